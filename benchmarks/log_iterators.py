@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Benchmark for LogFile named iterators
+
+Writes a syslog file with given number of entries and measures entries per
+second when several named iterators read the same file concurrently, one
+entry or one batch at a time.
+
+Usage: python benchmarks/log_iterators.py [entries] [iterators]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from systematic.log import LogFile
+
+DEFAULT_ENTRIES = 1000000
+DEFAULT_ITERATORS = 4
+BATCH_SIZE = 1000
+
+
+def write_logfile(path, count):
+    """Write test file
+
+    Every tenth entry has a continuation line
+    """
+    with open(path, 'w') as fd:
+        for index in range(count):
+            seconds = index // 10
+            fd.write('Oct 16 {:02d}:{:02d}:{:02d} host{:d} prog[{:d}]: message {:d}\n'.format(
+                seconds // 3600 % 24, seconds // 60 % 60, seconds % 60, index % 5, index % 100, index
+            ))
+            if index % 10 == 0:
+                fd.write('    continuation of message {:d}\n'.format(index))
+
+
+def report(name, count, elapsed):
+    print('{:30s} {:10.0f} entries/s ({:d} entries in {:.2f}s)'.format(name, count / elapsed, count, elapsed))
+
+
+def interleaved(path, iterators):
+    """Iterators advancing in turns, one entry at a time
+
+    """
+    logfile = LogFile(path)
+    names = ['iterator{:d}'.format(i) for i in range(iterators)]
+    for name in names:
+        logfile.register_iterator(name)
+
+    count = 0
+    start = time.time()
+    active = list(names)
+    while active:
+        for name in list(active):
+            try:
+                logfile.next_iterator_match(name)
+                count += 1
+            except StopIteration:
+                active.remove(name)
+    report('{:d} iterators, next'.format(iterators), count, time.time() - start)
+
+
+def batched(path, iterators):
+    """Iterators advancing in turns, one batch at a time
+
+    """
+    logfile = LogFile(path)
+    names = ['iterator{:d}'.format(i) for i in range(iterators)]
+    for name in names:
+        logfile.register_iterator(name)
+
+    count = 0
+    start = time.time()
+    active = list(names)
+    while active:
+        for name in list(active):
+            entries = logfile.next_n(name, BATCH_SIZE)
+            if not entries:
+                active.remove(name)
+            count += len(entries)
+    report('{:d} iterators, next_n({:d})'.format(iterators, BATCH_SIZE), count, time.time() - start)
+
+
+def filtered(path, iterators):
+    """Iterators with callbacks over loaded file
+
+    """
+    logfile = LogFile(path)
+    logfile.reload()
+    count = 0
+    start = time.time()
+    for index in range(iterators):
+        cursor = logfile.register_iterator('filter{:d}'.format(index), lambda entry: entry.pid == '1')
+        count += len(logfile)
+        for entry in cursor:
+            pass
+    report('{:d} iterators, callback'.format(iterators), count, time.time() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ENTRIES
+    iterators = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_ITERATORS
+
+    fd, path = tempfile.mkstemp(prefix='log-iterators', suffix='.log')
+    os.close(fd)
+    try:
+        write_logfile(path, count)
+        interleaved(path, iterators)
+        batched(path, iterators)
+        filtered(path, iterators)
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Benchmark for syslog line parsing
+
+Compares lines per second of systematic.log.LogEntry against the previous
+implementation, which parsed each timestamp with strptime and tried the source
+formats one by one. Also verifies both produce identical fields and compares
+bytes per cached entry.
+
+Usage: python benchmarks/log_parser.py [lines]
+"""
+
+import random
+import sys
+import time
+import tracemalloc
+
+from datetime import datetime
+
+from systematic.log import LogEntry, LogFileError, SourceMatcher, SOURCE_FORMATS
+
+DEFAULT_LINES = 200000
+
+HOSTS = ('web1', 'web2', 'db1', 'mail')
+SOURCES = (
+    '{host} sshd[{pid}]',
+    '{host} kernel',
+    '{host} postfix/smtpd[{pid}]',
+    '<13> {host} cron[{pid}]',
+    '<3.4> {host} sudo',
+)
+FIELDS = ('version', 'host', 'program', 'pid', 'source', 'message', 'time')
+
+
+class LegacyLogEntry(object):
+    """Previous LogEntry parsing implementation
+
+    """
+    def __init__(self, logfile, line, year, source_formats):
+        line = line.rstrip()
+        self.logfile = logfile
+        self.line = line
+        self.message_fields = {}
+
+        self.version = None
+        self.host = None
+        self.program = None
+        self.pid = None
+
+        try:
+            mon, day, time, line = line.split(None, 3)
+        except ValueError:
+            raise LogFileError('Error splitting log line: {}'.format(line))
+
+        self.time = datetime.strptime('{} {} {} {}'.format(year, mon, day, time), '%Y %b %d %H:%M:%S')
+        try:
+            self.source, self.message = [x.strip() for x in line.split(':', 1)]
+            for fmt in source_formats:
+                m = fmt.match(self.source)
+                if m:
+                    for k, v in m.groupdict().items():
+                        setattr(self, k, v)
+                    break
+        except ValueError:
+            self.source = None
+            self.message = line
+
+
+def generate_lines(count):
+    """Generate test lines
+
+    Lines are spread over one day, several lines per second
+    """
+    rng = random.Random(count)
+    lines = []
+    for index in range(count):
+        seconds = index // 4
+        source = rng.choice(SOURCES).format(host=rng.choice(HOSTS), pid=rng.randint(1, 65535))
+        lines.append('Oct {:2d} {:02d}:{:02d}:{:02d} {}: message number {:d}\n'.format(
+            16 + seconds // 86400, seconds // 3600 % 24, seconds // 60 % 60, seconds % 60, source, index
+        ))
+    return lines
+
+
+def benchmark(name, loader, lines):
+    """Run benchmark
+
+    Returns parsed entries
+    """
+    start = time.time()
+    entries = [loader(line) for line in lines]
+    elapsed = time.time() - start
+    print('{:10s} {:10.0f} lines/s ({:d} lines in {:.2f}s)'.format(name, len(lines) / elapsed, len(lines), elapsed))
+    return entries
+
+
+def measure_memory(name, loader, lines):
+    """Measure memory
+
+    Measure bytes allocated per cached entry
+    """
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    entries = [loader(line) for line in lines]
+    allocated = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    print('{:10s} {:10.1f} bytes per cached entry'.format(name, allocated / len(entries)))
+    return allocated / len(entries)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_LINES
+    lines = generate_lines(count)
+    matcher = SourceMatcher.get(SOURCE_FORMATS)
+
+    legacy = benchmark('before', lambda line: LegacyLogEntry(None, line, 2020, SOURCE_FORMATS), lines)
+    current = benchmark('after', lambda line: LogEntry(None, line, 2020, matcher).decode(), lines)
+    benchmark('lazy', lambda line: LogEntry(None, line, 2020, matcher), lines)
+
+    for old, new in zip(legacy, current):
+        for field in FIELDS:
+            if getattr(old, field) != getattr(new, field):
+                raise SystemExit('Parsed field {} differs: {} != {}'.format(
+                    field, getattr(old, field), getattr(new, field)
+                ))
+    print('parsed output identical')
+    del legacy, current
+
+    before = measure_memory('before', lambda line: LegacyLogEntry(None, line, 2020, SOURCE_FORMATS), lines)
+    after = measure_memory('after', lambda line: LogEntry(None, line, 2020, matcher), lines)
+    print('{:.1f}x less memory per cached entry'.format(before / after))
+
+
+if __name__ == '__main__':
+    main()
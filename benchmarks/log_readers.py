@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""
+Benchmark for LogFile readers
+
+Writes a syslog file with given number of entries and measures entries per
+second for a full streaming pass over the file, with and without accessing
+decoded entry fields.
+
+The file is then compressed with each supported codec, and the threaded
+PipelinedReader is compared to decompressing on the parsing thread.
+
+Usage: python benchmarks/log_readers.py [entries]
+"""
+
+import bz2
+import gzip
+import lzma
+import os
+import sys
+import tempfile
+import time
+
+from systematic.log import LogFile
+from systematic.logreader import has_zstd, zstd
+
+DEFAULT_ENTRIES = 1000000
+
+
+def write_logfile(path, count):
+    """Write test file
+
+    Every tenth entry has a continuation line
+    """
+    with open(path, 'w') as fd:
+        for index in range(count):
+            seconds = index // 10
+            fd.write('Oct 16 {:02d}:{:02d}:{:02d} host{:d} prog[{:d}]: message {:d}\n'.format(
+                seconds // 3600 % 24, seconds // 60 % 60, seconds % 60, index % 5, index % 100, index
+            ))
+            if index % 10 == 0:
+                fd.write('    continuation of message {:d}\n'.format(index))
+
+
+def report(name, count, elapsed, size):
+    print('{:30s} {:10.0f} entries/s {:8.1f} MB/s ({:d} entries in {:.2f}s)'.format(
+        name, count / elapsed, size / elapsed / 2**20, count, elapsed
+    ))
+
+
+def full_pass(path, decode):
+    """Stream all entries from file
+
+    """
+    logfile = LogFile(path, streaming=True)
+    count = 0
+    start = time.time()
+    for entry in logfile:
+        if decode:
+            entry.program
+        count += 1
+    report(
+        'buffered{}'.format(decode and ', decoded' or ''),
+        count, time.time() - start, os.stat(path).st_size
+    )
+
+
+def compress(path, codec):
+    """Compress test file
+
+    Returns path to compressed file, or None if codec is not available
+    """
+    with open(path, 'rb') as fd:
+        data = fd.read()
+    if codec == 'gzip':
+        data = gzip.compress(data)
+    elif codec == 'bz2':
+        data = bz2.compress(data)
+    elif codec == 'xz':
+        data = lzma.compress(data)
+    elif codec == 'zstd':
+        if not has_zstd:
+            return None
+        if hasattr(zstd, 'compress'):
+            data = zstd.compress(data)
+        else:
+            data = zstd.ZstdCompressor().compress(data)
+    compressed = '{}.{}'.format(path, codec)
+    with open(compressed, 'wb') as fd:
+        fd.write(data)
+    return compressed
+
+
+def inline_pass(path, codec, size):
+    """Stream all entries decompressing on parsing thread
+
+    Throughput is reported for uncompressed size
+    """
+    opener = {'gzip': gzip.GzipFile, 'bz2': bz2.BZ2File, 'xz': lzma.LZMAFile}[codec]
+    fd = opener(path)
+    count = 0
+    start = time.time()
+    for entry in LogFile(fd, streaming=True):
+        entry.program
+        count += 1
+    fd.close()
+    report('{} inline'.format(codec), count, time.time() - start, size)
+
+
+def pipelined_pass(path, codec, size):
+    """Stream all entries decompressing in producer thread
+
+    """
+    count = 0
+    start = time.time()
+    for entry in LogFile(path, streaming=True):
+        entry.program
+        count += 1
+    report('{} pipelined'.format(codec), count, time.time() - start, size)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ENTRIES
+
+    fd, path = tempfile.mkstemp(prefix='log-readers', suffix='.log')
+    os.close(fd)
+    try:
+        write_logfile(path, count)
+        for decode in (False, True):
+            full_pass(path, decode)
+
+        for codec in ('gzip', 'bz2', 'xz', 'zstd'):
+            compressed = compress(path, codec)
+            if compressed is None:
+                print('{:30s} not available'.format(codec))
+                continue
+            try:
+                size = os.stat(path).st_size
+                if codec != 'zstd':
+                    inline_pass(compressed, codec, size)
+                pipelined_pass(compressed, codec, size)
+            finally:
+                os.unlink(compressed)
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
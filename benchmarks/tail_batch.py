@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Benchmark for TailReader backlog catch-up
+
+Writes a log file with given number of lines and measures lines per second
+for reading the whole backlog with TailReader.readline() and with
+TailReader.read_batch(), using the poll and inotify backends.
+
+Usage: python benchmarks/tail_batch.py [lines]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from systematic.inotify import has_inotify
+from systematic.tail import TailReader
+
+DEFAULT_LINES = 500000
+
+
+def write_logfile(path, count):
+    with open(path, 'w') as fd:
+        for index in range(count):
+            seconds = index // 10
+            fd.write('Oct 16 {:02d}:{:02d}:{:02d} host{:d} prog[{:d}]: message {:d}\n'.format(
+                seconds // 3600 % 24, seconds // 60 % 60, seconds % 60, index % 5, index % 100, index
+            ))
+
+
+def report(name, count, elapsed, size):
+    print('{:30s} {:10.0f} lines/s {:8.1f} MB/s ({:d} lines in {:.2f}s)'.format(
+        name, count / elapsed, size / elapsed / 2**20, count, elapsed
+    ))
+
+
+def readline_pass(path, count, backend):
+    reader = TailReader(path, backend=backend)
+    start = time.time()
+    for index in range(count):
+        reader.readline()
+    report('readline, {}'.format(backend), count, time.time() - start, os.stat(path).st_size)
+    reader.close()
+
+
+def batch_pass(path, count, backend):
+    reader = TailReader(path, backend=backend)
+    lines = 0
+    start = time.time()
+    while lines < count:
+        lines += len(reader.read_batch())
+    report('read_batch, {}'.format(backend), lines, time.time() - start, os.stat(path).st_size)
+    reader.close()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_LINES
+
+    fd, path = tempfile.mkstemp(prefix='tail-batch', suffix='.log')
+    os.close(fd)
+    try:
+        write_logfile(path, count)
+        for backend in ['poll'] + (['inotify'] if has_inotify else []):
+            readline_pass(path, count, backend)
+            batch_pass(path, count, backend)
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
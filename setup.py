@@ -16,6 +16,9 @@ setup(
     packages=find_packages(),
     scripts=glob.glob('bin/*'),
     install_requires=(),
+    extras_require={
+        'zstd': ('zstandard', ),
+    },
     tests_require=(
         'pytest',
         'pytest-runner',
@@ -0,0 +1,152 @@
+"""
+Linux inotify file change notifications
+
+Minimal ctypes wrapper for the inotify API of the C library. has_inotify
+is False on other platforms, or if the C library does not provide inotify.
+
+Example usage:
+
+from systematic.inotify import Inotify, IN_MODIFY
+watcher = Inotify()
+watcher.add_watch('/var/log', IN_MODIFY)
+for wd, mask, cookie, name in watcher.wait(timeout=1.0):
+    print(name)
+
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+
+# Event masks from sys/inotify.h
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event header: wd, mask, cookie, len
+EVENT_HEADER = struct.Struct('iIII')
+
+# Bytes read from inotify file descriptor at once
+EVENT_BUFFER_SIZE = 65536
+
+_libc = None
+if sys.platform[:5] == 'linux':
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        _libc.inotify_init1.argtypes = (ctypes.c_int, )
+        _libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        _libc.inotify_rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+    except (OSError, AttributeError):
+        _libc = None
+has_inotify = _libc is not None
+
+
+class InotifyError(Exception):
+    pass
+
+
+class Inotify(object):
+    """Inotify instance
+
+    Wrapper for an inotify file descriptor. The descriptor is non-blocking,
+    use wait() to wait for events or register fileno() to a selector.
+    """
+    def __init__(self):
+        if not has_inotify:
+            raise InotifyError('inotify is not available on this platform')
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self.fd = None
+            raise InotifyError('Error initializing inotify: {}'.format(os.strerror(ctypes.get_errno())))
+
+    def __repr__(self):
+        return 'inotify {}'.format(self.fd)
+
+    def __del__(self):
+        self.close()
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """Add watch
+
+        Watch path for events in mask. Returns the watch descriptor
+        """
+        if self.fd is None:
+            raise InotifyError('inotify instance is closed')
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise InotifyError('Error watching {}: {}'.format(path, os.strerror(ctypes.get_errno())))
+        return wd
+
+    def remove_watch(self, wd):
+        if self.fd is None:
+            return
+        if _libc.inotify_rm_watch(self.fd, wd) < 0 and ctypes.get_errno() != errno.EINVAL:
+            raise InotifyError('Error removing watch {}: {}'.format(wd, os.strerror(ctypes.get_errno())))
+
+    def read(self):
+        """Read events
+
+        Returns list of pending events as tuples (wd, mask, cookie, name)
+        without waiting. Name is a string, empty for events of the watched
+        path itself.
+        """
+        if self.fd is None:
+            raise InotifyError('inotify instance is closed')
+        try:
+            data = os.read(self.fd, EVENT_BUFFER_SIZE)
+        except BlockingIOError:
+            return []
+        except OSError as e:
+            raise InotifyError('Error reading inotify events: {}'.format(e))
+
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\x00'))
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def wait(self, timeout=None):
+        """Wait for events
+
+        Wait up to timeout seconds, or forever if timeout is None, for events.
+        Returns list of events like read(), empty list on timeout.
+        """
+        if self.fd is None:
+            raise InotifyError('inotify instance is closed')
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        if not poller.poll(timeout * 1000 if timeout is not None else None):
+            return []
+        return self.read()
+
+    def close(self):
+        if getattr(self, 'fd', None) is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -8,16 +8,34 @@ import sys
 import fnmatch
 import re
 import urllib
-import bz2
-import gzip
 import threading
+import array
+import io
+import bisect
+import collections
+import heapq
+import itertools
+import json
 import logging
 import logging.handlers
+import random
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
 
 from builtins import int
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
 
-from systematic.tail import TailReader
+from systematic.logaggregate import LogAggregation, DEFAULT_INTERVAL, DEFAULT_GROUP_BY, DEFAULT_TOP, DEFAULT_CAPACITY
+from systematic.logformats.extractors import DEFAULT_MESSAGE_EXTRACTORS
+from systematic.logindex import LogFileSidecarIndex, BlockReader
+from systematic.logreader import (
+    LogReaderError, PipelinedReader, ReverseLineReader, detect_compression
+)
+from systematic.tail import AsyncTailReader, MultiTailReader, TailReader
 
 DEFAULT_LOGFORMAT = '%(module)s %(levelname)s %(message)s'
 DEFAULT_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
@@ -59,6 +77,243 @@ SOURCE_FORMATS = [
     re.compile(r'^(?P<host>[^\s]+)\s+(?P<program>[^\[]+)$'),
 ]
 
+# Month abbreviations in syslog timestamps, matched before falling back to strptime
+SYSLOG_MONTHS = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12,
+}
+
+# LogFile.seek_time stops bisecting and scans forward when range is smaller than this
+SEEK_TIME_SCAN_BYTES = 8192
+
+# Number of last loaded bytes compared to detect replaced data in incremental reloads
+RESUME_CHECK_BYTES = 4096
+
+# First bytes of lines which may be blank, and of continuation lines
+LINE_WHITESPACE_BYTES = frozenset(b' \t\r\n\x0b\x0c')
+LINE_CONTINUATION_BYTES = frozenset(b' \t')
+
+# Maximum number of parsed syslog timestamps (one per second) to cache
+TIMESTAMP_CACHE_SIZE = 4096
+_TIMESTAMP_CACHE = {}
+
+# Source fields decoded to LogEntry attributes, in order of LogEntry._fields
+LOGENTRY_SOURCE_FIELDS = ('source', 'message', 'version', 'host', 'program', 'pid')
+LOGENTRY_SOURCE_FIELD_INDEX = dict((name, index) for index, name in enumerate(LOGENTRY_SOURCE_FIELDS))
+
+# JSON lines output: encoder shared by all entries, and characters written per chunk
+JSON_LINES_ENCODER = json.JSONEncoder(separators=(',', ':'))
+JSON_LINES_BUFFER_SIZE = 2**16
+
+RE_NAMED_GROUP = re.compile(r'\(\?P<(?P<name>[^>]+)>')
+RE_BACKREFERENCE = re.compile(r'\(\?P=|\\\d')
+
+
+def parse_syslog_timestamp(year, month, day, time):
+    """Parse syslog timestamp
+
+    Return datetime for syslog timestamp fields like 'Oct', '6', '10:00:01' in
+    given year. Common timestamps are decoded with a month lookup table and
+    integer slicing, anything else with strptime. Results are cached per second.
+
+    Raises ValueError for invalid timestamps.
+    """
+    key = (year, month, day, time)
+    try:
+        return _TIMESTAMP_CACHE[key]
+    except KeyError:
+        pass
+
+    month_number = SYSLOG_MONTHS.get(month, None)
+    if month_number is not None and len(day) <= 2 and day.isdigit() and \
+            len(time) == 8 and time[2] == ':' and time[5] == ':' and \
+            time[:2].isdigit() and time[3:5].isdigit() and time[6:].isdigit():
+        value = datetime(year, month_number, int(day), int(time[:2]), int(time[3:5]), int(time[6:]))
+    else:
+        value = datetime.strptime('{} {} {} {}'.format(year, month, day, time), '%Y %b %d %H:%M:%S')
+
+    if len(_TIMESTAMP_CACHE) >= TIMESTAMP_CACHE_SIZE:
+        _TIMESTAMP_CACHE.clear()
+    _TIMESTAMP_CACHE[key] = value
+    return value
+
+
+class SourceMatcher(object):
+    """Syslog source field matcher
+
+    Combines a list of source format regexps to a single regexp with one
+    alternative per format. Alternatives are tried in list order, so the result
+    is same as matching the formats one by one and using the first match.
+
+    Formats which can't be combined (different flags, backreferences) are
+    matched one by one.
+    """
+
+    __instances = {}
+
+    def __init__(self, source_formats):
+        self.source_formats = tuple(source_formats)
+        self.regexp = None
+        self.alternatives = {}
+
+        if len(set(fmt.flags for fmt in self.source_formats)) != 1:
+            return
+        if any(RE_BACKREFERENCE.search(fmt.pattern) for fmt in self.source_formats):
+            return
+
+        patterns = []
+        for index, fmt in enumerate(self.source_formats):
+            alternative = '_format{:d}'.format(index)
+            fields = []
+
+            def rename_group(m):
+                renamed = '_f{:d}_{}'.format(index, m.group('name'))
+                fields.append((renamed, m.group('name')))
+                return '(?P<{}>'.format(renamed)
+
+            patterns.append('(?P<{}>{})'.format(alternative, RE_NAMED_GROUP.sub(rename_group, fmt.pattern)))
+            self.alternatives[alternative] = (
+                tuple(name for renamed, name in fields),
+                tuple(renamed for renamed, name in fields),
+            )
+
+        try:
+            self.regexp = re.compile('|'.join(patterns), self.source_formats[0].flags)
+        except re.error:
+            self.regexp = None
+
+    def __iter__(self):
+        return iter(self.source_formats)
+
+    def __reduce__(self):
+        return (SourceMatcher.get, (self.source_formats, ))
+
+    @classmethod
+    def get(cls, source_formats):
+        """Get matcher
+
+        Return cached matcher for list of source formats
+        """
+        if isinstance(source_formats, SourceMatcher):
+            return source_formats
+
+        key = tuple(source_formats)
+        if key not in cls.__instances:
+            cls.__instances[key] = cls(key)
+        return cls.__instances[key]
+
+    def match(self, value):
+        """Match source
+
+        Returns dictionary of named fields from first matching source format
+        or None
+        """
+        if self.regexp is None:
+            for fmt in self.source_formats:
+                m = fmt.match(value)
+                if m:
+                    return m.groupdict()
+            return None
+
+        m = self.regexp.match(value)
+        if not m:
+            return None
+
+        names, groups = self.alternatives[m.lastgroup]
+        if len(groups) == 1:
+            return {names[0]: m.group(groups[0])}
+        return dict(zip(names, m.group(*groups)))
+
+
+def regexp_literals(regexp):
+    """Literal strings required by regexp
+
+    Returns tuple (prefix, literal) of literal string any string matched
+    with regexp.match() must start with, and the longest literal string
+    it must contain. Either can be empty string if not known.
+    """
+    if isinstance(regexp, str):
+        regexp = re.compile(regexp)
+    if not isinstance(regexp.pattern, str) or regexp.flags & re.IGNORECASE:
+        return '', ''
+
+    try:
+        parsed = sre_parse.parse(regexp.pattern, regexp.flags)
+        state = getattr(parsed, 'state', None) or getattr(parsed, 'pattern', None)
+        if state.flags & re.IGNORECASE:
+            return '', ''
+    except Exception:
+        return '', ''
+
+    prefix = None
+    literals = ['']
+    for index, (op, value) in enumerate(parsed):
+        if op == sre_parse.AT and value == sre_parse.AT_BEGINNING and index == 0:
+            continue
+        if op == sre_parse.LITERAL:
+            literals[-1] += chr(value)
+            continue
+        if prefix is None:
+            prefix = literals[-1]
+        literals.append('')
+
+    if prefix is None:
+        prefix = literals[-1]
+    return prefix, max(literals, key=len)
+
+
+class MessageMatcher(object):
+    """Multi-pattern message matcher
+
+    Matches messages against a dictionary of named regexps in one call.
+    Literal prefix and required literal strings are extracted from the
+    regexps, so the regexp engine is only called for messages which can
+    match. Rules are matched with regexp.match() like filter_message.
+    """
+    def __init__(self, rules):
+        self.rules = []
+        self.by_first_character = {}
+        self.unprefixed = []
+
+        for name, regexp in rules.items():
+            if isinstance(regexp, str):
+                regexp = re.compile(regexp)
+            prefix, literal = regexp_literals(regexp)
+            if literal == prefix:
+                literal = ''
+            rule = (name, regexp, prefix, literal)
+            self.rules.append(rule)
+            if prefix:
+                self.by_first_character.setdefault(prefix[0], []).append(rule)
+            else:
+                self.unprefixed.append(rule)
+
+    def __repr__(self):
+        return 'matcher for {:d} rules'.format(len(self.rules))
+
+    def match(self, message):
+        """Match message
+
+        Returns dictionary of rule name to regexp groupdict for matching rules
+        """
+        matches = {}
+        if message is None:
+            return matches
+
+        rules = self.by_first_character.get(message[:1], None)
+        for rule_list in (rules, self.unprefixed):
+            if not rule_list:
+                continue
+            for name, regexp, prefix, literal in rule_list:
+                if prefix and not message.startswith(prefix):
+                    continue
+                if literal and literal not in message:
+                    continue
+                m = regexp.match(message)
+                if m:
+                    matches[name] = m.groupdict()
+        return matches
+
 
 class LoggerError(Exception):
     """
@@ -342,83 +597,498 @@ class LogFileError(Exception):
     pass
 
 
+def _source_field(name):
+    """Decoded source field property
+
+    Property for a LogEntry field decoded from the line on first access
+    """
+    index = LOGENTRY_SOURCE_FIELD_INDEX[name]
+
+    def get_field(self):
+        if self._fields is None:
+            self.__decode_source__()
+        return self._fields[index]
+
+    def set_field(self, value):
+        if self._fields is None:
+            self.__decode_source__()
+        self._fields[index] = value
+
+    return property(get_field, set_field, doc='Entry {} decoded on first access'.format(name))
+
+
 class LogEntry(object):
     """
     Generic syslog logfile entry
+
+    Only the raw line is stored when the entry is created. The line may be
+    given as bytes, and is decoded to a string when first accessed. Time and
+    source fields are decoded from the line when first accessed and kept after
+    that.
+    Decoding errors raise LogFileError on access; call decode() to check the
+    line when the entry is created.
     """
+
+    __slots__ = (
+        'logfile', 'year', 'source_formats',
+        '_line', '_continuation', '_time', '_fields', '_message_fields',
+    )
+
     def __init__(self, logfile, line, year, source_formats):
-        line = line.rstrip()
         self.logfile = logfile
-        self.line = line
-        self.message_fields = {}
+        self._line = line.rstrip()
+        self.year = year
+        self.source_formats = source_formats
+        self._continuation = None
+        self._time = None
+        self._fields = None
+        self._message_fields = None
+
+    def __repr__(self):
+        return '{} {}{}{}'.format(
+            self.time.strftime('%Y-%m-%d %H:%M:%S'),
+            self.program is not None and '{} '.format(self.program) or '',
+            self.pid is not None and '({}) '.format(self.pid) or '',
+            self.message
+        )
+
+    def __getstate__(self):
+        """Pickle state
+
+        Entries are pickled without the parent logfile
+        """
+        state = dict((name, getattr(self, name, None)) for name in LogEntry.__slots__)
+        state['logfile'] = None
+        return getattr(self, '__dict__', None), state
+
+    def __setstate__(self, state):
+        data, slots = state
+        for name, value in slots.items():
+            setattr(self, name, value)
+        if data:
+            self.__dict__.update(data)
+
+    def __getattr__(self, attr):
+        """Extra source fields
+
+        Return fields matched by custom source formats
+        """
+        if attr[:1] == '_':
+            raise AttributeError(attr)
+
+        try:
+            if self._fields is None:
+                self.__decode_source__()
+        except LogFileError:
+            raise AttributeError(attr)
+
+        extra = self._fields[-1]
+        if extra is None or attr not in extra:
+            raise AttributeError('{} has no attribute {}'.format(self.__class__.__name__, attr))
+        return extra[attr]
 
-        self.version = None
-        self.host = None
-        self.program = None
-        self.pid = None
+    def __split_line__(self):
+        """Split line
 
+        Split line to parts passed to __decode_time__ and __decode_source__
+        """
         try:
-            mon, day, time, line = line.split(None, 3)
+            mon, day, time, line = self.line.split(None, 3)
         except ValueError:
             raise LogFileError('Error splitting log line: {}'.format(self.line))
+        return mon, day, time, line
+
+    def __decode_time__(self, parts=None):
+        """Decode time
 
+        Parse entry time from the line, or from parts of already split line
+        """
+        mon, day, time, line = parts or self.__split_line__()
         try:
-            self.time = datetime.strptime('{} {} {} {}'.format(year, mon, day, time), '%Y %b %d %H:%M:%S')
+            self._time = parse_syslog_timestamp(self.year, mon, day, time)
         except ValueError:
             raise LogFileError('Error parsing entry time from line: {}'.format(self.line))
 
-        try:
-            self.source, self.message = [x.strip() for x in line.split(':', 1)]
-            for fmt in source_formats:
-                m = fmt.match(self.source)
-                if m:
-                    for k, v in m.groupdict().items():
-                        setattr(self, k, v)
-                    break
+    def __decode_source__(self, parts=None):
+        """Decode source and message
+
+        Parse source, message and fields matched by source formats from the line,
+        or from parts of already split line
+        """
+        mon, day, time, line = parts or self.__split_line__()
 
+        try:
+            source, message = [x.strip() for x in line.split(':', 1)]
+            fields = SourceMatcher.get(self.source_formats).match(source)
         except ValueError:
             # Lines like '--- last message repeated 2 times ---'
-            self.source = None
-            self.message = line
+            source = None
+            message = line
+            fields = None
 
-    def __repr__(self):
-        return '{} {}{}{}'.format(
-            self.time.strftime('%Y-%m-%d %H:%M:%S'),
-            self.program is not None and '{} '.format(self.program) or '',
-            self.pid is not None and '({}) '.format(self.pid) or '',
-            self.message
-        )
+        self.__store_fields__(source, message, fields)
+
+    def __store_fields__(self, source, message, fields=None):
+        """Store decoded fields
+
+        Fields matching LOGENTRY_SOURCE_FIELDS are stored to the entry, any
+        other fields are available as extra attributes. Continuation lines
+        appended before decoding are added to the message.
+        """
+        if self._continuation is not None:
+            message = '{}{}'.format(message, self._continuation)
+            self._continuation = None
+
+        values = [source, message, None, None, None, None]
+        extra = None
+        if fields:
+            for key, value in fields.items():
+                if key in LOGENTRY_SOURCE_FIELD_INDEX:
+                    values[LOGENTRY_SOURCE_FIELD_INDEX[key]] = value
+                else:
+                    if extra is None:
+                        extra = {}
+                    extra[key] = value
+        values.append(extra)
+        self._fields = values
+
+    @property
+    def line(self):
+        if isinstance(self._line, bytes):
+            self._line = self._line.decode('utf-8', 'replace')
+        return self._line
+
+    @line.setter
+    def line(self, value):
+        self._line = value
+
+    @property
+    def time(self):
+        if self._time is None:
+            self.__decode_time__()
+        return self._time
+
+    @time.setter
+    def time(self, value):
+        self._time = value
+
+    source = _source_field('source')
+    message = _source_field('message')
+    version = _source_field('version')
+    host = _source_field('host')
+    program = _source_field('program')
+    pid = _source_field('pid')
+
+    @property
+    def message_fields(self):
+        """Message fields
+
+        Fields are extracted from the message on first access with message
+        field extractors of the parent logfile
+        """
+        if self._message_fields is None:
+            self._message_fields = {}
+            extractors = getattr(self.logfile, 'extractors', None)
+            if extractors is not None:
+                self._message_fields.update(extractors.extract(self))
+        return self._message_fields
+
+    @message_fields.setter
+    def message_fields(self, value):
+        self._message_fields = value
+
+    def decode(self):
+        """Decode entry
+
+        Decode all fields from the line. Raises LogFileError if line can't be parsed.
+        """
+        if self._time is None or self._fields is None:
+            parts = self.__split_line__()
+            if self._time is None:
+                self.__decode_time__(parts)
+            if self._fields is None:
+                self.__decode_source__(parts)
+        return self
+
+    def as_dict(self, verbose=False):
+        """Return entry as dict
+
+        With verbose message_fields and extra source fields are included.
+        Raises LogFileError if line can't be parsed.
+        """
+        self.decode()
+        source, message, version, host, program, pid, extra = self._fields
+        data = {
+            'time': self._time.isoformat(' '),
+            'host': host,
+            'program': program,
+            'pid': pid,
+            'message': message,
+        }
+        if verbose:
+            data['source'] = source
+            data['message_fields'] = self.message_fields
+            if version is not None:
+                data['version'] = version
+            if extra:
+                data.update(extra)
+        return data
+
+    def to_json(self, verbose=False):
+        """Return entry as JSON
+
+        Returns the entry as one line of JSON without newline, for JSON lines
+        output. Raises LogFileError if line can't be parsed.
+        """
+        return JSON_LINES_ENCODER.encode(self.as_dict(verbose))
 
     def append(self, message):
-        self.message = '{}\n{}'.format(self.message, message.rstrip())
+        if self._fields is not None:
+            self.message = '{}\n{}'.format(self.message, message.rstrip())
+        elif self._continuation is not None:
+            self._continuation = '{}\n{}'.format(self._continuation, message.rstrip())
+        else:
+            self._continuation = '\n{}'.format(message.rstrip())
 
     def update_message_fields(self, data):
         self.message_fields.update(data)
 
 
+class LogFileIndex(object):
+    """Index of cached logfile entries
+
+    Columnar index of entries in a LogFile: list offsets of entries by host
+    and by program, and entry times with offsets for range queries. Time
+    columns are kept in file order and sorted on demand for files with out of
+    order timestamps.
+    """
+    def __init__(self):
+        self.hosts = {}
+        self.programs = {}
+        self.times = []
+        self.offsets = array.array('L')
+        self.__ordered = True
+        self.__sorted = None
+
+    def __repr__(self):
+        return 'index of {:d} entries'.format(len(self.offsets))
+
+    def clear(self):
+        self.hosts.clear()
+        self.programs.clear()
+        self.times = []
+        self.offsets = array.array('L')
+        self.__ordered = True
+        self.__sorted = None
+
+    def add(self, offset, entry):
+        """Add entry
+
+        Add entry at given list offset to the index
+        """
+        if entry.host not in self.hosts:
+            self.hosts[entry.host] = array.array('L')
+        self.hosts[entry.host].append(offset)
+
+        if entry.program not in self.programs:
+            self.programs[entry.program] = array.array('L')
+        self.programs[entry.program].append(offset)
+
+        if self.times and entry.time < self.times[-1]:
+            self.__ordered = False
+        self.times.append(entry.time)
+        self.offsets.append(offset)
+        self.__sorted = None
+
+    def truncate(self, offset):
+        """Truncate index
+
+        Remove entries with list offset >= offset from the index
+        """
+        for column in (self.hosts, self.programs):
+            for key in list(column.keys()):
+                offsets = column[key]
+                while offsets and offsets[-1] >= offset:
+                    offsets.pop()
+                if not offsets:
+                    del column[key]
+
+        while self.offsets and self.offsets[-1] >= offset:
+            self.offsets.pop()
+            self.times.pop()
+        self.__ordered = all(a <= b for a, b in zip(self.times, self.times[1:]))
+        self.__sorted = None
+
+    def __sorted_columns__(self):
+        """Sorted time columns
+
+        Entries are usually added in time order, so sorting is only needed
+        for files with out of order timestamps
+        """
+        if self.__ordered:
+            return self.times, self.offsets
+        if self.__sorted is None:
+            order = sorted(range(len(self.times)), key=self.times.__getitem__)
+            self.__sorted = (
+                [self.times[i] for i in order],
+                array.array('L', (self.offsets[i] for i in order)),
+            )
+        return self.__sorted
+
+    def between(self, start=None, end=None):
+        """Offsets in time range
+
+        Return sorted list offsets for entries with start <= time < end. Start
+        or end can be None for open ended range.
+        """
+        times, offsets = self.__sorted_columns__()
+        first = bisect.bisect_left(times, start) if start is not None else 0
+        last = bisect.bisect_left(times, end) if end is not None else len(times)
+        return sorted(offsets[first:last])
+
+
+class LogFileCursor(object):
+    """Named iterator for LogFile
+
+    Position of a named iterator in a LogFile. Cached entries are returned
+    from the list and entries past the end are parsed from the file, so any
+    number of cursors can iterate the same file independently. In streaming
+    mode all cursors share the single pass over the file.
+
+    Optional callback filters returned entries: entries for which it returns
+    False are skipped.
+    """
+    def __init__(self, logfile, name, callback=None):
+        self.logfile = logfile
+        self.name = name
+        self.callback = callback
+        self.position = 0
+        self.__exhausted = False
+
+    def __repr__(self):
+        return '{} iterator {} position {:d}'.format(self.logfile.path, self.name, self.position)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
+
+    def reset(self):
+        self.position = 0
+        self.__exhausted = False
+
+    def next(self, callback=None):
+        """Next entry
+
+        Return next entry matching callback, or raise StopIteration and reset
+        the cursor to beginning at end of file
+        """
+        if self.__exhausted:
+            self.__exhausted = False
+            raise StopIteration
+
+        if callback is None:
+            callback = self.callback
+
+        logfile = self.logfile
+        while True:
+            if self.position < len(logfile):
+                entry = list.__getitem__(logfile, self.position)
+            else:
+                entry = logfile.__read_entry__()
+                if entry is None:
+                    self.reset()
+                    raise StopIteration
+            self.position += 1
+
+            if callback is None or callback(entry):
+                return entry
+
+    def next_n(self, count, callback=None):
+        """Next entries
+
+        Return list of up to count next entries matching callback. The list is
+        shorter than count at end of file, and empty when the cursor was
+        already at the end, in which case the cursor is reset to beginning.
+        """
+        if callback is None:
+            callback = self.callback
+
+        if self.__exhausted:
+            self.__exhausted = False
+            return []
+
+        logfile = self.logfile
+        entries = []
+        if callback is None and not logfile.streaming and self.position < len(logfile):
+            entries = list.__getitem__(logfile, slice(self.position, self.position + count))
+            self.position += len(entries)
+
+        while len(entries) < count:
+            try:
+                entries.append(self.next(callback))
+            except StopIteration:
+                # Cursor was reset: return empty list on next call
+                self.__exhausted = bool(entries)
+                break
+        return entries
+
+
 class LogFile(list):
     """Generic syslog file iterator
 
     Opens logfile with self.lineloader and returns
 
     default lineloader is systematic.log.LogEntry
+
+    With streaming=True parsed entries are not cached to the list: iterating
+    the object reads the file once, yielding each entry with its continuation
+    lines, and memory use does not depend on the size of the file.
+
+    With index=True cached entries are indexed by host, program and time
+    while the file is loaded, and filter_host, filter_program and between
+    return matches from the index instead of scanning all entries.
+
+    With sidecar_index=True a persistent block index is stored next to the
+    file, or to index_directory, and filter_host, filter_program and between
+    only parse blocks of the file which may contain matching entries, unless
+    the entries are already cached. See systematic.logindex for details.
+
+    Entry message_fields are extracted with extractors, by default with the
+    registry in systematic.logformats.extractors.
     """
 
     lineloader = LogEntry
+    indexer = LogFileIndex
+    extractors = DEFAULT_MESSAGE_EXTRACTORS
 
-    def __init__(self, path, source_formats=SOURCE_FORMATS):
+    def __init__(self, path, source_formats=SOURCE_FORMATS, streaming=False, index=False,
+                 sidecar_index=False, index_directory=None, extractors=None):
         if isinstance(path, str):
             self.path = os.path.expanduser(os.path.expandvars(path))
         else:
             self.path = path
 
         self.source_formats = source_formats
+        self.source_matcher = SourceMatcher.get(source_formats)
+        self.streaming = streaming
+        self.index = self.indexer() if index and not streaming else None
+        self.sidecar_index = sidecar_index
+        self.index_directory = index_directory
         self.mtime = None
+        self.__sidecar = None
+        if extractors is not None:
+            self.extractors = extractors
 
         self.iterators = {}
         self.register_iterator('default')
 
         self.__loaded = False
+        self.__reader = None
+        self.__stat = None
+        self.__parsed_offsets = None
+        self.__resume_state = None
         self.fd = None
 
     def __repr__(self):
@@ -427,73 +1097,155 @@ class LogFile(list):
     def __iter__(self):
         return self
 
-    def register_iterator(self, name):
+    def register_iterator(self, name, callback=None):
+        """Register named iterator
+
+        Returns LogFileCursor for the iterator
+        """
         if name in self.iterators:
             raise LogFileError('Iterator name already registered: {}'.format(name))
-        self.iterators[name] = None
+        self.iterators[name] = LogFileCursor(self, name, callback)
+        return self.iterators[name]
 
-    def get_iterator(self, name):
-        if name not in self.iterators:
+    def __cursor__(self, name):
+        try:
+            return self.iterators[name]
+        except KeyError:
             raise LogFileError('Iterator name not registered: {}'.format(name))
 
-        if self.iterators[name] is None:
-            self.iterators[name] = 0
-
-        return self.iterators[name]
+    def get_iterator(self, name):
+        return self.__cursor__(name).position
 
     def reset_iterator(self, name):
-        if name not in self.iterators:
-            raise LogFileError('Iterator name not registered: {}'.format(name))
-
-        self.iterators[name] = None
+        self.__cursor__(name).reset()
 
     def update_iterator(self, name, value=None):
-        if name not in self.iterators:
-            raise LogFileError('Iterator name not registered: {}'.format(name))
-
+        cursor = self.__cursor__(name)
         if value is not None:
-            self.iterators[name] = value
-
+            cursor.position = value
         else:
-            if self.iterators[name] is not None:
-                self.iterators[name] += 1
-            else:
-                self.iterators[name] = 0
+            cursor.position += 1
 
     def __open_logfile__(self, path):
-        """Try opening log file
+        """Open log file
 
-        Try opening logfile in gz, bz2 and raw text formats
+        Open logfile in gz, bz2, xz, zstd or raw text format. The format is
+        detected from magic bytes at start of the file, and cached while the
+        file is not modified, so the file is only opened once.
 
+        Compressed files are returned as PipelinedReader objects, which
+        decompress the file in a separate thread.
         """
         if not os.path.isfile(path):
             raise LogFileError('No such file: {}'.format(path))
 
         try:
-            fd = gzip.GzipFile(path)
-            fd.readline()
-            fd.seek(0)
-            return fd
-        except IOError:
-            pass
+            fd = open(path, 'rb')
+        except IOError as e:
+            raise LogFileError('Error opening logfile {}: {}'.format(path, e))
 
         try:
-            fd = bz2.BZ2File(path)
-            fd.readline()
-            fd.seek(0)
-            return fd
-        except IOError:
-            pass
+            codec = detect_compression(fd, path)
+            if codec is None:
+                return fd
+            return PipelinedReader(fd, codec)
+        except (IOError, LogReaderError) as e:
+            fd.close()
+            raise LogFileError('Error opening logfile {}: {}'.format(path, e))
+
+    def __open_source__(self):
+        """Open log source
+
+        Returns tuple (fd, mtime) for self.path, which may be a path or
+        an already opened file like object
+        """
+        if hasattr(self.path, 'readline'):
+            return self.path, datetime.now()
 
         try:
-            fd = open(path, 'r')
-            fd.readline()
-            fd.seek(0)
-            return fd
-        except IOError:
-            pass
+            fd = self.__open_logfile__(self.path)
+            mtime = datetime.fromtimestamp(os.stat(self.path).st_mtime)
+        except (OSError, LogReaderError) as e:
+            raise LogFileError('Error opening {}: {}'.format(self.path, e))
+        return fd, mtime
+
+    def __plain_file_stat__(self, fd):
+        """Stat plain file
+
+        Returns os.stat_result for uncompressed files opened from a path,
+        or None for compressed files and file like objects
+        """
+        if isinstance(fd, io.BufferedReader) and fd is not self.path:
+            return os.fstat(fd.fileno())
+        return None
+
+    def __read_lines__(self, fd):
+        """Read lines from file
+
+        Returns iterator of lines from fd as bytes. Lines read from text mode
+        file like objects are encoded back to bytes.
+        """
+        if isinstance(fd, (io.BufferedIOBase, PipelinedReader)):
+            return iter(fd)
+
+        def encode_lines():
+            while True:
+                line = fd.readline()
+                if not line:
+                    return
+                yield line.encode('utf-8') if isinstance(line, str) else line
+        return encode_lines()
+
+    def __parse_entries__(self, fd, year, offset=0):
+        """Parse entries from file
+
+        Generator parsing log entries from lines in fd. Continuation lines of
+        multiline entries are appended to the preceding entry before it is
+        returned, so only one entry is held in memory at a time.
 
-        raise LogFileError('Error opening logfile {}'.format(path))
+        Lines are passed to the lineloader as bytes, and only decoded when
+        entry fields are accessed.
+
+        When reading self.fd, the byte offsets where the last entry started
+        and where reading stopped are stored for incremental reloads.
+        """
+        entry = None
+        entry_offset = offset
+        lines = self.__read_lines__(fd)
+        while True:
+            try:
+                line = next(lines, None)
+            except (OSError, LogReaderError) as e:
+                raise LogFileError('Error reading file {}: {}'.format(self.path, e))
+            if line is None:
+                break
+
+            line_offset = offset
+            offset += len(line)
+
+            # Only lines starting with whitespace may be continuation or empty lines
+            if line[0] in LINE_WHITESPACE_BYTES:
+                # Multiline log entry
+                if line[0] in LINE_CONTINUATION_BYTES and entry is not None:
+                    entry.append(line.decode('utf-8', 'replace'))
+                    continue
+                if not line.strip():
+                    continue
+
+            if entry is not None:
+                yield entry
+            entry_offset = line_offset
+            entry = self.lineloader(
+                self,
+                line,
+                year=year,
+                source_formats=self.source_matcher
+            )
+
+        if fd is self.fd:
+            self.__parsed_offsets = (entry_offset, offset, entry is not None)
+        if entry is not None:
+            yield entry
 
     def __next__(self):
         """Next iterator
@@ -508,161 +1260,676 @@ class LogFile(list):
     def next_iterator_match(self, iterator, callback=None):
         """Return next matching line
 
-        Iterates lines from log with self.readline()
+        Return next entry from named iterator matching callback
         """
         if iterator not in self.iterators:
             raise LogFileError('Unknown iterator: {}'.format(iterator))
+        return self.iterators[iterator].next(callback)
 
-        if not self.__loaded:
-            if self.fd is not None:
-                if hasattr(self.path, 'readline'):
-                    self.fd = self.path
-                    self.mtime = datetime.now()
-                else:
-                    try:
-                        self.fd = self.__open_logfile__(self.path)
-                        self.mtime = datetime.fromtimestamp(os.stat(self.path).st_mtime)
-                    except OSError as e:
-                        raise LogFileError('Error opening {}: {}'.format(self.path, e))
-
-            while True:
-                if self.get_iterator(iterator) < len(self)-1:
-                    try:
-                        entry = self[self.get_iterator(iterator)]
-                    except IndexError:
-                        self.reset_iterator(iterator)
-                        raise StopIteration
-
-                else:
-                    entry = self.readline()
-
-                if entry is None:
-                    self.reset_iterator(iterator)
-                    raise StopIteration
+    def next_n(self, iterator, count, callback=None):
+        """Return next matching lines
 
-                self.update_iterator(iterator, len(self)-1)
-                if callback is not None:
-                    if callback(entry):
-                        return entry
-                else:
-                    return entry
+        Return list of up to count next entries from named iterator matching
+        callback. See LogFileCursor.next_n for details.
+        """
+        if iterator not in self.iterators:
+            raise LogFileError('Unknown iterator: {}'.format(iterator))
+        return self.iterators[iterator].next_n(count, callback)
 
-        else:
-            # Iterate cached entries
-            if self.iterators[iterator] is None:
-                self.update_iterator(iterator)
+    def __read_entry__(self):
+        """Read next entry
 
-            while True:
-                try:
-                    entry = self[self.get_iterator(iterator)]
-                    self.update_iterator(iterator)
+        Return next entry parsed from the file, opening the file if necessary,
+        or None when all entries have been read. In streaming mode the file is
+        closed at end, so the next call starts a new pass.
+        """
+        if self.__loaded:
+            return None
 
-                    if callback is not None:
-                        if callback(entry):
-                            return entry
-                    else:
-                        return entry
+        if self.fd is None:
+            self.fd, self.mtime = self.__open_source__()
+            self.__stat = self.__plain_file_stat__(self.fd)
 
-                except IndexError:
-                    self.reset_iterator(iterator)
-                    raise StopIteration
+        entry = self.readline()
+        if entry is None and self.streaming:
+            self.close()
+        return entry
 
     def readline(self):
         """Read line from log
 
-        Parse entry from logfile
+        Parse entry from logfile. Entries are appended to the list unless the
+        file is opened in streaming mode.
         """
 
         if self.fd is None:
             raise LogFileError('File is not loaded')
 
+        if self.__reader is None:
+            self.__reader = self.__parse_entries__(self.fd, self.mtime.year)
+
         try:
-            line = self.fd.readline()
-            if line == '':
-                self.__loaded = True
-                return None
+            entry = next(self.__reader)
+        except StopIteration:
+            self.__reader = None
+            self.__loaded = not self.streaming
+            self.__save_resume_state__()
+            return None
 
-            # Multiline log entry
-            if line[:1] in [' ', '\t'] and len(self):
-                self[-1].append(line)
-                return self.readline()
+        if not self.streaming:
+            self.append(entry)
+            if self.index is not None:
+                self.index.add(len(self) - 1, entry)
+        return entry
 
-            else:
-                entry = self.lineloader(
-                    self,
-                    line,
-                    year=self.mtime.year,
-                    source_formats=self.source_formats
-                )
-                self.append(entry)
-                return entry
+    def close(self):
+        """Close file
 
-        except OSError as e:
-            raise LogFileError('Error reading file {}: {}'.format(self.path, e))
+        Close the file descriptor opened for iteration. Cached entries are kept.
+        """
+        self.__reader = None
+        if self.fd is not None and self.fd is not self.path:
+            self.fd.close()
+        self.fd = None
 
-    def reload(self):
+    def __save_resume_state__(self):
+        """Save resume state
+
+        Store inode, device, offsets and last loaded bytes of a fully loaded
+        plain text file for incremental reloads
+        """
+        self.__resume_state = None
+        if self.streaming or self.__stat is None or self.__parsed_offsets is None:
+            return
+
+        entry_offset, end_offset, has_entries = self.__parsed_offsets
+        if not has_entries:
+            entry_offset = end_offset
+        check_offset = max(end_offset - RESUME_CHECK_BYTES, 0)
+        try:
+            check_data = os.pread(self.fd.fileno(), end_offset - check_offset, check_offset)
+        except OSError:
+            return
+        self.__resume_state = (
+            self.__stat.st_ino,
+            self.__stat.st_dev,
+            entry_offset,
+            end_offset,
+            len(self) - 1 if has_entries else len(self),
+            check_offset,
+            check_data,
+        )
+
+    def __resume__(self):
+        """Resume loading file
+
+        Parse data appended to a loaded plain text file. The last entry is
+        parsed again, because continuation lines may have been appended to it.
+        Returns False if the file must be reloaded from start, because it has
+        not been loaded, was rotated or truncated. Files truncated and written
+        again past the loaded size are detected by comparing the last loaded
+        bytes.
+        """
+        if self.__resume_state is None or not self.__loaded:
+            return False
+
+        inode, device, entry_offset, end_offset, count, check_offset, check_data = self.__resume_state
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+
+        if (st.st_ino, st.st_dev) != (inode, device) or st.st_size < end_offset:
+            return False
+
+        try:
+            fd = open(self.path, 'rb')
+            if os.pread(fd.fileno(), end_offset - check_offset, check_offset) != check_data:
+                fd.close()
+                return False
+            if st.st_size == end_offset:
+                fd.close()
+                return True
+            fd.seek(entry_offset)
+        except (OSError, LogReaderError) as e:
+            raise LogFileError('Error opening {}: {}'.format(self.path, e))
+
+        del self[count:len(self)]
+        if self.index is not None:
+            self.index.truncate(count)
+
+        self.close()
+        self.fd = fd
+        self.__stat = st
+        self.mtime = datetime.fromtimestamp(st.st_mtime)
+        self.__reader = self.__parse_entries__(fd, self.mtime.year, entry_offset)
+        self.__loaded = False
+        while self.readline() is not None:
+            pass
+        return True
+
+    def reload(self, incremental=False):
         """Reload file
 
-        Reload file, clearing existing entries
+        Reload file, clearing existing entries.
+
+        With incremental=True, a loaded plain text file is only parsed from
+        the last loaded entry on, unless it has been rotated or truncated.
         """
+        if incremental and not self.streaming and self.__resume__():
+            return
+
         del self[0:len(self)]
+        if self.index is not None:
+            self.index.clear()
+        self.close()
         self.__loaded = False
+        for name in self.iterators:
+            self.reset_iterator(name)
+
+        if self.streaming:
+            return
+
+        while self.__read_entry__() is not None:
+            pass
+
+    def __entries_from__(self, fd, offset, year, mtime):
+        """Entry offsets and times from offset
+
+        Generator returning tuples (offset, time) for entries starting at or
+        after byte offset in fd. Lines which can't be parsed are skipped.
+        Entry times later than the file modification time are from previous
+        year, like the December entries in a file written in January.
+        """
+        fd.seek(offset)
+        if offset > 0:
+            # Skip to start of next line
+            offset += len(fd.readline())
+
         while True:
+            line = fd.readline()
+            if not line:
+                return
+
+            line_offset = offset
+            offset += len(line)
+            if line[:1] in (b' ', b'\t') or not line.strip():
+                continue
+
             try:
-                return next(self)
-            except StopIteration:
-                break
+                time = self.lineloader(
+                    self,
+                    line.decode('utf-8', 'replace'),
+                    year=year,
+                    source_formats=self.source_matcher
+                ).time
+            except LogFileError:
+                continue
 
-    def filter_host(self, host):
-        """Filter by host name
+            if time > mtime + timedelta(days=1):
+                try:
+                    time = time.replace(year=time.year - 1)
+                except ValueError:
+                    pass
+            yield line_offset, time
+
+    def seek_time(self, timestamp):
+        """Seek to time
+
+        Position the file to first entry with time >= timestamp, so iterating
+        the file continues from that entry. Cached entries are cleared.
 
-        Return log entries matching given host name
+        Plain text files are searched by bisecting byte offsets, so only a few
+        blocks of the file are read. Compressed files are scanned from start.
+
+        Returns byte offset of the entry in the uncompressed file.
         """
+        if hasattr(self.path, 'readline'):
+            raise LogFileError('Seeking by time requires a file path')
+
+        fd, mtime = self.__open_source__()
+        year = mtime.year
+        try:
+            lo = 0
+            if isinstance(fd, io.BufferedReader):
+                hi = os.fstat(fd.fileno()).st_size
+                while hi - lo > SEEK_TIME_SCAN_BYTES:
+                    mid = (lo + hi) // 2
+                    found = next(self.__entries_from__(fd, mid, year, mtime), None)
+                    if found is None or found[1] >= timestamp:
+                        hi = mid
+                    else:
+                        lo = found[0] + 1
+
+            offset = None
+            for entry_offset, time in self.__entries_from__(fd, lo, year, mtime):
+                if time >= timestamp:
+                    offset = entry_offset
+                    break
+            if offset is None:
+                offset = fd.tell()
+            fd.seek(offset)
+
+        except OSError as e:
+            fd.close()
+            raise LogFileError('Error reading {}: {}'.format(self.path, e))
+
+        del self[0:len(self)]
+        if self.index is not None:
+            self.index.clear()
+        self.close()
+        for name in self.iterators:
+            self.reset_iterator(name)
+
+        self.fd = fd
+        self.mtime = mtime
+        self.__stat = self.__plain_file_stat__(fd)
+        self.__reader = self.__parse_entries__(fd, year, offset)
+        self.__loaded = False
+        return offset
+
+    def stream(self):
+        """Stream entries
+
+        Generator returning parsed entries from the file without caching them.
+        Does not affect the named iterators.
+        """
+        fd, mtime = self.__open_source__()
+        try:
+            for entry in self.__parse_entries__(fd, mtime.year):
+                yield entry
+        finally:
+            if fd is not self.path:
+                fd.close()
+
+    def __iter_entries__(self):
+        """Iterate entries for filters
+
+        Returns cached entries, loading the file if required, or a stream of
+        entries in streaming mode.
+        """
+        if self.streaming:
+            return self.stream()
+
         if len(self) == 0:
             self.reload()
-        return [x for x in self if x.host == host]
+        return list.__iter__(self)
 
-    def filter_program(self, program):
-        """Filter by program name
+    def __load_index__(self):
+        """Load index
 
-        Return log entries matching given program name
+        Returns the index with all entries loaded, or None if file is not indexed
         """
-        if len(self) == 0:
+        if self.index is None:
+            return None
+        if not self.__loaded:
             self.reload()
-        return [x for x in self if x.program == program]
+        return self.index
 
-    def filter_message(self, message_regexp):
+    def __query_entries__(self, start=None, end=None, host=None, program=None):
+        """Iterate entries for queries
+
+        Returns entries from blocks matching the query with sidecar index if
+        entries are not cached, or same entries as __iter_entries__
+        """
+        if not self.sidecar_index or hasattr(self.path, 'readline'):
+            return self.__iter_entries__()
+        if not self.streaming and (len(self) or self.__loaded):
+            return self.__iter_entries__()
+        return self.__sidecar_entries__(start, end, host, program)
+
+    def __sidecar_entries__(self, start=None, end=None, host=None, program=None, reverse=False):
+        """Iterate sidecar index blocks
+
+        Generator returning entries from blocks which may match the query.
+        With reverse, blocks are parsed from end of file and entries returned
+        last entry first.
+        """
+        try:
+            if self.__sidecar is None:
+                self.__sidecar = LogFileSidecarIndex(self, self.index_directory)
+            else:
+                self.__sidecar.refresh()
+        except Exception as e:
+            raise LogFileError('Error loading index for {}: {}'.format(self.path, e))
+
+        blocks = self.__sidecar.match(start, end, host, program)
+        if not blocks:
+            return
+
+        year = datetime.fromtimestamp(self.__sidecar.stat['mtime']).year
+        fd = self.__sidecar.open()
+        try:
+            if reverse:
+                for block in reversed(blocks):
+                    for entry in reversed(list(self.__parse_entries__(BlockReader(fd, block.offset, block.end), year))):
+                        yield entry
+                return
+            for block in blocks:
+                for entry in self.__parse_entries__(BlockReader(fd, block.offset, block.end), year):
+                    yield entry
+        finally:
+            fd.close()
+
+    def __reverse_entries__(self):
+        """Iterate entries backwards
+
+        Generator returning entries of an uncompressed file from last entry to
+        first, reading the file backwards in blocks with ReverseLineReader.
+        Continuation lines are appended to their entry like when parsing the
+        file from start.
+        """
+        try:
+            fd = open(self.path, 'rb')
+            year = datetime.fromtimestamp(os.fstat(fd.fileno()).st_mtime).year
+        except (IOError, OSError) as e:
+            raise LogFileError('Error opening {}: {}'.format(self.path, e))
+
+        try:
+            continuation = []
+            for line in ReverseLineReader(fd):
+                if line[0] in LINE_WHITESPACE_BYTES:
+                    if line[0] in LINE_CONTINUATION_BYTES:
+                        continuation.append(line)
+                        continue
+                    if not line.strip():
+                        continue
+
+                entry = self.lineloader(
+                    self,
+                    line,
+                    year=year,
+                    source_formats=self.source_matcher
+                )
+                for line in reversed(continuation):
+                    entry.append(line.decode('utf-8', 'replace'))
+                continuation = []
+                yield entry
+        except LogReaderError as e:
+            raise LogFileError('Error reading file {}: {}'.format(self.path, e))
+        finally:
+            fd.close()
+
+    def __is_plain_file__(self):
+        """Check if file is uncompressed
+
+        Returns True if path is an uncompressed file, which can be read backwards
+        """
+        if not isinstance(self.path, str):
+            return False
+        try:
+            with open(self.path, 'rb') as fd:
+                return detect_compression(fd, self.path) is None
+        except (IOError, OSError):
+            return False
+
+    def __scan_entries__(self, reverse=False, limited=False, start=None, end=None, host=None, program=None):
+        """Iterate entries for limited queries
+
+        Returns tuple (entries, reversed) with entries like __query_entries__.
+
+        With reverse, entries are returned last entry first if reversed is
+        True: cached entries are iterated backwards, and uncompressed files and
+        their sidecar index blocks are read backwards. Compressed files are
+        returned in file order.
+
+        With limited, files which are not loaded are streamed instead of
+        loading all entries, so callers can stop reading early.
+        """
+        cached = not self.streaming and (len(self) > 0 or self.__loaded)
+        sidecar = self.sidecar_index and not cached and not hasattr(self.path, 'readline')
+        if reverse:
+            if cached:
+                return list.__reversed__(self), True
+            plain = self.__is_plain_file__()
+            if sidecar:
+                # Seeking backwards in compressed files restarts decompression,
+                # so their blocks are read in file order
+                return self.__sidecar_entries__(start, end, host, program, reverse=plain), plain
+            if plain:
+                return self.__reverse_entries__(), True
+            return self.stream(), False
+
+        if sidecar and (start, end, host, program) != (None, None, None, None):
+            return self.__query_entries__(start, end, host, program), False
+        if limited and not cached:
+            return self.stream(), False
+        return self.__iter_entries__(), False
+
+    def __select__(self, match, limit=None, sample=None, from_end=False, **query):
+        """Select entries
+
+        Returns list of non-None results of match(entry) in file order.
+
+        With sample, only about given fraction of entries are matched, and
+        with limit at most limit results are returned, stopping the scan as
+        soon as limit is reached. With from_end the last matches are returned
+        instead of first ones, scanning from end of file when possible.
+        """
+        if sample is not None and not 0 < sample <= 1:
+            raise LogFileError('Invalid sample rate: {}'.format(sample))
+        if limit is not None and limit <= 0:
+            return []
+
+        entries, reverse = self.__scan_entries__(from_end, limit is not None, **query)
+        if from_end and not reverse:
+            # Keep last matches while scanning forward
+            results = collections.deque(maxlen=limit)
+            limit = None
+        else:
+            results = []
+
+        try:
+            for entry in entries:
+                if sample is not None and random.random() >= sample:
+                    continue
+                result = match(entry)
+                if result is None:
+                    continue
+                results.append(result)
+                if limit is not None and len(results) >= limit:
+                    break
+        finally:
+            if hasattr(entries, 'close'):
+                entries.close()
+
+        results = list(results)
+        if reverse:
+            results.reverse()
+        return results
+
+    def __select_offsets__(self, offsets, limit=None, sample=None, from_end=False):
+        """Select indexed entries
+
+        Returns entries for list offsets from index, with limit, sample and
+        from_end like __select__
+        """
+        if sample is not None:
+            if not 0 < sample <= 1:
+                raise LogFileError('Invalid sample rate: {}'.format(sample))
+            offsets = [offset for offset in offsets if random.random() < sample]
+        if limit is not None:
+            limit = max(limit, 0)
+            offsets = offsets[max(len(offsets) - limit, 0):] if from_end else offsets[:limit]
+        return [self[offset] for offset in offsets]
+
+    def filter_host(self, host, limit=None, sample=None, from_end=False):
+        """Filter by host name
+
+        Return log entries matching given host name. See __select__ for
+        limit, sample and from_end.
+        """
+        index = self.__load_index__()
+        if index is not None:
+            return self.__select_offsets__(index.hosts.get(host, ()), limit, sample, from_end)
+        return self.__select__(
+            lambda x: x if x.host == host else None,
+            limit, sample, from_end, host=host
+        )
+
+    def filter_program(self, program, limit=None, sample=None, from_end=False):
+        """Filter by program name
+
+        Return log entries matching given program name. See __select__ for
+        limit, sample and from_end.
+        """
+        index = self.__load_index__()
+        if index is not None:
+            return self.__select_offsets__(index.programs.get(program, ()), limit, sample, from_end)
+        return self.__select__(
+            lambda x: x if x.program == program else None,
+            limit, sample, from_end, program=program
+        )
+
+    def between(self, start=None, end=None, limit=None, sample=None, from_end=False):
+        """Filter by time range
+
+        Return log entries with start <= time < end in file order. Start or
+        end can be None for open ended range. Uses binary search over the
+        time column with index. See __select__ for limit, sample and from_end.
+        """
+        index = self.__load_index__()
+        if index is not None:
+            return self.__select_offsets__(index.between(start, end), limit, sample, from_end)
+        return self.__select__(
+            lambda x: x if (start is None or x.time >= start) and (end is None or x.time < end) else None,
+            limit, sample, from_end, start=start, end=end
+        )
+
+    def filter_message(self, message_regexp, limit=None, sample=None, from_end=False):
         """Filter by message regexp
 
         Filter log entries matching given regexp in message field
         """
-        if len(self) == 0:
-            self.reload()
-
         if isinstance(message_regexp, str):
             message_regexp = re.compile(message_regexp)
 
-        return [x for x in self if message_regexp.match(x.message)]
+        return self.__select__(
+            lambda x: x if message_regexp.match(x.message) else None,
+            limit, sample, from_end
+        )
 
-    def match_message(self, message_regexp):
+    def match_message(self, message_regexp, limit=None, sample=None, from_end=False):
         """
 
         Return dictionary of matching regexp keys for lines matching given regexp
          in message field
         """
-        if len(self) == 0:
-            self.reload()
-
         if isinstance(message_regexp, str):
             message_regexp = re.compile(message_regexp)
 
-        matches = []
-        for x in self:
+        def match(x):
             m = message_regexp.match(x.message)
-            if not m:
-                continue
-            matches.append(m.groupdict())
-        return matches
+            return m.groupdict() if m else None
+        return self.__select__(match, limit, sample, from_end)
+
+    def match_rules(self, rules, limit=None, sample=None, from_end=False):
+        """Match messages with multiple rules
+
+        Match messages against a dictionary of named regexps, or a
+        MessageMatcher, in a single pass. Returns list of tuples (entry, matches)
+        for entries matching any rule, where matches is a dictionary of rule
+        name to regexp groupdict.
+        """
+        if not isinstance(rules, MessageMatcher):
+            rules = MessageMatcher(rules)
+
+        def match(x):
+            result = rules.match(x.message)
+            return (x, result) if result else None
+        return self.__select__(match, limit, sample, from_end)
+
+    def filter_fields(self, fields=None, limit=None, sample=None, from_end=False, **values):
+        """Filter by message fields
+
+        Filter entries with message_fields matching all field values given
+        as fields dictionary or keyword arguments. Fields named like the
+        limit, sample and from_end arguments must be given in fields.
+        """
+        items = list((fields or {}).items()) + list(values.items())
+
+        def match(x):
+            message_fields = x.message_fields
+            if message_fields and all(message_fields.get(key) == value for key, value in items):
+                return x
+            return None
+        return self.__select__(match, limit, sample, from_end)
+
+    def aggregate(self, interval=DEFAULT_INTERVAL, group_by=DEFAULT_GROUP_BY, top=DEFAULT_TOP,
+                  capacity=DEFAULT_CAPACITY, callback=None, max_buckets=None):
+        """Aggregate entries
+
+        Count entries matching callback by time buckets of interval seconds
+        and by entry fields in group_by in one pass. Returns LogAggregation,
+        see systematic.logaggregate for details.
+        """
+        aggregation = LogAggregation(interval, group_by, top, capacity, callback, max_buckets)
+        return aggregation.update(self.__iter_entries__())
+
+    def write_json(self, fd, verbose=False):
+        """Write entries as JSON lines
+
+        Write all entries to file object fd as JSON lines without collecting
+        them to a list in streaming mode. See write_json_lines for details.
+        """
+        return write_json_lines(self.__iter_entries__(), fd, verbose)
+
+
+def write_json_lines(entries, fd, verbose=False, buffer_size=JSON_LINES_BUFFER_SIZE):
+    """Write entries as JSON lines
+
+    Write entries from iterable to file object fd opened in text or binary
+    mode, one JSON object per line. Lines are joined to chunks of about
+    buffer_size characters before writing. Lines which can't be parsed are
+    written as objects with only the line in field 'line'.
+
+    Returns number of written entries.
+    """
+    binary = not isinstance(fd, io.TextIOBase)
+    encode = JSON_LINES_ENCODER.encode
+    chunk = []
+    size = 0
+    count = 0
+    for entry in entries:
+        try:
+            line = encode(entry.as_dict(verbose))
+        except LogFileError:
+            line = encode({'line': entry.line})
+        chunk.append(line)
+        size += len(line) + 1
+        count += 1
+        if size >= buffer_size:
+            chunk.append('')
+            data = '\n'.join(chunk)
+            fd.write(data.encode('utf-8') if binary else data)
+            chunk = []
+            size = 0
+
+    if chunk:
+        chunk.append('')
+        data = '\n'.join(chunk)
+        fd.write(data.encode('utf-8') if binary else data)
+    return count
+
+
+def logfile_worker(loader, path, source_formats, method, args, options=None):
+    """Process logfile in worker
+
+    Process pool worker for LogFileCollection: runs LogFile method in
+    streaming mode and returns the result. Entries are decoded in the worker.
+    """
+    logfile = loader(path, source_formats=source_formats, streaming=True, **(options or {}))
+    if method == 'stream':
+        return [entry.decode() for entry in logfile.stream()]
+
+    result = getattr(logfile, method)(*args)
+    if method == 'aggregate':
+        return result
+    if method == 'match_rules':
+        result = [(entry.decode(), matches) for entry, matches in result]
+    elif method != 'match_message':
+        result = [entry.decode() for entry in result]
+    return result
 
 
 class LogFileCollection(object):
@@ -672,13 +1939,33 @@ class LogFileCollection(object):
 
         lc = LogFileCollection(glob.glob('/var/log/auth.log*'))
 
-    Files are sorted by modification timestamp and name.
+    Files are sorted by modification timestamp and name. Iterating the
+    collection returns entries file by file; use merged() to iterate entries
+    from all files ordered by time.
+
+    With streaming=True the log files are opened in streaming mode and
+    entries are not cached while iterating or filtering the collection.
+
+    With index=True or sidecar_index=True the log files are indexed as
+    described in LogFile. With sidecar indexes, files which can't contain
+    matches for a time, host or program query are skipped without reading.
+
+    With workers > 1 filters and stream() parse the files concurrently in
+    a pool of worker processes. Filtering runs in the workers, so only the
+    matching entries are returned to the caller. Entries parsed in workers
+    are not cached to the LogFile objects.
     """
 
     loader = LogFile
 
-    def __init__(self, logfiles, source_formats=SOURCE_FORMATS):
+    def __init__(self, logfiles, source_formats=SOURCE_FORMATS, streaming=False, workers=None, index=False,
+                 sidecar_index=False, index_directory=None):
         self.source_formats = source_formats
+        self.streaming = streaming
+        self.index = index
+        self.sidecar_index = sidecar_index
+        self.index_directory = index_directory
+        self.workers = workers
         self.logfiles = []
         self.__iter_index = None
         self.__iter_entry = None
@@ -703,7 +1990,15 @@ class LogFileCollection(object):
 
         for ts in sorted(stats.keys()):
             self.logfiles.extend(
-                self.loader(path, source_formats=self.source_formats) for path in stats[ts]
+                self.loader(
+                    path,
+                    source_formats=self.source_formats,
+                    streaming=self.streaming,
+                    index=self.index,
+                    sidecar_index=self.sidecar_index,
+                    index_directory=self.index_directory
+                )
+                for path in stats[ts]
             )
 
     def __repr__(self):
@@ -712,6 +2007,9 @@ class LogFileCollection(object):
     def __iter__(self):
         return self
 
+    def __next__(self):
+        return self.next()
+
     def next(self):
         if not self.logfiles:
             raise StopIteration
@@ -720,47 +2018,134 @@ class LogFileCollection(object):
             self.__iter_index = 0
             self.__iter_entry = self.logfiles[0]
 
-        try:
-            logentry = next(self.__iter_entry)
+        while True:
+            try:
+                return next(self.__iter_entry)
 
-        except StopIteration:
-            if self.__iter_index < len(self.logfiles) - 1:
-                self.__iter_index += 1
-                self.__iter_entry = self.logfiles[self.__iter_index]
+            except StopIteration:
+                if self.__iter_index < len(self.logfiles) - 1:
+                    self.__iter_index += 1
+                    self.__iter_entry = self.logfiles[self.__iter_index]
 
-                try:
-                    logentry = next(self.__iter_entry)
-                except StopIteration:
+                else:
                     self.__iter_index = None
                     self.__iter_entry = None
                     raise StopIteration
 
-            else:
-                self.__iter_index = None
-                self.__iter_entry = None
-                raise StopIteration
+    @property
+    def parallel(self):
+        return self.workers is not None and self.workers > 1 and len(self.logfiles) > 1
+
+    def __map_logfiles__(self, method, *args):
+        """Run method for logfiles
 
-        return logentry
+        Generator returning tuples (logfile, result) for given LogFile method
+        in logfile order. With workers, files are processed concurrently in a
+        process pool and at most two results per worker are kept waiting.
+        """
+        if not self.parallel:
+            for logfile in self.logfiles:
+                yield logfile, getattr(logfile, method)(*args)
+            return
+
+        def worker_result(logfile, future):
+            result = future.result()
+            if method == 'aggregate':
+                return logfile, result
+            if method == 'match_rules':
+                for entry, matches in result:
+                    entry.logfile = logfile
+            elif method != 'match_message':
+                for entry in result:
+                    entry.logfile = logfile
+            return logfile, result
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            pending = collections.deque()
+            for logfile in self.logfiles:
+                pending.append((logfile, executor.submit(
+                    logfile_worker, logfile.__class__, logfile.path, self.source_formats, method, args, {
+                        'sidecar_index': self.sidecar_index,
+                        'index_directory': self.index_directory,
+                    }
+                )))
+                if len(pending) >= self.workers * 2:
+                    yield worker_result(*pending.popleft())
+
+            while pending:
+                yield worker_result(*pending.popleft())
+
+    def __collect__(self, method, *args):
+        matches = []
+        for logfile, result in self.__map_logfiles__(method, *args):
+            matches.extend(result)
+        return matches
+
+    def stream(self):
+        """Stream entries
+
+        Generator returning entries from all logfiles in order without caching.
+        With workers, each file is parsed in a worker process and returned
+        as a whole.
+        """
+        if self.parallel:
+            for logfile, entries in self.__map_logfiles__('stream'):
+                for entry in entries:
+                    yield entry
+            return
+
+        for logfile in self.logfiles:
+            for entry in logfile.stream():
+                yield entry
+
+    def __timed_entries__(self, index, logfile):
+        """Entries with sort keys
+
+        Generator returning tuples (time, index, sequence, entry) for entries
+        in logfile. Entries with unparseable time get time of previous entry,
+        so they stay in file order.
+        """
+        time = datetime.min
+        for sequence, entry in enumerate(logfile.stream()):
+            try:
+                time = entry.time
+            except LogFileError:
+                pass
+            yield time, index, sequence, entry
+
+    def merged(self):
+        """Merge entries by time
+
+        Generator returning entries from all logfiles ordered by entry time,
+        for example to correlate syslog files collected from many hosts.
+        The files are streamed concurrently and merged with a heap, so only
+        one parsed entry per file is kept in memory. Entries with same time
+        are returned in logfile order.
+        """
+        streams = [self.__timed_entries__(index, logfile) for index, logfile in enumerate(self.logfiles)]
+        for time, index, sequence, entry in heapq.merge(*streams):
+            yield entry
 
     def filter_host(self, host):
         """Filter by host
 
         Filter all loaded logfiles by matching host with LogFile.filter_host
         """
-        matches = []
-        for parser in self.logfiles:
-            matches.extend(parser.filter_host(host))
-        return matches
+        return self.__collect__('filter_host', host)
 
     def filter_program(self, program):
         """Filter by program
 
         Filter all loaded logfiles by matching program with LogFile.filter_program
         """
-        matches = []
-        for parser in self.logfiles:
-            matches.extend(parser.filter_program(program))
-        return matches
+        return self.__collect__('filter_program', program)
+
+    def between(self, start=None, end=None):
+        """Filter by time range
+
+        Filter all loaded logfiles by time range with LogFile.between
+        """
+        return self.__collect__('between', start, end)
 
     def filter_message(self, message_regexp):
         """Filter messages by regexp
@@ -770,10 +2155,7 @@ class LogFileCollection(object):
         if isinstance(message_regexp, str):
             message_regexp = re.compile(message_regexp)
 
-        matches = []
-        for parser in self.logfiles:
-            matches.extend(parser.filter_message(message_regexp))
-        return matches
+        return self.__collect__('filter_message', message_regexp)
 
     def match_message(self, message_regexp):
         """Match messages by regexp
@@ -783,10 +2165,65 @@ class LogFileCollection(object):
         if isinstance(message_regexp, str):
             message_regexp = re.compile(message_regexp)
 
-        matches = []
-        for parser in self.logfiles:
-            matches.extend(parser.match_message(message_regexp))
-        return matches
+        return self.__collect__('match_message', message_regexp)
+
+    def match_rules(self, rules):
+        """Match messages with multiple rules
+
+        Match all loaded logfiles with LogFile.match_rules
+        """
+        if not isinstance(rules, MessageMatcher):
+            rules = MessageMatcher(rules)
+
+        return self.__collect__('match_rules', rules)
+
+    def filter_fields(self, fields=None, **values):
+        """Filter by message fields
+
+        Filter all loaded logfiles with LogFile.filter_fields
+        """
+        fields = dict(fields or {})
+        fields.update(values)
+        return self.__collect__('filter_fields', fields)
+
+    def aggregate(self, interval=DEFAULT_INTERVAL, group_by=DEFAULT_GROUP_BY, top=DEFAULT_TOP,
+                  capacity=DEFAULT_CAPACITY, callback=None, max_buckets=None):
+        """Aggregate entries
+
+        Aggregate entries from all logfiles with LogFile.aggregate. With
+        workers, each file is aggregated in a worker process and the results
+        are merged, and callback must be a function which can be pickled.
+        """
+        if not self.parallel:
+            aggregation = LogAggregation(interval, group_by, top, capacity, callback, max_buckets)
+            for logfile in self.logfiles:
+                aggregation.update(logfile.__iter_entries__())
+            return aggregation
+
+        aggregation = None
+        args = (interval, group_by, top, capacity, callback, max_buckets)
+        for logfile, result in self.__map_logfiles__('aggregate', *args):
+            if aggregation is None:
+                aggregation = result
+                aggregation.callback = callback
+            else:
+                aggregation.merge(result)
+        return aggregation
+
+    def write_json(self, fd, verbose=False, merged=False):
+        """Write entries as JSON lines
+
+        Write entries from all logfiles to file object fd as JSON lines, file
+        by file or with merged=True ordered by time like merged(). See
+        write_json_lines for details.
+        """
+        if merged:
+            entries = self.merged()
+        elif self.parallel:
+            entries = self.stream()
+        else:
+            entries = itertools.chain.from_iterable(logfile.__iter_entries__() for logfile in self.logfiles)
+        return write_json_lines(entries, fd, verbose)
 
 
 class LogfileTailReader(TailReader):
@@ -804,14 +2241,47 @@ class LogfileTailReader(TailReader):
 
     """
     lineparser = LogEntry
+    extractors = DEFAULT_MESSAGE_EXTRACTORS
 
-    def __init__(self, path=None, fd=None, source_formats=SOURCE_FORMATS):
-        super(LogfileTailReader, self).__init__(path, fd)
+    def __init__(self, path=None, fd=None, source_formats=SOURCE_FORMATS, backend=None, checkpoints=None):
+        super(LogfileTailReader, self).__init__(path, fd, backend, checkpoints)
         self.source_formats = source_formats
+        self.source_matcher = SourceMatcher.get(source_formats)
 
     def __format_line__(self, line):
         """Format line
 
         Formats line as log entry. Returns None if entry is not supported
         """
-        return self.lineparser(self, line, self.year, source_formats=self.source_formats)
+        return self.lineparser(self, line, self.year, source_formats=self.source_matcher).decode()
+
+
+class LogfileMultiTailReader(MultiTailReader):
+    """Multiple logfile tail reader
+
+    MultiTailReader returning tuples (path, entry) with entries parsed by
+    LogfileTailReader
+
+    from systematic.log import LogfileMultiTailReader
+    r = LogfileMultiTailReader(glob.glob('/var/log/*.log'))
+    r.seek_to_end()
+    for path, entry in r:
+        print(path, entry.program, entry.message)
+
+    """
+    reader = LogfileTailReader
+
+
+class AsyncLogfileTailReader(AsyncTailReader):
+    """Asyncio logfile tail reader
+
+    AsyncTailReader returning entries parsed by LogfileTailReader
+
+    from systematic.log import AsyncLogfileTailReader
+    r = AsyncLogfileTailReader('/var/log/messages')
+    r.seek_to_end()
+    async for entry in r:
+        print(entry.program, entry.message)
+
+    """
+    reader = LogfileTailReader
@@ -0,0 +1,408 @@
+"""
+Aggregation of syslog entries
+
+Group and count log entries by time bucket and entry fields like host and
+program in one streaming pass. Counts are kept with the space-saving
+algorithm, which is exact while the number of distinct keys fits the counter
+capacity and returns approximate top keys after that, so memory used per time
+bucket is bounded. The number of time buckets grows with the time span of the
+entries, unless limited with max_buckets.
+
+Example usage:
+
+from systematic.log import LogFile
+stats = LogFile('/var/log/messages', streaming=True).aggregate(interval=60, group_by=('program', ))
+print(stats.to_json())
+
+"""
+
+import heapq
+import json
+import zlib
+
+from datetime import datetime, timedelta
+
+DEFAULT_INTERVAL = 60
+DEFAULT_GROUP_BY = ('program', )
+DEFAULT_TOP = 10
+
+# Maximum number of keys counted in each counter
+DEFAULT_CAPACITY = 1000
+
+# Count-min sketch size
+DEFAULT_SKETCH_WIDTH = 2048
+DEFAULT_SKETCH_DEPTH = 4
+
+AGGREGATION_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+EPOCH = datetime(1970, 1, 1)
+
+
+class LogAggregationError(Exception):
+    pass
+
+
+def key_bytes(key):
+    """Encode key
+
+    Encode counter key tuple to bytes for hashing
+    """
+    return '\x00'.join('{}'.format(value) for value in key).encode('utf-8')
+
+
+class CountMinSketch(object):
+    """Count-min sketch
+
+    Fixed size frequency table for estimating counts of any key. Estimates
+    are never lower than the real count.
+    """
+    def __init__(self, width=DEFAULT_SKETCH_WIDTH, depth=DEFAULT_SKETCH_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.tables = [[0] * width for row in range(depth)]
+
+    def __repr__(self):
+        return 'count-min sketch {:d}x{:d}'.format(self.depth, self.width)
+
+    def __positions__(self, key):
+        value = key_bytes(key)
+        first = zlib.crc32(value)
+        second = zlib.adler32(value) | 1
+        return [(first + i * second) % self.width for i in range(self.depth)]
+
+    def add(self, key, count=1):
+        for table, position in zip(self.tables, self.__positions__(key)):
+            table[position] += count
+
+    def estimate(self, key):
+        return min(table[position] for table, position in zip(self.tables, self.__positions__(key)))
+
+    def merge(self, other):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise LogAggregationError('Can not merge count-min sketches of different size')
+        for table, other_table in zip(self.tables, other.tables):
+            for position, count in enumerate(other_table):
+                table[position] += count
+
+
+class SpaceSavingCounter(object):
+    """Space-saving counter
+
+    Counts at most capacity keys. When the counter is full, a new key replaces
+    the key with lowest count and inherits its count as error, so counts of
+    keys are upper bounds and count - error lower bounds. Counts are exact
+    while the number of distinct keys is not more than capacity.
+    """
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.total = 0
+        self.counts = {}
+        self.errors = {}
+        self.__heap = []
+        self.__sequence = 0
+
+    def __repr__(self):
+        return 'space-saving counter {:d}/{:d} keys'.format(len(self.counts), self.capacity)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __push__(self, key):
+        """Push key to heap
+
+        Sequence number orders keys with same count, so keys are not compared
+        """
+        self.__sequence += 1
+        heapq.heappush(self.__heap, (self.counts[key], self.__sequence, key))
+
+    def __evict__(self):
+        """Remove key with lowest count
+
+        Heap entries are updated lazily: entries with outdated count are
+        pushed back with current count. Returns count of removed key.
+        """
+        while True:
+            count, sequence, key = heapq.heappop(self.__heap)
+            if self.counts[key] == count:
+                del self.counts[key]
+                self.errors.pop(key, None)
+                return count
+            self.__push__(key)
+
+    def add(self, key, count=1):
+        self.total += count
+        if key in self.counts:
+            self.counts[key] += count
+            return
+
+        error = 0
+        if len(self.counts) >= self.capacity:
+            error = self.__evict__()
+        self.counts[key] = error + count
+        if error:
+            self.errors[key] = error
+        self.__push__(key)
+
+    def count(self, key):
+        return self.counts.get(key, 0)
+
+    def error(self, key):
+        return self.errors.get(key, 0)
+
+    def top(self, count=None):
+        """Return top keys
+
+        Returns list of (key, count, error) tuples ordered by count
+        """
+        keys = sorted(self.counts.items(), key=lambda item: -item[1])
+        if count is not None:
+            keys = keys[:count]
+        return [(key, value, self.errors.get(key, 0)) for key, value in keys]
+
+    def merge(self, other):
+        """Merge counter
+
+        Add counts from other counter, keeping the keys with highest counts
+        """
+        counts = dict(self.counts)
+        errors = dict(self.errors)
+        for key, value in other.counts.items():
+            counts[key] = counts.get(key, 0) + value
+            if key in other.errors:
+                errors[key] = errors.get(key, 0) + other.errors[key]
+
+        total = self.total + other.total
+        keys = sorted(counts.items(), key=lambda item: -item[1])[:self.capacity]
+        self.counts = {}
+        self.errors = {}
+        self.__heap = []
+        for key, value in keys:
+            self.counts[key] = value
+            if errors.get(key):
+                self.errors[key] = errors[key]
+            self.__push__(key)
+        self.total = total
+
+
+class LogAggregation(object):
+    """Aggregated log entries
+
+    Counts entries by time bucket of interval seconds and by values of
+    entry attributes in group_by, like host and program. Only entries
+    matching callback are counted, if given.
+
+    Each time bucket has a SpaceSavingCounter of group keys limited to
+    capacity keys, and overall counts are kept in a SpaceSavingCounter and
+    a CountMinSketch for estimating counts of any key with estimate().
+    Entries with unparseable time, and entries for which callback raises an
+    exception, are counted as skipped.
+
+    With max_buckets only the latest max_buckets time buckets are kept.
+    Entries in dropped buckets are counted in dropped, and remain in the
+    overall counts.
+    """
+    def __init__(self, interval=DEFAULT_INTERVAL, group_by=DEFAULT_GROUP_BY, top=DEFAULT_TOP,
+                 capacity=DEFAULT_CAPACITY, callback=None, max_buckets=None):
+        if interval <= 0:
+            raise LogAggregationError('Invalid interval: {}'.format(interval))
+        if isinstance(group_by, str):
+            group_by = (group_by, )
+
+        self.interval = interval
+        self.group_by = tuple(group_by)
+        self.top = top
+        self.capacity = capacity
+        self.callback = callback
+        self.max_buckets = max_buckets
+
+        self.entries = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.first_time = None
+        self.last_time = None
+        self.buckets = {}
+        self.keys = SpaceSavingCounter(capacity)
+        self.sketch = CountMinSketch()
+        self.__sketch_pending = {}
+
+        self.__bucket_start = None
+        self.__bucket_end = None
+        self.__bucket = None
+
+    def __repr__(self):
+        return 'aggregation of {:d} entries by {}'.format(self.entries, ', '.join(self.group_by))
+
+    def __getstate__(self):
+        """Pickle state
+
+        Callback and current bucket are not pickled
+        """
+        self.__flush_sketch__()
+        state = dict(self.__dict__)
+        state['callback'] = None
+        state['_LogAggregation__bucket_start'] = None
+        state['_LogAggregation__bucket_end'] = None
+        state['_LogAggregation__bucket'] = None
+        return state
+
+    def __flush_sketch__(self):
+        """Update sketch
+
+        Counts are added to the sketch in batches, so each distinct key is
+        hashed once per batch instead of once per entry
+        """
+        for key, count in self.__sketch_pending.items():
+            self.sketch.add(key, count)
+        self.__sketch_pending.clear()
+
+    def __bucket_counter__(self, time):
+        """Return counter for time bucket
+
+        """
+        if self.__bucket is not None and self.__bucket_start <= time < self.__bucket_end:
+            return self.__bucket
+
+        seconds = int((time - EPOCH).total_seconds())
+        start = EPOCH + timedelta(seconds=seconds - seconds % self.interval)
+        counter = self.buckets.get(start)
+        if counter is None:
+            counter = self.buckets[start] = SpaceSavingCounter(self.capacity)
+            self.__drop_buckets__()
+        self.__bucket_start = start
+        self.__bucket_end = start + timedelta(seconds=self.interval)
+        self.__bucket = counter
+        return self.__bucket
+
+    def __drop_buckets__(self):
+        """Drop old buckets
+
+        Remove oldest buckets when there are more than max_buckets buckets
+        """
+        if self.max_buckets is None:
+            return
+        while len(self.buckets) > self.max_buckets:
+            counter = self.buckets.pop(min(self.buckets))
+            self.dropped += counter.total
+            if counter is self.__bucket:
+                self.__bucket = None
+
+    def add(self, entry):
+        """Add entry
+
+        Count entry if it matches callback. Callback is called for the
+        decoded entry.
+        """
+        try:
+            # Decode time and source fields splitting the line once
+            time = entry.decode().time
+            if self.callback is not None and not self.callback(entry):
+                return
+        except Exception:
+            self.skipped += 1
+            return
+
+        key = tuple(getattr(entry, field, None) for field in self.group_by)
+        self.__bucket_counter__(time).add(key)
+        self.keys.add(key)
+        pending = self.__sketch_pending
+        pending[key] = pending.get(key, 0) + 1
+        if len(pending) >= self.capacity:
+            self.__flush_sketch__()
+
+        self.entries += 1
+        if self.first_time is None or time < self.first_time:
+            self.first_time = time
+        if self.last_time is None or time > self.last_time:
+            self.last_time = time
+
+    def update(self, entries):
+        """Add entries
+
+        Count entries from iterable in one pass. Returns self.
+        """
+        for entry in entries:
+            self.add(entry)
+        return self
+
+    def merge(self, other):
+        """Merge aggregation
+
+        Add counts from another aggregation with same interval and grouping
+        """
+        if (other.interval, other.group_by) != (self.interval, self.group_by):
+            raise LogAggregationError('Can not merge aggregations with different interval or grouping')
+
+        for start, counter in other.buckets.items():
+            if start in self.buckets:
+                self.buckets[start].merge(counter)
+            else:
+                self.buckets[start] = counter
+        self.keys.merge(other.keys)
+        self.__flush_sketch__()
+        other.__flush_sketch__()
+        self.sketch.merge(other.sketch)
+
+        self.entries += other.entries
+        self.skipped += other.skipped
+        self.dropped += other.dropped
+        for time in (other.first_time, other.last_time):
+            if time is None:
+                continue
+            if self.first_time is None or time < self.first_time:
+                self.first_time = time
+            if self.last_time is None or time > self.last_time:
+                self.last_time = time
+
+        self.__bucket = None
+        self.__drop_buckets__()
+        return self
+
+    def estimate(self, **fields):
+        """Estimate count
+
+        Return estimated count of entries with given group_by field values
+        """
+        self.__flush_sketch__()
+        return self.sketch.estimate(tuple(fields.get(field, None) for field in self.group_by))
+
+    def __format_keys__(self, counter, count=None):
+        return [
+            {
+                'key': dict(zip(self.group_by, key)),
+                'count': value,
+                'error': error,
+            }
+            for key, value, error in counter.top(count)
+        ]
+
+    def as_dict(self, verbose=False):
+        """Return data as dict
+
+        With verbose all counted keys are returned for each bucket, instead of
+        top keys
+        """
+        top = None if verbose else self.top
+        return {
+            'interval': self.interval,
+            'group_by': list(self.group_by),
+            'entries': self.entries,
+            'skipped': self.skipped,
+            'dropped': self.dropped,
+            'first_time': self.first_time.strftime(AGGREGATION_TIME_FORMAT) if self.first_time else None,
+            'last_time': self.last_time.strftime(AGGREGATION_TIME_FORMAT) if self.last_time else None,
+            'top': self.__format_keys__(self.keys, self.top),
+            'buckets': [
+                {
+                    'start': start.strftime(AGGREGATION_TIME_FORMAT),
+                    'count': counter.total,
+                    'rate': float(counter.total) / self.interval,
+                    'keys': self.__format_keys__(counter, top),
+                }
+                for start, counter in sorted(self.buckets.items())
+            ],
+        }
+
+    def to_json(self, verbose=False):
+        """Return data as JSON
+
+        """
+        return json.dumps(self.as_dict(verbose=verbose), indent=2)
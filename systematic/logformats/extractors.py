@@ -0,0 +1,232 @@
+"""
+Message field extractors for syslog entries
+
+Extractors parse fields from messages of known programs to LogEntry
+message_fields. Extractors are registered by program name patterns to a
+MessageFieldExtractors registry, and run when message_fields of an entry
+is first accessed. Each extractor counts its calls, matches and time spent.
+
+Example usage:
+
+from systematic.log import LogFile
+logfile = LogFile('/var/log/auth.log')
+for entry in logfile.filter_fields(event='failed'):
+    print(entry.message_fields['address'])
+print(logfile.extractors.to_json())
+
+"""
+
+import fnmatch
+import json
+import re
+import time
+
+# Optional kernel timestamp prefix like '[ 12.345678] '
+KERNEL_TIMESTAMP = r'(?:\[\s*[\d.]+\]\s+)?'
+
+
+class MessageFieldExtractorError(Exception):
+    pass
+
+
+class MessageFieldExtractor(object):
+    """Message field extractor
+
+    Extracts fields from messages of programs matching program name patterns
+    with a list of (event, regexp) tuples. The groupdict of first matching
+    regexp is returned, with the event name in field 'event'.
+    """
+    def __init__(self, name, programs, patterns):
+        self.name = name
+        self.programs = tuple(programs)
+        self.patterns = []
+        for event, regexp in patterns:
+            try:
+                if isinstance(regexp, str):
+                    regexp = re.compile(regexp)
+            except re.error as e:
+                raise MessageFieldExtractorError('Error compiling {} regexp {}: {}'.format(name, event, e))
+            self.patterns.append((event, regexp))
+
+        self.calls = 0
+        self.matches = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return '{} extractor'.format(self.name)
+
+    @property
+    def match_rate(self):
+        return float(self.matches) / self.calls if self.calls else 0.0
+
+    def match_program(self, program):
+        for pattern in self.programs:
+            if fnmatch.fnmatchcase(program, pattern):
+                return True
+        return False
+
+    def extract(self, message):
+        """Extract fields
+
+        Returns dictionary of fields extracted from message, or None
+        """
+        start = time.perf_counter()
+        fields = None
+        for event, regexp in self.patterns:
+            m = regexp.match(message)
+            if m:
+                fields = dict((key, value) for key, value in m.groupdict().items() if value is not None)
+                fields['event'] = event
+                break
+
+        self.calls += 1
+        if fields is not None:
+            self.matches += 1
+        self.seconds += time.perf_counter() - start
+        return fields
+
+    def reset_stats(self):
+        self.calls = 0
+        self.matches = 0
+        self.seconds = 0.0
+
+    def as_dict(self, verbose=False):
+        data = {
+            'name': self.name,
+            'programs': list(self.programs),
+            'calls': self.calls,
+            'matches': self.matches,
+            'match_rate': self.match_rate,
+            'seconds': self.seconds,
+            'seconds_per_call': self.seconds / self.calls if self.calls else 0.0,
+        }
+        if verbose:
+            data['patterns'] = dict((event, regexp.pattern) for event, regexp in self.patterns)
+        return data
+
+
+class MessageFieldExtractors(object):
+    """Registry of message field extractors
+
+    Extractors are looked up by entry program. Lookups are cached by
+    program name, so program name patterns are matched once per program.
+    """
+    def __init__(self, extractors=None):
+        self.extractors = []
+        self.__programs = {}
+        for extractor in extractors or ():
+            self.register(extractor)
+
+    def __repr__(self):
+        return '{:d} message field extractors'.format(len(self.extractors))
+
+    def __iter__(self):
+        return iter(self.extractors)
+
+    def register(self, extractor):
+        """Register extractor
+
+        Extractors with same name are replaced
+        """
+        self.extractors = [x for x in self.extractors if x.name != extractor.name]
+        self.extractors.append(extractor)
+        self.__programs = {}
+
+    def get(self, program):
+        """Return extractors for program
+
+        """
+        try:
+            return self.__programs[program]
+        except KeyError:
+            pass
+        if program is None:
+            extractors = ()
+        else:
+            extractors = tuple(x for x in self.extractors if x.match_program(program))
+        self.__programs[program] = extractors
+        return extractors
+
+    def extract(self, entry):
+        """Extract fields for entry
+
+        Returns dictionary of fields extracted from entry message by all
+        extractors for the entry program
+        """
+        fields = {}
+        extractors = self.get(entry.program)
+        if extractors:
+            message = entry.message
+            for extractor in extractors:
+                result = extractor.extract(message)
+                if result:
+                    fields.update(result)
+        return fields
+
+    def reset_stats(self):
+        for extractor in self.extractors:
+            extractor.reset_stats()
+
+    def as_dict(self, verbose=False):
+        return {
+            'extractors': [extractor.as_dict(verbose) for extractor in self.extractors],
+        }
+
+    def to_json(self, verbose=False):
+        """Return extractor stats as JSON
+
+        """
+        return json.dumps(self.as_dict(verbose=verbose), indent=2)
+
+
+SSHD_EXTRACTOR_PATTERNS = (
+    ('accepted', r'^Accepted (?P<method>\S+) for (?P<user>\S+) from (?P<address>\S+)(?: port (?P<port>\d+))?'),
+    ('failed', r'^Failed (?P<method>\S+) for (?:invalid user )?(?P<user>\S+) from (?P<address>\S+)'
+               r'(?: port (?P<port>\d+))?'),
+    ('invalid_user', r'^Invalid user (?P<user>\S*) from (?P<address>\S+)(?: port (?P<port>\d+))?'),
+    ('closed', r'^Connection closed by (?:(?:authenticating|invalid) user (?P<user>\S+) )?'
+               r'(?P<address>[^\s:]+)(?: port (?P<port>\d+))?'),
+    ('disconnected', r'^Disconnected from (?:(?:authenticating|invalid) )?(?:user (?P<user>\S+) )?'
+                     r'(?P<address>\S+) port (?P<port>\d+)'),
+    ('session', r'^pam_unix\(sshd:session\): session (?P<session>opened|closed) for user (?P<user>[^\s(]+)'),
+)
+
+SUDO_EXTRACTOR_PATTERNS = (
+    ('command', r'^\s*(?P<user>\S+) : (?:(?P<error>[^;]+?) ; )?TTY=(?P<tty>\S+) ; PWD=(?P<pwd>.*?) ; '
+                r'USER=(?P<target_user>\S+) ;(?: .*?;)? COMMAND=(?P<command>.*)$'),
+    ('session', r'^pam_unix\(sudo:session\): session (?P<session>opened|closed) for user (?P<user>[^\s(]+)'),
+)
+
+POSTFIX_EXTRACTOR_PATTERNS = (
+    ('delivery', r'^(?P<queue_id>[0-9A-Za-z]+): to=<(?P<to>[^>]*)>,(?: orig_to=<[^>]*>,)? '
+                 r'relay=(?P<relay>[^,]+),.*? status=(?P<status>\w+)'),
+    ('sender', r'^(?P<queue_id>[0-9A-Za-z]+): from=<(?P<sender>[^>]*)>, size=(?P<size>\d+)'),
+    ('client', r'^(?P<queue_id>[0-9A-Za-z]+): client=(?P<client>\S+)'),
+    ('connection', r'^(?P<connection>connect|disconnect) from (?P<client>\S+)'),
+)
+
+KERNEL_EXTRACTOR_PATTERNS = (
+    ('firewall', KERNEL_TIMESTAMP + r'.*?IN=(?P<in_interface>\S*) OUT=(?P<out_interface>\S*).*? '
+                                    r'SRC=(?P<source>\S+) DST=(?P<destination>\S+).*? PROTO=(?P<protocol>\S+)'
+                                    r'(?: SPT=(?P<source_port>\d+) DPT=(?P<destination_port>\d+))?'),
+    ('oom', KERNEL_TIMESTAMP + r'Out of memory: Kill(?:ed)? process (?P<pid>\d+) \((?P<process>[^)]+)\)'),
+    ('segfault', KERNEL_TIMESTAMP + r'(?P<process>[^\s\[]+)\[(?P<pid>\d+)\]: segfault at (?P<address>[0-9a-f]+)'),
+    ('link', KERNEL_TIMESTAMP + r'(?P<interface>[^\s:]+): link (?:is )?(?P<state>up|down)'),
+)
+
+
+def default_extractors():
+    """Return default extractors
+
+    Returns new MessageFieldExtractors registry with extractors for sshd,
+    sudo, postfix and kernel messages
+    """
+    return MessageFieldExtractors([
+        MessageFieldExtractor('sshd', ('sshd', ), SSHD_EXTRACTOR_PATTERNS),
+        MessageFieldExtractor('sudo', ('sudo', ), SUDO_EXTRACTOR_PATTERNS),
+        MessageFieldExtractor('postfix', ('postfix/*', ), POSTFIX_EXTRACTOR_PATTERNS),
+        MessageFieldExtractor('kernel', ('kernel', ), KERNEL_EXTRACTOR_PATTERNS),
+    ])
+
+
+DEFAULT_MESSAGE_EXTRACTORS = default_extractors()
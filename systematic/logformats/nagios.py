@@ -2,11 +2,14 @@
 Parser for nagios/icinga log entries
 """
 
+import array
 import re
 from datetime import datetime
 
-from systematic.log import LogEntry, LogFile, LogFileError
+from systematic.log import LogEntry, LogFile, LogFileError, LogFileIndex
 
+# Original regexp parsers for icinga log lines, kept for reference. Lines are
+# split with string methods in IcingaLogEntry.__split_line__ instead.
 RE_ICINGA_LOG = [
     re.compile(r'^\[(?P<epoch>\d+)\] (?P<category>[^:]+): (?P<message>.*)$'),
     re.compile(r'^\[(?P<epoch>\d+)\] (?P<message>.*)$'),
@@ -14,22 +17,16 @@ RE_ICINGA_LOG = [
 
 
 class IcingaLogEntry(LogEntry):
-    def __init__(self, line, year, source_formats):
-        line = line.strip()
-        self.line = line
-
-        self.time = None
-        for parser in RE_ICINGA_LOG:
-            m = parser.match(line)
-            if m:
-                fields = m.groupdict()
-                self.time = datetime.fromtimestamp(float(fields['epoch']))
-                self.category = fields.get('category', '').strip()
-                self.message = fields.get('message', '').strip()
-                break
-
-        if self.time is None:
-            raise LogFileError('Error parsing entry {}'.format(line))
+    """Icinga log entry
+
+    Entry fields are decoded on first access like with LogEntry. Entry time
+    is available as integer epoch in field epoch.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, logfile, line, year=None, source_formats=None):
+        super(IcingaLogEntry, self).__init__(logfile, line.strip(), year, source_formats)
 
     def __repr__(self):
         if self.category:
@@ -37,6 +34,136 @@ class IcingaLogEntry(LogEntry):
         else:
             return '{} {}'.format(self.time, self.message)
 
+    def __split_line__(self):
+        """Split line
+
+        Split '[epoch] category: message' or '[epoch] message' line without
+        regexps. Returns tuple (epoch, category, message).
+        """
+        line = self.line
+        head, separator, message = line.partition('] ')
+        epoch = head[1:]
+        if not separator or head[:1] != '[' or not epoch.isdigit():
+            raise LogFileError('Error parsing entry {}'.format(line))
+
+        # Category ends at first ':', which must be followed by a space
+        category, separator, text = message.partition(': ')
+        if separator and category and ':' not in category:
+            return int(epoch), category, text
+        return int(epoch), '', message
+
+    def __decode_time__(self, parts=None):
+        self.__decode_source__(parts)
+
+    def __decode_source__(self, parts=None):
+        epoch, category, message = parts or self.__split_line__()
+        self._time = datetime.fromtimestamp(epoch)
+        self.__store_fields__(None, message.strip(), {
+            'category': category.strip(),
+            'epoch': epoch,
+        })
+
+
+class IcingaLogIndex(LogFileIndex):
+    """Index of cached icinga log entries
+
+    LogFileIndex with list offsets of entries by category
+    """
+    def __init__(self):
+        super(IcingaLogIndex, self).__init__()
+        self.categories = {}
+
+    def clear(self):
+        super(IcingaLogIndex, self).clear()
+        self.categories.clear()
+
+    def add(self, offset, entry):
+        if entry.category not in self.categories:
+            self.categories[entry.category] = array.array('L')
+        self.categories[entry.category].append(offset)
+        super(IcingaLogIndex, self).add(offset, entry)
+
+    def truncate(self, offset):
+        for key in list(self.categories.keys()):
+            offsets = self.categories[key]
+            while offsets and offsets[-1] >= offset:
+                offsets.pop()
+            if not offsets:
+                del self.categories[key]
+        super(IcingaLogIndex, self).truncate(offset)
+
 
 class IcingaLog(LogFile):
+    """Icinga log file
+
+    Icinga logs are in time order, so time range queries on cached entries
+    and seeks in plain text files use binary search. With index=True cached
+    entries are also indexed by category.
+    """
     lineloader = IcingaLogEntry
+    indexer = IcingaLogIndex
+
+    def __bisect_time__(self, time):
+        """Search cached entries
+
+        Returns offset of first cached entry with time >= time
+        """
+        lo = 0
+        hi = len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid].time < time:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def filter_category(self, category, limit=None, sample=None, from_end=False):
+        """Filter by category
+
+        Return log entries with given category, like 'SERVICE ALERT'. See
+        LogFile.__select__ for limit, sample and from_end.
+        """
+        index = self.__load_index__()
+        if index is not None:
+            return self.__select_offsets__(index.categories.get(category, ()), limit, sample, from_end)
+
+        # Skip decoding entries which can't match
+        prefix = '] {}: '.format(category) if category else None
+        return self.__select__(
+            lambda x: x if (prefix is None or prefix in x.line) and x.category == category else None,
+            limit, sample, from_end
+        )
+
+    def between(self, start=None, end=None, limit=None, sample=None, from_end=False):
+        """Filter by time range
+
+        Return log entries with start <= time < end. Cached entries are
+        searched with binary search.
+        """
+        if self.streaming or self.index is not None or self.sidecar_index:
+            return super(IcingaLog, self).between(start, end, limit, sample, from_end)
+
+        # Load the file if entries are not cached
+        self.__iter_entries__()
+        first = self.__bisect_time__(start) if start is not None else 0
+        last = self.__bisect_time__(end) if end is not None else len(self)
+        return self.__select_offsets__(range(first, last), limit, sample, from_end)
+
+    def between_epochs(self, start=None, end=None):
+        """Filter by epoch range
+
+        Return log entries with start <= epoch < end
+        """
+        return self.between(
+            datetime.fromtimestamp(start) if start is not None else None,
+            datetime.fromtimestamp(end) if end is not None else None,
+        )
+
+    def seek_epoch(self, epoch):
+        """Seek to epoch
+
+        Position the file to first entry with epoch >= epoch. See
+        LogFile.seek_time for details.
+        """
+        return self.seek_time(datetime.fromtimestamp(epoch))
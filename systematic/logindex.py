@@ -0,0 +1,351 @@
+"""
+Persistent block index for syslog files
+
+Sidecar index files for compressed and plain text log files. The index splits
+the file to blocks of entries and records for each block the uncompressed byte
+offset, time range and bloom filters of hosts and programs, so queries can
+skip whole files or blocks that can't contain matching entries.
+
+Index files are stored next to the log file or in a cache directory, and are
+invalidated when the inode, size or modification time of the log file changes.
+"""
+
+import binascii
+import hashlib
+import io
+import json
+import os
+import zlib
+
+from datetime import datetime
+
+# Number of entries per indexed block
+DEFAULT_BLOCK_ENTRIES = 4096
+
+# Bloom filter size in bits and number of hash functions
+DEFAULT_BLOOM_BITS = 2048
+DEFAULT_BLOOM_HASHES = 3
+
+INDEX_FORMAT_VERSION = 1
+INDEX_FILE_SUFFIX = '.idx'
+INDEX_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class LogIndexError(Exception):
+    pass
+
+
+class BloomFilter(object):
+    """Bloom filter
+
+    Bloom filter for strings with stable hashes, so filters can be stored
+    to index files
+    """
+    def __init__(self, bits=DEFAULT_BLOOM_BITS, hashes=DEFAULT_BLOOM_HASHES, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray(data) if data is not None else bytearray(bits // 8)
+
+    def __repr__(self):
+        return 'bloom filter {:d} bits'.format(self.bits)
+
+    def __contains__(self, value):
+        data = self.data
+        for position in self.__positions__(value):
+            if not data[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __positions__(self, value):
+        value = value.encode('utf-8')
+        first = zlib.crc32(value)
+        second = zlib.adler32(value) | 1
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self.__positions__(value):
+            self.data[position >> 3] |= 1 << (position & 7)
+
+    def as_dict(self):
+        return {
+            'bits': self.bits,
+            'hashes': self.hashes,
+            'data': binascii.hexlify(bytes(self.data)).decode('ascii'),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['bits'], data['hashes'], binascii.unhexlify(data['data']))
+
+
+class LogIndexBlock(object):
+    """Indexed block
+
+    Block of entries in indexed file: uncompressed byte offsets of the block,
+    number of entries, time range and bloom filters of hosts and programs
+    """
+    def __init__(self, offset, end=None, entries=0, first_time=None, last_time=None, hosts=None, programs=None):
+        self.offset = offset
+        self.end = end
+        self.entries = entries
+        self.first_time = first_time
+        self.last_time = last_time
+        self.hosts = hosts if hosts is not None else BloomFilter()
+        self.programs = programs if programs is not None else BloomFilter()
+
+    def __repr__(self):
+        return 'block {}-{} {:d} entries'.format(self.offset, self.end, self.entries)
+
+    def add(self, entry):
+        """Add entry
+
+        Add entry time, host and program to the block
+        """
+        self.entries += 1
+        if self.first_time is None or entry.time < self.first_time:
+            self.first_time = entry.time
+        if self.last_time is None or entry.time > self.last_time:
+            self.last_time = entry.time
+        if entry.host is not None:
+            self.hosts.add(entry.host)
+        if entry.program is not None:
+            self.programs.add(entry.program)
+
+    def match(self, start=None, end=None, host=None, program=None):
+        """Check if block may match
+
+        Returns False if block can't contain entries with start <= time < end
+        and given host and program
+        """
+        if self.first_time is not None:
+            if start is not None and self.last_time < start:
+                return False
+            if end is not None and self.first_time >= end:
+                return False
+        if host is not None and host not in self.hosts:
+            return False
+        if program is not None and program not in self.programs:
+            return False
+        return True
+
+    def as_dict(self):
+        return {
+            'offset': self.offset,
+            'end': self.end,
+            'entries': self.entries,
+            'first_time': self.first_time.strftime(INDEX_TIME_FORMAT) if self.first_time else None,
+            'last_time': self.last_time.strftime(INDEX_TIME_FORMAT) if self.last_time else None,
+            'hosts': self.hosts.as_dict(),
+            'programs': self.programs.as_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data['offset'],
+            data['end'],
+            data['entries'],
+            datetime.strptime(data['first_time'], INDEX_TIME_FORMAT) if data['first_time'] else None,
+            datetime.strptime(data['last_time'], INDEX_TIME_FORMAT) if data['last_time'] else None,
+            BloomFilter.from_dict(data['hosts']),
+            BloomFilter.from_dict(data['programs']),
+        )
+
+
+class BlockReader(object):
+    """Block reader
+
+    File like object returning lines from fd until end offset of a block
+    """
+    def __init__(self, fd, offset, end):
+        self.fd = fd
+        self.offset = offset
+        self.end = end
+        self.fd.seek(offset)
+
+    def readline(self):
+        if self.end is not None and self.offset >= self.end:
+            return b''
+        line = self.fd.readline()
+        self.offset += len(line)
+        return line
+
+
+class LogFileSidecarIndex(object):
+    """Sidecar index for a log file
+
+    Loads index for the log file from index_directory, or from next to the
+    log file if index_directory is None. The index is rebuilt if it's missing
+    or the file has changed since indexing.
+
+    Failing to write the index file is not an error: the index is then only
+    kept in memory.
+    """
+    def __init__(self, logfile, index_directory=None, block_entries=DEFAULT_BLOCK_ENTRIES):
+        self.logfile = logfile
+        self.path = os.path.realpath(logfile.path)
+        self.index_directory = index_directory
+        self.block_entries = block_entries
+        self.blocks = []
+        self.stat = None
+
+        self.load()
+
+    def __repr__(self):
+        return 'index {} {:d} blocks'.format(self.path, len(self.blocks))
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+    @property
+    def index_path(self):
+        if self.index_directory is not None:
+            name = hashlib.sha1(self.path.encode('utf-8')).hexdigest()
+            return os.path.join(self.index_directory, '{}{}'.format(name, INDEX_FILE_SUFFIX))
+        # Hidden file, so globs for rotated log files don't match index files
+        return os.path.join(
+            os.path.dirname(self.path),
+            '.{}{}'.format(os.path.basename(self.path), INDEX_FILE_SUFFIX)
+        )
+
+    @property
+    def first_time(self):
+        times = [block.first_time for block in self.blocks if block.first_time is not None]
+        return min(times) if times else None
+
+    @property
+    def last_time(self):
+        times = [block.last_time for block in self.blocks if block.last_time is not None]
+        return max(times) if times else None
+
+    def __file_stat__(self):
+        try:
+            st = os.stat(self.path)
+        except OSError as e:
+            raise LogIndexError('Error running stat on {}: {}'.format(self.path, e))
+        return {
+            'inode': st.st_ino,
+            'device': st.st_dev,
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+        }
+
+    def open(self):
+        """Open log file
+
+        Open the log file in binary mode, decompressing transparently
+        """
+        fd = self.logfile.__open_logfile__(self.path)
+        if isinstance(fd, io.TextIOBase):
+            fd.close()
+            fd = open(self.path, 'rb')
+        return fd
+
+    def load(self):
+        """Load index
+
+        Load index from index file if it's valid for current log file, or
+        build and save a new index
+        """
+        self.stat = self.__file_stat__()
+        try:
+            with open(self.index_path, 'r') as fd:
+                data = json.load(fd)
+            if data.get('version') == INDEX_FORMAT_VERSION and data.get('path') == self.path and \
+                    data.get('stat') == self.stat and data.get('block_entries') == self.block_entries:
+                self.blocks = [LogIndexBlock.from_dict(block) for block in data['blocks']]
+                return
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+        self.build()
+        self.save()
+
+    def build(self):
+        """Build index
+
+        Read the log file and index blocks of entries
+        """
+        logfile = self.logfile
+        year = datetime.fromtimestamp(self.stat['mtime']).year
+        self.blocks = []
+
+        block = None
+        offset = 0
+        fd = self.open()
+        try:
+            while True:
+                line = fd.readline()
+                if not line:
+                    break
+
+                # Continuation lines and empty lines belong to previous entry
+                if line[:1] not in (b' ', b'\t') and line.strip():
+                    if block is None or block.entries >= self.block_entries:
+                        if block is not None:
+                            block.end = offset
+                        block = LogIndexBlock(offset)
+                        self.blocks.append(block)
+
+                    try:
+                        block.add(logfile.lineloader(
+                            logfile,
+                            line.decode('utf-8', 'replace'),
+                            year=year,
+                            source_formats=logfile.source_matcher
+                        ))
+                    except Exception:
+                        # Unparseable entries are not indexed
+                        pass
+
+                offset += len(line)
+        except (IOError, OSError) as e:
+            raise LogIndexError('Error reading {}: {}'.format(self.path, e))
+        finally:
+            fd.close()
+
+        if block is not None:
+            block.end = offset
+
+    def save(self):
+        """Save index
+
+        Write index file atomically. Returns True if index was written.
+        """
+        data = {
+            'version': INDEX_FORMAT_VERSION,
+            'path': self.path,
+            'stat': self.stat,
+            'block_entries': self.block_entries,
+            'blocks': [block.as_dict() for block in self.blocks],
+        }
+        path = self.index_path
+        tmpfile = '{}.{:d}.tmp'.format(path, os.getpid())
+        try:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(tmpfile, 'w') as fd:
+                json.dump(data, fd)
+            os.rename(tmpfile, path)
+            return True
+        except (IOError, OSError):
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+            return False
+
+    def refresh(self):
+        """Refresh index
+
+        Reload the index if the log file has changed since it was loaded
+        """
+        if self.__file_stat__() != self.stat:
+            self.load()
+
+    def match(self, start=None, end=None, host=None, program=None):
+        """Return matching blocks
+
+        Returns blocks which may contain entries with start <= time < end
+        and given host and program
+        """
+        return [block for block in self.blocks if block.match(start, end, host, program)]
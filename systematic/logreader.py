@@ -0,0 +1,392 @@
+"""
+Line readers for log files
+
+Readers returning raw lines from log files for systematic.log.LogFile
+
+Compressed files are decompressed in a producer thread by PipelinedReader.
+Supported codecs are gzip, bz2, xz and zstd. Reading zstd files requires
+compression.zstd from python 3.14 or the zstandard module.
+"""
+
+import bz2
+import io
+import lzma
+import os
+import queue
+import threading
+import zlib
+
+try:
+    from compression import zstd
+    has_zstd = True
+except ImportError:
+    try:
+        import zstandard as zstd
+        has_zstd = True
+    except ImportError:
+        zstd = None
+        has_zstd = False
+
+# Compressed bytes read and decompressed per chunk by PipelinedReader
+DEFAULT_CHUNK_SIZE = 2**17
+
+# Maximum number of decompressed chunks waiting in PipelinedReader queue
+DEFAULT_QUEUE_SIZE = 16
+
+# Bytes read per block by ReverseLineReader
+DEFAULT_REVERSE_BLOCK_SIZE = 2**16
+
+# Seconds to wait for queue before checking if reader was closed
+QUEUE_POLL_INTERVAL = 0.1
+
+COMPRESSION_CODECS = ('gzip', 'bz2', 'xz', 'zstd')
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Magic bytes at start of compressed files
+COMPRESSION_MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (ZSTD_MAGIC, 'zstd'),
+)
+COMPRESSION_MAGIC_BYTES = max(len(magic) for magic, codec in COMPRESSION_MAGIC)
+
+# Maximum number of detected file formats to cache
+FORMAT_CACHE_SIZE = 65536
+_FORMAT_CACHE = {}
+
+
+class LogReaderError(Exception):
+    pass
+
+
+class ReverseLineReader(object):
+    """Backwards line reader
+
+    Reads lines from an uncompressed file from end to start in blocks of
+    block_size bytes. Iterating the reader returns lines as bytes, including
+    the newline, last line first. Lines are split by newlines only, like with
+    readline().
+
+    Only data before end offset is read, by default up to current file size.
+    """
+    def __init__(self, fd, block_size=DEFAULT_REVERSE_BLOCK_SIZE, end=None):
+        if isinstance(fd, str):
+            try:
+                fd = open(fd, 'rb')
+            except (IOError, OSError) as e:
+                raise LogReaderError('Error opening {}: {}'.format(fd, e))
+
+        self.fd = fd
+        self.name = getattr(fd, 'name', None)
+        self.block_size = block_size
+        try:
+            self.end = end if end is not None else os.fstat(fd.fileno()).st_size
+        except (IOError, OSError) as e:
+            raise LogReaderError('Error running stat on {}: {}'.format(self.name, e))
+
+    def __repr__(self):
+        return 'reverse {}'.format(self.name)
+
+    def __iter__(self):
+        fileno = self.fd.fileno()
+        offset = self.end
+        # Start of the line split by block start, and if the data read so far
+        # is after the last newline of the file
+        head = b''
+        at_end = True
+        while offset > 0:
+            start = max(offset - self.block_size, 0)
+            try:
+                data = os.pread(fileno, offset - start, start) + head
+            except (IOError, OSError) as e:
+                raise LogReaderError('Error reading {}: {}'.format(self.name, e))
+            offset = start
+
+            lines = data.split(b'\n')
+            head = lines[0]
+            if len(lines) == 1:
+                continue
+
+            last = len(lines) - 1
+            if at_end:
+                # Data after last newline
+                if lines[last]:
+                    yield lines[last]
+                last -= 1
+                at_end = False
+            for index in range(last, 0, -1):
+                yield lines[index] + b'\n'
+
+        if head:
+            yield head if at_end else head + b'\n'
+        elif not at_end:
+            yield b'\n'
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+
+def detect_compression(fd, path=None):
+    """Detect compression codec
+
+    Returns codec for a file opened in binary mode from magic bytes at start
+    of the file, or None for uncompressed files. fd is left at start of file.
+
+    With path, the result is cached by path, inode and modification time of
+    the file, so the file is only read again when it has changed.
+    """
+    key = None
+    if path is not None:
+        st = os.fstat(fd.fileno())
+        key = (path, st.st_ino, st.st_dev, st.st_mtime_ns)
+        try:
+            return _FORMAT_CACHE[key]
+        except KeyError:
+            pass
+
+    header = fd.read(COMPRESSION_MAGIC_BYTES)
+    fd.seek(0)
+    codec = None
+    for magic, name in COMPRESSION_MAGIC:
+        if header.startswith(magic):
+            codec = name
+            break
+
+    if key is not None:
+        if len(_FORMAT_CACHE) >= FORMAT_CACHE_SIZE:
+            _FORMAT_CACHE.clear()
+        _FORMAT_CACHE[key] = codec
+    return codec
+
+
+def decompressor(codec):
+    """Return decompressor for codec
+
+    Returns a new streaming decompressor object with decompress() method,
+    and eof and unused_data attributes
+    """
+    if codec == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if codec == 'bz2':
+        return bz2.BZ2Decompressor()
+    if codec == 'xz':
+        return lzma.LZMADecompressor()
+    if codec == 'zstd':
+        if not has_zstd:
+            raise LogReaderError('Reading zstd files requires compression.zstd or zstandard module')
+        if hasattr(zstd, 'ZstdDecompressor') and hasattr(zstd.ZstdDecompressor, 'decompressobj'):
+            return zstd.ZstdDecompressor().decompressobj()
+        return zstd.ZstdDecompressor()
+    raise LogReaderError('Unknown compression codec: {}'.format(codec))
+
+
+def queue_put(chunks, stop, item):
+    """Put item to queue
+
+    Returns False if stop was set while waiting for space in queue
+    """
+    while not stop.is_set():
+        try:
+            chunks.put(item, timeout=QUEUE_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def decompress_lines(fd, codec, chunk_size, chunks, stop):
+    """Decompress file to lines
+
+    Producer thread for PipelinedReader: decompress fd from current position
+    to lists of complete lines in chunks queue until end of file or stop is
+    set. The last item in queue is None at end of file, or the exception raised.
+    """
+    try:
+        decompress = decompressor(codec)
+        partial = b''
+        while not stop.is_set():
+            data = fd.read(chunk_size)
+            if not data:
+                break
+
+            output = []
+            while data:
+                output.append(decompress.decompress(data))
+                data = b''
+                if getattr(decompress, 'eof', False):
+                    # Concatenated compressed streams
+                    data = decompress.unused_data
+                    decompress = decompressor(codec)
+
+            data = partial + b''.join(output)
+            if not data:
+                continue
+            lines = io.BytesIO(data).readlines()
+            partial = lines.pop() if not lines[-1].endswith(b'\n') else b''
+            if lines and not queue_put(chunks, stop, lines):
+                return
+
+        if partial:
+            queue_put(chunks, stop, [partial])
+        queue_put(chunks, stop, None)
+    except Exception as e:
+        queue_put(chunks, stop, e)
+
+
+class PipelinedReader(object):
+    """Threaded decompressing line reader
+
+    Reads a compressed file in a producer thread, which decompresses chunks
+    of the file and splits them to lines to a bounded queue. The reader works
+    like a binary file object: readline() and iterating the reader return
+    lines as bytes from the queue. zlib, bz2 and lzma release the GIL while
+    decompressing, so decompressing overlaps with parsing the lines.
+
+    The file is given as path or as file object opened in binary mode, which
+    is closed when the reader is closed. Files with multiple concatenated
+    compressed streams are supported. Seeking backwards restarts decompression
+    from start of the file.
+    """
+    def __init__(self, fd, codec, chunk_size=DEFAULT_CHUNK_SIZE, queue_size=DEFAULT_QUEUE_SIZE):
+        self.__queue = None
+        self.__thread = None
+        self.__stop = None
+        self.__lines = []
+        self.__index = 0
+        self.__eof = False
+
+        if codec not in COMPRESSION_CODECS:
+            raise LogReaderError('Unknown compression codec: {}'.format(codec))
+        if codec == 'zstd' and not has_zstd:
+            raise LogReaderError('Reading zstd files requires compression.zstd or zstandard module')
+
+        if isinstance(fd, str):
+            try:
+                fd = open(fd, 'rb')
+            except (IOError, OSError) as e:
+                raise LogReaderError('Error opening {}: {}'.format(fd, e))
+
+        self.fd = fd
+        self.path = getattr(fd, 'name', None)
+        self.name = self.path
+        self.codec = codec
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.offset = 0
+        self.__start__()
+
+    def __repr__(self):
+        return '{} {}'.format(self.codec, self.path)
+
+    def __del__(self):
+        if self.__stop is not None:
+            self.__stop.set()
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def __start__(self):
+        """Start producer thread
+
+        Start decompressing from start of the file
+        """
+        try:
+            self.fd.seek(0)
+        except (IOError, OSError) as e:
+            raise LogReaderError('Error reading {}: {}'.format(self.path, e))
+
+        self.offset = 0
+        self.__lines = []
+        self.__index = 0
+        self.__eof = False
+        self.__queue = queue.Queue(self.queue_size)
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(
+            target=decompress_lines,
+            args=(self.fd, self.codec, self.chunk_size, self.__queue, self.__stop),
+            name='decompress {}'.format(self.path),
+        )
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def readline(self):
+        while self.__index >= len(self.__lines):
+            if self.__eof:
+                return b''
+            item = self.__queue.get()
+            if item is None:
+                self.__eof = True
+                self.__lines = []
+                self.__index = 0
+                continue
+            if isinstance(item, Exception):
+                self.__eof = True
+                raise LogReaderError('Error decompressing {}: {}'.format(self.path, item))
+            self.__lines = item
+            self.__index = 0
+
+        line = self.__lines[self.__index]
+        self.__index += 1
+        self.offset += len(line)
+        return line
+
+    def read(self, size=-1):
+        """Read data
+
+        Read up to size bytes as lines. Provided for file API compatibility,
+        readline() is more efficient.
+        """
+        data = []
+        length = 0
+        while size < 0 or length < size:
+            line = self.readline()
+            if not line:
+                break
+            data.append(line)
+            length += len(line)
+        return b''.join(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.offset
+        elif whence != os.SEEK_SET:
+            raise LogReaderError('Seeking from end is not supported for compressed files')
+
+        if offset < self.offset:
+            self.__stop_producer__()
+            self.__start__()
+
+        # Skip lines, returning the remaining part of a line split by offset
+        while self.offset < offset:
+            line = self.readline()
+            if not line:
+                break
+            if self.offset > offset:
+                remaining = self.offset - offset
+                self.__index -= 1
+                self.__lines[self.__index] = line[-remaining:]
+                self.offset = offset
+        return self.offset
+
+    def tell(self):
+        return self.offset
+
+    def __stop_producer__(self):
+        if self.__thread is not None:
+            self.__stop.set()
+            self.__thread.join()
+            self.__thread = None
+        self.__eof = True
+
+    def close(self):
+        """Close reader
+
+        Stop the producer thread and close the file
+        """
+        self.__stop_producer__()
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
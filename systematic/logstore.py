@@ -0,0 +1,334 @@
+"""
+SQLite store for parsed syslog entries
+
+Export parsed entries from log files to a sqlite database, so later queries
+run against the database instead of parsing the log files again. Entry time,
+source fields, message and message_fields are stored as columns, with indexes
+by time, host and program.
+
+Files are identified by a fingerprint of the first FINGERPRINT_BYTES bytes
+of the uncompressed file, so a rotated file is recognized after it has been
+renamed or compressed, and files starting with the same line are not mixed
+up. Appending a file which is already in the store only inserts entries added
+after the previous export.
+
+Example usage:
+
+from glob import glob
+from systematic.log import LogFileCollection
+from systematic.logstore import LogStore
+store = LogStore('/var/tmp/logs.sqlite')
+store.append(LogFileCollection(glob('/var/log/auth.log*'), streaming=True))
+for entry in store.query(program='sshd', fields={'event': 'failed'}):
+    print(entry['time'], entry['message_fields']['address'])
+
+"""
+
+import hashlib
+import json
+import os
+import re
+
+from datetime import datetime
+
+from systematic.log import LogFile, LogFileCollection, LogFileError
+from systematic.sqlite import SQLiteDatabase
+
+# Number of entries inserted per batch
+DEFAULT_BATCH_SIZE = 10000
+
+# Number of bytes from start of file used as fingerprint
+FINGERPRINT_BYTES = 4096
+
+# Valid message_fields keys in queries
+RE_FIELD_NAME = re.compile(r'^\w+$')
+
+LOG_STORE_TABLES_SQL = (
+    """
+    CREATE TABLE IF NOT EXISTS files (
+        id          INTEGER PRIMARY KEY,
+        path        TEXT,
+        fingerprint TEXT,
+        fingerprint_size INTEGER,
+        inode       INTEGER,
+        device      INTEGER,
+        size        INTEGER,
+        mtime       INTEGER,
+        entries     INTEGER DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS entries (
+        file            INTEGER REFERENCES files(id) ON DELETE CASCADE,
+        seq             INTEGER,
+        time            TEXT,
+        host            TEXT,
+        program         TEXT,
+        pid             TEXT,
+        source          TEXT,
+        message         TEXT,
+        message_fields  TEXT,
+        PRIMARY KEY (file, seq)
+    )
+    """,
+    """CREATE INDEX IF NOT EXISTS entry_times ON entries(time)""",
+    """CREATE INDEX IF NOT EXISTS entry_hosts ON entries(host, time)""",
+    """CREATE INDEX IF NOT EXISTS entry_programs ON entries(program, time)""",
+)
+
+
+class LogStoreError(Exception):
+    pass
+
+
+class LogStore(SQLiteDatabase):
+    """SQLite store for log entries
+
+    Entries are inserted in batches of batch_size entries, and each file is
+    committed in one transaction. With message_fields=False message fields
+    are not extracted or stored.
+    """
+    def __init__(self, db_path, batch_size=DEFAULT_BATCH_SIZE, message_fields=True):
+        super(LogStore, self).__init__(db_path, LOG_STORE_TABLES_SQL)
+        self.batch_size = batch_size
+        self.message_fields = message_fields
+
+    def __repr__(self):
+        return 'log store {}'.format(self.db_path)
+
+    def __logfiles__(self, source):
+        """Log files to export
+
+        Returns list of LogFile objects for a path, LogFile or LogFileCollection
+        """
+        if isinstance(source, LogFileCollection):
+            return source.logfiles
+        if isinstance(source, LogFile):
+            return [source]
+        if isinstance(source, str):
+            return [LogFile(source, streaming=True)]
+        raise LogStoreError('Unsupported log source: {}'.format(source))
+
+    def __file_head__(self, logfile):
+        """Start of file
+
+        Returns first FINGERPRINT_BYTES bytes of the uncompressed file
+        """
+        fd = logfile.__open_logfile__(logfile.path)
+        try:
+            return fd.read(FINGERPRINT_BYTES)
+        finally:
+            fd.close()
+
+    def __lookup_file__(self, st, head=None):
+        """Lookup file
+
+        Returns tuple (id, entries) for file whose fingerprint matches the
+        same number of bytes from start of head, or for file with same inode,
+        device, size and modification time if head is None. Files with longest
+        matching fingerprint are preferred. Returns None for unknown files.
+        """
+        c = self.cursor
+        if head is None:
+            c.execute(
+                """SELECT id, entries FROM files WHERE inode=? AND device=? AND size=? AND mtime=?""",
+                (st.st_ino, st.st_dev, st.st_size, st.st_mtime_ns)
+            )
+            result = c.fetchone()
+            return tuple(result) if result is not None else None
+
+        c.execute(
+            """SELECT id, entries, fingerprint, fingerprint_size FROM files
+            WHERE fingerprint_size<=? ORDER BY fingerprint_size DESC, id""",
+            (len(head), )
+        )
+        for file_id, entries, fingerprint, size in c.fetchall():
+            if hashlib.sha1(head[:size]).hexdigest() == fingerprint:
+                return file_id, entries
+        return None
+
+    def __entry_row__(self, file_id, seq, entry):
+        """Row for entry
+
+        Returns entries table row for entry, or None if entry can't be decoded
+        """
+        try:
+            entry.decode()
+        except LogFileError:
+            return None
+
+        message_fields = None
+        if self.message_fields and entry.message_fields:
+            message_fields = json.dumps(entry.message_fields)
+        return (
+            file_id,
+            seq,
+            entry.time.isoformat(' '),
+            entry.host,
+            entry.program,
+            entry.pid,
+            entry.source,
+            entry.message,
+            message_fields,
+        )
+
+    def __insert_entries__(self, file_id, entries, skip):
+        """Insert entries
+
+        Insert entries after first skip entries in batches. Returns total
+        number of entries in file.
+        """
+        c = self.cursor
+        batch = []
+        seq = 0
+        for entry in entries:
+            seq += 1
+            if seq <= skip:
+                continue
+            row = self.__entry_row__(file_id, seq, entry)
+            if row is None:
+                continue
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                c.executemany("""INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""", batch)
+                batch = []
+        if batch:
+            c.executemany("""INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""", batch)
+        return seq
+
+    def __append_logfile__(self, logfile):
+        """Append log file
+
+        Export new entries from logfile. Returns number of new entries.
+        """
+        if not isinstance(logfile.path, str):
+            raise LogStoreError('Log files must be given as paths: {}'.format(logfile.path))
+
+        try:
+            st = os.stat(logfile.path)
+        except OSError as e:
+            raise LogStoreError('Error running stat on {}: {}'.format(logfile.path, e))
+
+        c = self.cursor
+        details = self.__lookup_file__(st)
+        if details is not None:
+            # Renamed file which has not been modified
+            c.execute("""UPDATE files SET path=? WHERE id=?""", (logfile.path, details[0]))
+            self.commit()
+            return 0
+
+        head = self.__file_head__(logfile)
+        if not head:
+            return 0
+
+        details = self.__lookup_file__(st, head)
+        try:
+            if details is None:
+                c.execute("""INSERT INTO files (path) VALUES (?)""", (logfile.path, ))
+                file_id = c.lastrowid
+                previous = skip = 0
+            else:
+                # Last entry is inserted again, because lines may have been appended to it
+                file_id, previous = details
+                skip = max(previous - 1, 0)
+                c.execute("""DELETE FROM entries WHERE file=? AND seq>?""", (file_id, skip))
+
+            entries = self.__insert_entries__(file_id, logfile.__iter_entries__(), skip)
+            # Fingerprint grows with the file up to FINGERPRINT_BYTES
+            c.execute(
+                """UPDATE files SET path=?, fingerprint=?, fingerprint_size=?,
+                inode=?, device=?, size=?, mtime=?, entries=? WHERE id=?""",
+                (
+                    logfile.path, hashlib.sha1(head).hexdigest(), len(head),
+                    st.st_ino, st.st_dev, st.st_size, st.st_mtime_ns, entries, file_id
+                )
+            )
+            self.commit()
+        except LogFileError as e:
+            self.rollback()
+            raise LogStoreError('Error exporting {}: {}'.format(logfile.path, e))
+        except Exception:
+            self.rollback()
+            raise
+
+        return max(entries - previous, 0)
+
+    def append(self, source):
+        """Append log entries
+
+        Export entries from a log file path, LogFile or LogFileCollection.
+        Files already in the store are only read when they have changed,
+        and only entries added since the previous export are inserted.
+
+        Returns number of new entries.
+        """
+        return sum(self.__append_logfile__(logfile) for logfile in self.__logfiles__(source))
+
+    def __where__(self, start=None, end=None, host=None, program=None, fields=None):
+        """Query conditions
+
+        Returns tuple (where, args) for query arguments
+        """
+        conditions = []
+        args = []
+        if start is not None:
+            conditions.append('time >= ?')
+            args.append(start.isoformat(' '))
+        if end is not None:
+            conditions.append('time < ?')
+            args.append(end.isoformat(' '))
+        if host is not None:
+            conditions.append('host = ?')
+            args.append(host)
+        if program is not None:
+            conditions.append('program = ?')
+            args.append(program)
+        for key, value in (fields or {}).items():
+            if not RE_FIELD_NAME.match(key):
+                raise LogStoreError('Invalid message field name: {}'.format(key))
+            conditions.append("json_extract(message_fields, '$.{}') = ?".format(key))
+            args.append(value)
+
+        where = ' WHERE {}'.format(' AND '.join(conditions)) if conditions else ''
+        return where, args
+
+    def query(self, start=None, end=None, host=None, program=None, fields=None, limit=None):
+        """Query entries
+
+        Generator returning entries with start <= time < end, host, program
+        and message fields matching given values, ordered by time. Entries are
+        returned as dictionaries with time as datetime and message_fields as
+        dictionary.
+        """
+        where, args = self.__where__(start, end, host, program, fields)
+        sql = """SELECT f.path AS path, e.time, e.host, e.program, e.pid, e.source, e.message, e.message_fields
+        FROM entries e JOIN files f ON e.file=f.id{} ORDER BY e.time, e.file, e.seq""".format(where)
+        if limit is not None:
+            sql += ' LIMIT {:d}'.format(limit)
+
+        c = self.cursor
+        c.execute(sql, args)
+        for result in c:
+            entry = self.as_dict(c, result)
+            entry['time'] = datetime.fromisoformat(entry['time'])
+            entry['message_fields'] = json.loads(entry['message_fields']) if entry['message_fields'] else {}
+            yield entry
+
+    def count(self, start=None, end=None, host=None, program=None, fields=None):
+        """Count entries
+
+        Returns number of entries matching query, see query()
+        """
+        where, args = self.__where__(start, end, host, program, fields)
+        c = self.cursor
+        c.execute("""SELECT COUNT(*) FROM entries{}""".format(where), args)
+        return c.fetchone()[0]
+
+    def files(self):
+        """Stored files
+
+        Returns list of dictionaries with details of exported files
+        """
+        c = self.cursor
+        c.execute("""SELECT id, path, fingerprint, entries FROM files ORDER BY id""")
+        return [self.as_dict(c, result) for result in c.fetchall()]
@@ -2,8 +2,20 @@
 Python implementation of 'tail' type file reader class
 """
 
+import asyncio
+import collections
+import json
+import logging
 import os
+import threading
 import time
+import weakref
+
+from systematic.inotify import (
+    Inotify, InotifyError, has_inotify,
+    IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE,
+    IN_DELETE_SELF, IN_MOVE_SELF, IN_Q_OVERFLOW, IN_IGNORED, IN_ONLYDIR,
+)
 
 # Poll interval
 INTERVAL = 0.01
@@ -11,21 +23,649 @@ INTERVAL = 0.01
 # Retry fast but not as fast as as polling
 OPEN_RETRY_INTERVAL = 0.2
 
+# Maximum number of lines read from one file at a time by MultiTailReader
+DEFAULT_MAX_LINES = 1000
+
+# Default limits for lines and characters read by TailReader.read_batch
+DEFAULT_BATCH_LINES = 10000
+DEFAULT_BATCH_BYTES = 2**20
+
+# Seconds to wait for inotify events before checking files anyway
+INOTIFY_INTERVAL = 1.0
+
+# Minimum seconds between writes of committed checkpoints to disk
+CHECKPOINT_SYNC_INTERVAL = 1.0
+
+# Rotated file names checked when resuming from a checkpoint
+CHECKPOINT_ROTATED_SUFFIXES = ('.1', )
+
+TAIL_BACKENDS = ('inotify', 'poll')
+
+# Directory events for watched files: writes, truncation, rotation and creation
+INOTIFY_DIRECTORY_EVENTS = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+    IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+
+
+logger = logging.getLogger(__name__)
+
 
 class TailReaderError(Exception):
     pass
 
 
+class PollWatcher(object):
+    """Polling file watcher
+
+    Watcher which does not know which files have changed: wait() sleeps and
+    returns all watched paths
+    """
+    backend = 'poll'
+    interval = INTERVAL
+
+    def __init__(self):
+        self.paths = collections.OrderedDict()
+
+    def __repr__(self):
+        return 'poll watcher {:d} paths'.format(len(self.paths))
+
+    def fileno(self):
+        return None
+
+    def watch(self, path):
+        self.paths[path] = True
+
+    def unwatch(self, path):
+        self.paths.pop(path, None)
+
+    def read(self):
+        return list(self.paths)
+
+    def wait(self, timeout=None):
+        """Wait for changes
+
+        Sleep timeout seconds, default INTERVAL. Returns list of all paths.
+        """
+        time.sleep(timeout if timeout is not None else INTERVAL)
+        return list(self.paths)
+
+    def close(self):
+        self.paths.clear()
+
+
+class InotifyWatcher(object):
+    """Inotify file watcher
+
+    Watches the directories of watched paths with inotify, so events are
+    received for writes to the files and when the files are created, moved,
+    deleted or truncated. One watch is used per directory.
+    """
+    backend = 'inotify'
+    interval = INOTIFY_INTERVAL
+
+    def __init__(self):
+        try:
+            self.inotify = Inotify()
+        except InotifyError as e:
+            raise TailReaderError(e)
+        self.paths = set()
+        self.directories = {}
+        self.watches = {}
+        self.checked = time.time()
+
+    def __repr__(self):
+        return 'inotify watcher {:d} paths'.format(len(self.paths))
+
+    def __add_directory_watch__(self, directory):
+        try:
+            wd = self.inotify.add_watch(directory, INOTIFY_DIRECTORY_EVENTS)
+        except InotifyError as e:
+            raise TailReaderError(e)
+        self.directories[directory] = wd
+        self.watches[wd] = directory
+
+    def __rewatch__(self):
+        """Restore directory watches
+
+        Watch directories which were removed and have been created again.
+        Returns paths in restored directories.
+        """
+        paths = set()
+        for directory in set(os.path.dirname(path) for path in self.paths):
+            if self.directories.get(directory) is None and os.path.isdir(directory):
+                try:
+                    self.__add_directory_watch__(directory)
+                except TailReaderError:
+                    continue
+                paths.update(path for path in self.paths if os.path.dirname(path) == directory)
+        return paths
+
+    def fileno(self):
+        return self.inotify.fileno()
+
+    def watch(self, path):
+        """Watch path
+
+        Raises TailReaderError if directory of path can't be watched
+        """
+        path = os.path.abspath(path)
+        directory = os.path.dirname(path)
+        if directory not in self.directories:
+            self.__add_directory_watch__(directory)
+        self.paths.add(path)
+
+    def unwatch(self, path):
+        path = os.path.abspath(path)
+        self.paths.discard(path)
+        directory = os.path.dirname(path)
+        if not any(os.path.dirname(x) == directory for x in self.paths):
+            wd = self.directories.pop(directory, None)
+            if wd is not None:
+                self.watches.pop(wd, None)
+                self.inotify.remove_watch(wd)
+
+    def __changed_paths__(self, events):
+        """Changed paths
+
+        Returns list of watched paths in events, in order of first event
+        """
+        changed = collections.OrderedDict()
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                return list(self.paths)
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                # Directory was removed or unmounted
+                self.watches.pop(wd, None)
+                self.directories[directory] = None
+            if not name or mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                changed.update((path, True) for path in self.paths if os.path.dirname(path) == directory)
+                continue
+            path = os.path.join(directory, name)
+            if path in self.paths:
+                changed[path] = True
+        return list(changed)
+
+    def read(self):
+        """Read changes
+
+        Returns list of watched paths with pending events without waiting
+        """
+        try:
+            return self.__changed_paths__(self.inotify.read())
+        except InotifyError as e:
+            raise TailReaderError(e)
+
+    def wait(self, timeout=None):
+        """Wait for changes
+
+        Wait up to timeout seconds, default INOTIFY_INTERVAL, for events for
+        watched paths. Returns list of changed paths. All paths are returned
+        every INOTIFY_INTERVAL seconds without events, so callers check the
+        files periodically anyway. Returns empty list on timeout.
+        """
+        if timeout is None:
+            timeout = INOTIFY_INTERVAL
+        deadline = time.time() + timeout
+        while True:
+            wait = min(deadline, self.checked + INOTIFY_INTERVAL) - time.time()
+            try:
+                changed = self.__changed_paths__(self.inotify.wait(max(wait, 0)))
+            except InotifyError as e:
+                raise TailReaderError(e)
+            if changed:
+                return changed
+
+            now = time.time()
+            if now >= self.checked + INOTIFY_INTERVAL:
+                self.checked = now
+                self.__rewatch__()
+                return list(self.paths)
+            if now >= deadline:
+                return []
+
+    def add_reader(self, loop, callback):
+        """Add event loop reader
+
+        Call callback from asyncio event loop when events are available.
+        The callback must read the events.
+        """
+        loop.add_reader(self.fileno(), callback)
+
+    def remove_reader(self, loop):
+        loop.remove_reader(self.fileno())
+
+    def close(self):
+        self.inotify.close()
+        self.paths.clear()
+        self.directories.clear()
+        self.watches.clear()
+
+
+class SharedInotify(object):
+    """Shared inotify instance
+
+    InotifyWatcher shared by SharedInotifyWatcher objects, so following many
+    files with separate TailReader objects uses one inotify instance. The
+    number of inotify instances per user is limited, by default to 128 on
+    Linux (fs.inotify.max_user_instances).
+
+    Events read by any watcher are dispatched to all watchers of the changed
+    paths. Only one thread waits for events at a time, other threads wait
+    until events are dispatched to them, or until they need to take over
+    waiting for events.
+    """
+    def __init__(self):
+        self.watcher = InotifyWatcher()
+        self.lock = threading.Lock()
+        self.subscribers = collections.defaultdict(weakref.WeakSet)
+        self.members = weakref.WeakSet()
+        self.waiting = collections.OrderedDict()
+        self.loops = {}
+        self.polling = False
+
+    def __repr__(self):
+        return 'shared inotify {:d} paths'.format(len(self.subscribers))
+
+    def fileno(self):
+        return self.watcher.fileno()
+
+    def __watch__(self, subscriber, path):
+        with self.lock:
+            if path not in self.subscribers:
+                self.watcher.watch(path)
+            self.subscribers[path].add(subscriber)
+
+    def __unwatch__(self, subscriber, path):
+        with self.lock:
+            subscribers = self.subscribers.get(path)
+            if subscribers is None:
+                return
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self.subscribers[path]
+                self.watcher.unwatch(path)
+
+    def __dispatch__(self, events):
+        """Dispatch events
+
+        Add changed paths to pending changes of watchers. Must be called
+        with the lock held.
+        """
+        for path in self.watcher.__changed_paths__(events):
+            for subscriber in self.subscribers.get(path, ()):
+                subscriber.changed[path] = True
+                subscriber.event.set()
+
+    def read(self):
+        """Read events
+
+        Read and dispatch pending events without waiting
+        """
+        with self.lock:
+            try:
+                self.__dispatch__(self.watcher.inotify.read())
+            except InotifyError as e:
+                raise TailReaderError(e)
+
+    def wait(self, subscriber, timeout):
+        """Wait for changes
+
+        Wait up to timeout seconds for changes to paths of subscriber. Returns
+        list of changed paths, empty list on timeout.
+        """
+        deadline = time.time() + timeout
+        while True:
+            with self.lock:
+                if subscriber.changed:
+                    return subscriber.__pop_changed__()
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return []
+                polling = not self.polling
+                if polling:
+                    self.polling = True
+                else:
+                    subscriber.event.clear()
+                    self.waiting[subscriber] = True
+
+            if not polling:
+                subscriber.event.wait(remaining)
+                with self.lock:
+                    self.waiting.pop(subscriber, None)
+                continue
+
+            events = []
+            try:
+                events = self.watcher.inotify.wait(remaining)
+            except InotifyError as e:
+                raise TailReaderError(e)
+            finally:
+                with self.lock:
+                    self.polling = False
+                    self.__dispatch__(events)
+                    # Wake a waiting thread to wait for events instead
+                    for waiter in self.waiting:
+                        if not waiter.changed:
+                            waiter.event.set()
+                            break
+
+    def rewatch(self):
+        with self.lock:
+            self.watcher.__rewatch__()
+
+    def __on_readable__(self, loop):
+        """Event loop reader callback
+
+        Read the events, and call callbacks of watchers with changes
+        """
+        self.read()
+        for subscriber, callback in list(self.loops.get(loop, {}).items()):
+            if subscriber.changed:
+                callback()
+
+    def add_reader(self, loop, subscriber, callback):
+        callbacks = self.loops.setdefault(loop, {})
+        if not callbacks:
+            loop.add_reader(self.fileno(), self.__on_readable__, loop)
+        callbacks[subscriber] = callback
+
+    def remove_reader(self, loop, subscriber):
+        callbacks = self.loops.get(loop, {})
+        callbacks.pop(subscriber, None)
+        if not callbacks and loop in self.loops:
+            del self.loops[loop]
+            loop.remove_reader(self.fileno())
+
+    def close(self):
+        self.watcher.close()
+        self.subscribers.clear()
+        self.loops.clear()
+
+
+_shared_inotify = None
+_shared_inotify_lock = threading.RLock()
+
+
+def shared_inotify(member):
+    """Return shared inotify instance
+
+    The instance is created on first use, and used by member until
+    release_shared_inotify() is called for it
+    """
+    global _shared_inotify
+    with _shared_inotify_lock:
+        if _shared_inotify is None:
+            _shared_inotify = SharedInotify()
+        _shared_inotify.members.add(member)
+        return _shared_inotify
+
+
+def release_shared_inotify(member):
+    """Release shared inotify instance
+
+    The instance is closed when it has no members
+    """
+    global _shared_inotify
+    with _shared_inotify_lock:
+        if _shared_inotify is None:
+            return
+        _shared_inotify.members.discard(member)
+        if not _shared_inotify.members:
+            _shared_inotify.close()
+            _shared_inotify = None
+
+
+class SharedInotifyWatcher(object):
+    """Shared inotify file watcher
+
+    Watcher with the same interface as InotifyWatcher, using the shared
+    inotify instance returned by shared_inotify()
+    """
+    backend = 'inotify'
+    interval = INOTIFY_INTERVAL
+
+    def __init__(self):
+        self.shared = shared_inotify(self)
+        self.paths = set()
+        self.changed = collections.OrderedDict()
+        self.event = threading.Event()
+        self.checked = time.time()
+
+    def __repr__(self):
+        return 'shared inotify watcher {:d} paths'.format(len(self.paths))
+
+    def __del__(self):
+        self.close()
+
+    def __pop_changed__(self):
+        changed = list(self.changed)
+        self.changed.clear()
+        return changed
+
+    def fileno(self):
+        if self.shared is None:
+            return None
+        return self.shared.fileno()
+
+    def watch(self, path):
+        """Watch path
+
+        Raises TailReaderError if directory of path can't be watched
+        """
+        path = os.path.abspath(path)
+        self.shared.__watch__(self, path)
+        self.paths.add(path)
+
+    def unwatch(self, path):
+        path = os.path.abspath(path)
+        self.paths.discard(path)
+        self.changed.pop(path, None)
+        if self.shared is not None:
+            self.shared.__unwatch__(self, path)
+
+    def read(self):
+        """Read changes
+
+        Returns list of watched paths with pending events without waiting
+        """
+        self.shared.read()
+        with self.shared.lock:
+            return self.__pop_changed__()
+
+    def wait(self, timeout=None):
+        """Wait for changes
+
+        Wait for changes like InotifyWatcher.wait()
+        """
+        if timeout is None:
+            timeout = INOTIFY_INTERVAL
+        deadline = time.time() + timeout
+        while True:
+            changed = self.shared.wait(self, min(deadline, self.checked + INOTIFY_INTERVAL) - time.time())
+            if changed:
+                return changed
+
+            now = time.time()
+            if now >= self.checked + INOTIFY_INTERVAL:
+                self.checked = now
+                self.shared.rewatch()
+                return list(self.paths)
+            if now >= deadline:
+                return []
+
+    def add_reader(self, loop, callback):
+        """Add event loop reader
+
+        Call callback from asyncio event loop when watched paths have changed
+        """
+        self.shared.add_reader(loop, self, callback)
+
+    def remove_reader(self, loop):
+        self.shared.remove_reader(loop, self)
+
+    def close(self):
+        shared = getattr(self, 'shared', None)
+        if shared is None:
+            return
+        for path in list(self.paths):
+            self.unwatch(path)
+        for loop in list(shared.loops):
+            shared.remove_reader(loop, self)
+        self.shared = None
+        release_shared_inotify(self)
+
+
+def tail_watcher(backend=None, shared=False):
+    """Return file watcher
+
+    Returns InotifyWatcher for backend 'inotify', PollWatcher for 'poll',
+    and with backend None InotifyWatcher if inotify is available. With
+    shared, SharedInotifyWatcher is returned instead of InotifyWatcher.
+
+    Falling back to polling, for example when the limit of inotify instances
+    is reached, is logged as a warning.
+    """
+    if backend not in TAIL_BACKENDS + (None, ):
+        raise TailReaderError('Unknown tail backend: {}'.format(backend))
+    if backend == 'poll' or (backend is None and not has_inotify):
+        return PollWatcher()
+    try:
+        if shared:
+            return SharedInotifyWatcher()
+        return InotifyWatcher()
+    except TailReaderError as e:
+        if backend == 'inotify':
+            raise
+        logger.warning('Polling files for changes, inotify is not available: {}'.format(e))
+        return PollWatcher()
+
+
+class TailCheckpoints(object):
+    """Tail reader checkpoints
+
+    Durable store for positions of TailReader objects, saved as JSON to path.
+    Each followed path records the device, inode and byte offset of the file
+    read last, so readers can resume after restart even if the file was
+    rotated meanwhile.
+
+    Committed positions are written to disk and synced at most every
+    sync_interval seconds, and when sync() or close() is called. After a
+    crash, lines committed within the last sync_interval seconds are read
+    again.
+    """
+    def __init__(self, path, sync_interval=CHECKPOINT_SYNC_INTERVAL):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.synced = time.time()
+        self.dirty = False
+        self.files = self.__load__()
+
+    def __repr__(self):
+        return 'tail checkpoints {}'.format(self.path)
+
+    def __load__(self):
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as fd:
+                data = json.load(fd)
+        except (OSError, ValueError) as e:
+            raise TailReaderError('Error loading checkpoints {}: {}'.format(self.path, e))
+        if not isinstance(data, dict) or not isinstance(data.get('files', None), dict):
+            raise TailReaderError('Invalid checkpoints file {}'.format(self.path))
+        return data['files']
+
+    def get(self, path):
+        """Get checkpoint
+
+        Returns dictionary with device, inode and offset for path, or None
+        """
+        return self.files.get(path, None)
+
+    def update(self, path, device, inode, offset):
+        """Update checkpoint
+
+        Record position for path. Changes are synced to disk if sync_interval
+        seconds have passed since previous sync.
+        """
+        checkpoint = {'device': device, 'inode': inode, 'offset': offset}
+        if self.files.get(path, None) != checkpoint:
+            self.files[path] = checkpoint
+            self.dirty = True
+        if self.dirty and time.time() - self.synced >= self.sync_interval:
+            self.sync()
+
+    def remove(self, path):
+        if self.files.pop(path, None) is not None:
+            self.dirty = True
+
+    def sync(self):
+        """Write checkpoints to disk
+
+        The file is replaced atomically and synced with fsync
+        """
+        self.synced = time.time()
+        if not self.dirty:
+            return
+        tmpfile = '{}.tmp'.format(self.path)
+        try:
+            with open(tmpfile, 'w') as fd:
+                json.dump({'files': self.files}, fd)
+                fd.flush()
+                os.fsync(fd.fileno())
+            os.replace(tmpfile, self.path)
+            directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+        except OSError as e:
+            raise TailReaderError('Error writing checkpoints {}: {}'.format(self.path, e))
+        self.dirty = False
+
+    def close(self):
+        self.sync()
+
+
 class TailReader(object):
     """File tail reader
 
     Read files like 'tail', opening closed / truncated files correctly
+
+    The reader waits for new data with inotify when available, and polls the
+    file every INTERVAL seconds otherwise or with backend='poll'. Rotation
+    and truncation are checked after each wait, not for every line.
+
+    Use read_batch() to read lines in blocks when following busy files.
+
+    With checkpoints (a TailCheckpoints object), commit() records the byte
+    offset after lines returned so far. When the reader is created again,
+    reading resumes from the committed offset. If the file was rotated, rest
+    of the rotated file is read before the new file. Files are then read
+    with only line feeds as line separators, so offsets match the file.
     """
-    def __init__(self, path=None, fd=None):
+    def __init__(self, path=None, fd=None, backend=None, checkpoints=None):
         self.path = path
         self.stat = None
         self.fd = fd
         self.pos = 0
+        self.offset = 0
+        self.backend = backend
+        self.checkpoints = checkpoints
+        self.watcher = None
+        self.__check_file = True
+        self.__lines = collections.deque()
+        self.__partial = ''
+        self.__eof = False
+        self.__file = None
+        self.__encoding = None
+        self.__flushed = False
+        self.__resumed = False
+        self.__restored = checkpoints is None
 
     def __format_line__(self, line):
         """Format line
@@ -42,11 +682,113 @@ class TailReader(object):
         return self.readline()
 
     def close(self):
+        # Incomplete last line read from the file is returned as a line
+        if self.__partial:
+            self.__lines.append(self.__partial)
+            self.__partial = ''
+            self.__flushed = True
         if self.fd is not None:
             self.fd.close()
         self.fd = None
         self.stat = None
 
+    def __get_watcher__(self):
+        """Return file watcher
+
+        Watcher is created on first use. If the path can't be watched with
+        inotify, falls back to polling unless backend is 'inotify'.
+        """
+        if self.watcher is None:
+            watcher = tail_watcher(self.backend, shared=True)
+            try:
+                watcher.watch(self.path)
+            except TailReaderError as e:
+                watcher.close()
+                if self.backend == 'inotify':
+                    raise
+                logger.warning('Polling {} for changes: {}'.format(self.path, e))
+                watcher = PollWatcher()
+                watcher.watch(self.path)
+            self.watcher = watcher
+        return self.watcher
+
+    def __wait__(self, timeout=None):
+        """Wait for file changes
+
+        Wait with the watcher until the file may have changed
+        """
+        self.__get_watcher__().wait(timeout)
+        self.__check_file = True
+
+    def __checkpoint__(self):
+        """Find checkpoint position
+
+        Returns tuple (path, offset) for the file to open. If the committed
+        file was rotated, path is the rotated file.
+        """
+        checkpoint = self.checkpoints.get(self.path)
+        if checkpoint is None:
+            return self.path, 0
+
+        for path in (self.path, ) + tuple(self.path + suffix for suffix in CHECKPOINT_ROTATED_SUFFIXES):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if st.st_dev == checkpoint['device'] and st.st_ino == checkpoint['inode']:
+                if checkpoint['offset'] > st.st_size:
+                    # File was truncated
+                    return path, 0
+                return path, checkpoint['offset']
+        return self.path, 0
+
+    def __open__(self):
+        """Open file
+
+        Try to open the file once, and seek to beginning of file when file is
+        opened. Returns True if the file was opened.
+
+        With checkpoints, the first file opened is positioned at the committed
+        offset instead.
+        """
+        if self.fd is not None:
+            self.close()
+
+        path, offset = self.path, 0
+        if not self.__restored:
+            path, offset = self.__checkpoint__()
+
+        if os.path.isfile(path) and os.access(path, os.R_OK):
+
+            try:
+                if self.checkpoints is not None:
+                    self.fd = open(path, 'r', newline='\n')
+                else:
+                    self.fd = open(path, 'r')
+                self.stat = os.fstat(self.fd.fileno())
+                self.fd.seek(offset)
+                self.pos = offset
+                self.offset = offset
+                self.__file = (self.stat.st_dev, self.stat.st_ino)
+                self.__encoding = self.fd.encoding
+                self.__resumed = not self.__restored and self.checkpoints.get(self.path) is not None
+                self.__restored = True
+                self.__eof = False
+                self.year = time.localtime(self.stat.st_mtime).tm_year
+                return True
+
+            except IOError:
+                pass
+            except OSError:
+                pass
+
+        else:
+            self.stat = None
+            self.fd = None
+            self.pos = 0
+
+        return False
+
     def load(self):
         """Load file
 
@@ -55,31 +797,146 @@ class TailReader(object):
         This will hang until file is available and readable, and seek to beginning
         of file when file is opened.
         """
-        while True:
+        while not self.__open__():
+            self.__wait__(OPEN_RETRY_INTERVAL)
+
+    def __check_rotation__(self):
+        """Check file rotation
+
+        Close the file if it was removed or rotated, and open it again if it
+        was truncated. A rotated file is closed only when reading it returns
+        no more data, so lines written to it before rotation are not lost.
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            st = None
+
+        try:
+            if self.stat is not None and (st is None or st.st_ino != self.stat.st_ino):
+                if self.fd is None or not self.__read_block__(DEFAULT_BATCH_BYTES):
+                    self.close()
+                return
+
             if self.fd is not None:
-                self.close()
+                if st is None:
+                    self.close()
+                elif self.pos > 0 and self.pos > st.st_size:
+                    self.__open__()
 
-            if os.path.isfile(self.path) and os.access(self.path, os.R_OK):
+        except IOError:
+            self.close()
+        except OSError:
+            self.close()
 
-                try:
-                    self.fd = open(self.path, 'r')
-                    self.stat = os.stat(self.path)
-                    self.fd.seek(0)
-                    self.pos = 0
-                    self.year = time.localtime(self.stat.st_mtime).tm_year
-                    break
+    def __read_block__(self, size):
+        """Read block
 
-                except IOError:
-                    pass
-                except OSError:
-                    pass
+        Read up to size characters and split them to lines. The incomplete
+        last line is kept until rest of it is read. Returns number of
+        characters read, 0 at end of file.
+        """
+        try:
+            data = self.fd.read(size)
+            if not data:
+                self.pos = self.fd.tell()
+                self.__eof = True
+                return 0
+        except IOError as e:
+            raise TailReaderError('Error reading {}: {}'.format(self.path, e))
+        except OSError as e:
+            raise TailReaderError('Error reading {}: {}'.format(self.path, e))
 
-            else:
-                self.stat = None
-                self.fd = None
-                self.pos = 0
+        self.__eof = False
+        lines = (self.__partial + data).split('\n')
+        self.__partial = lines.pop()
+        self.__lines.extend(lines)
+        return len(data)
+
+    def __consume__(self, lines):
+        """Advance offset
+
+        Advance checkpoint offset past lines taken from line buffer
+        """
+        size = len(''.join(lines).encode(self.__encoding)) + len(lines)
+        if self.__flushed and not self.__lines:
+            # Last line of closed file had no line feed
+            size -= 1
+            self.__flushed = False
+        self.offset += size
 
-            time.sleep(OPEN_RETRY_INTERVAL)
+    def __pending__(self):
+        """Check for pending lines
+
+        Returns True if lines are buffered or the file was not read to the end.
+        If a rotated file was closed, the new file is opened here, and is only
+        pending if it could be opened.
+        """
+        if self.__lines:
+            return True
+        if self.fd is None and self.__file is not None and not self.__open__():
+            return False
+        return self.fd is not None and not self.__eof
+
+    def __read_lines__(self, max_lines=None, check=False, max_bytes=DEFAULT_BATCH_BYTES):
+        """Read available lines
+
+        Returns list of up to max_lines formatted lines which can be read
+        without waiting, reading at most max_bytes characters from the file.
+        With check, rotation and truncation are checked first.
+        """
+        if check:
+            self.__check_rotation__()
+        if self.fd is None and not self.__lines:
+            # Lines of a closed file are returned before opening new file
+            self.__open__()
+
+        remaining = max_bytes
+        while self.fd is not None and remaining > 0 and (max_lines is None or len(self.__lines) < max_lines):
+            size = self.__read_block__(remaining)
+            if not size:
+                if check:
+                    # Rotated file was read to the end
+                    self.__check_rotation__()
+                break
+            remaining -= size
+
+        buffered = self.__lines
+        if max_lines is None or max_lines >= len(buffered):
+            raw = list(buffered)
+            buffered.clear()
+        else:
+            raw = [buffered.popleft() for index in range(max_lines)]
+        if self.checkpoints is not None and raw:
+            self.__consume__(raw)
+
+        lines = []
+        for line in raw:
+            try:
+                lines.append(self.__format_line__(line.rstrip()))
+            except Exception:
+                # Skip exceptions formatting lines, likely just corrupted
+                pass
+        return lines
+
+    def __seek_end__(self):
+        """Jump to end of file without waiting
+
+        Skips buffered lines. If the file does not exist, it is read from
+        start when created. Position restored from checkpoint is kept.
+        """
+        if self.fd is None:
+            self.__open__()
+        if self.__resumed:
+            self.__resumed = False
+            return
+        if self.fd is not None:
+            self.fd.seek(0, os.SEEK_END)
+            self.pos = self.offset = self.fd.tell()
+            self.__eof = True
+        self.__lines.clear()
+        self.__partial = ''
+        self.__flushed = False
 
     def seek_to_end(self):
         """Jump to end of file
@@ -90,7 +947,61 @@ class TailReader(object):
         """
         if self.fd is None:
             self.load()
-        self.fd.seek(os.stat(self.path).st_size)
+        self.__seek_end__()
+
+    def read_batch(self, max_lines=DEFAULT_BATCH_LINES, max_bytes=DEFAULT_BATCH_BYTES, timeout=None):
+        """Read lines in batch
+
+        Returns list of up to max_lines formatted lines. The file is read in
+        blocks of at most max_bytes characters per call, and split to lines in
+        one go. Rotation and truncation are checked once per batch, after
+        waiting for data.
+
+        If no lines are available, waits up to timeout seconds for data, or
+        forever if timeout is None. Returns empty list on timeout.
+
+        Incomplete lines at end of file are returned when they are completed,
+        or when the file is rotated.
+        """
+        self.__get_watcher__()
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            check = self.__check_file
+            self.__check_file = False
+            lines = self.__read_lines__(max_lines, check, max_bytes)
+            if lines:
+                return lines
+            if self.__pending__():
+                continue
+
+            if deadline is None:
+                self.__wait__()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return []
+                self.__wait__(min(remaining, self.__get_watcher__().interval))
+
+    def __position__(self):
+        """Current position
+
+        Returns tuple (device, inode, offset) after lines returned so far,
+        or None if no file has been opened
+        """
+        if self.__file is None:
+            return None
+        return self.__file + (self.offset, )
+
+    def commit(self):
+        """Commit position
+
+        Record offset after lines returned so far to checkpoints
+        """
+        if self.checkpoints is None:
+            raise TailReaderError('No checkpoints for {}'.format(self.path))
+        position = self.__position__()
+        if position is not None:
+            self.checkpoints.update(self.path, *position)
 
     def readline(self):
         """Read a line from the file
@@ -101,20 +1012,22 @@ class TailReader(object):
         If file is removed or truncated and re-created, reopens the file handle
         automatically.
         """
+        # Watch the file before reading, so writes after reading are not missed
+        self.__get_watcher__()
 
         while True:
-            try:
-                if self.stat is not None and os.stat(self.path).st_ino != self.stat.st_ino:
-                    self.close()
+            if self.__check_file:
+                self.__check_file = False
+                self.__check_rotation__()
 
-                if self.fd is not None:
-                    if self.pos > 0 and self.pos > os.stat(self.path).st_size:
-                        self.load()
-
-            except IOError:
-                self.close()
-            except OSError:
-                self.close()
+            if self.__lines:
+                line = self.__lines.popleft()
+                if self.checkpoints is not None:
+                    self.__consume__([line])
+                try:
+                    return self.__format_line__(line.rstrip())
+                except Exception:
+                    continue
 
             if self.fd is None:
                 self.load()
@@ -122,13 +1035,19 @@ class TailReader(object):
             if self.fd is not None:
                 try:
                     line = self.fd.readline()
+                    if self.__partial:
+                        line = self.__partial + line
+                        self.__partial = ''
 
                     if line != '':
+                        self.__eof = False
+                        if self.checkpoints is not None:
+                            self.offset += len(line.encode(self.__encoding))
                         try:
                             return self.__format_line__(line.rstrip())
                         except Exception:
                             # Skip exceptions formatting lines, likely just corrupted
-                            pass
+                            continue
 
                 except IOError as e:
                     raise TailReaderError('Error opening {}: {}'.format(self.path, e))
@@ -137,10 +1056,375 @@ class TailReader(object):
 
                 try:
                     self.pos = self.fd.tell()
+                    self.__eof = True
 
                 except IOError as e:
                     raise TailReaderError('Error reading {}: {}'.format(self.path, e))
                 except OSError as e:
                     raise TailReaderError('Error reading {}: {}'.format(self.path, e))
 
-            time.sleep(INTERVAL)
+            self.__wait__()
+
+
+class MultiTailReader(object):
+    """Multiple file tail reader
+
+    Follows many files from a single thread. One watcher is shared by all
+    files, and only files reported changed by the watcher are read, so with
+    inotify idle files cost nothing. Rotation and truncation are handled
+    like in TailReader.
+
+    Iterating the object or calling readline() returns tuples (path, line)
+    in order of arrival. Files with more than max_lines lines available are
+    read in turns, max_lines lines at a time.
+
+    Lines are formatted with the reader class, created with reader_options.
+    With checkpoints in reader_options, commit() records positions of lines
+    returned so far for all files.
+    """
+    reader = TailReader
+
+    def __init__(self, paths=None, backend=None, max_lines=DEFAULT_MAX_LINES, **reader_options):
+        self.backend = backend
+        self.max_lines = max_lines
+        self.reader_options = reader_options
+        self.watcher = tail_watcher(backend)
+        self.readers = collections.OrderedDict()
+        self.__pending = collections.deque()
+        self.__ready = collections.OrderedDict()
+        self.__queued = {}
+        self.__positions = {}
+        for path in paths or ():
+            self.add(path)
+
+    def __repr__(self):
+        return 'tail {:d} files'.format(len(self.readers))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.readline()
+
+    def next(self):
+        return self.readline()
+
+    def add(self, path):
+        """Add file
+
+        Start following path. Existing lines in the file are returned, use
+        seek_to_end() to skip them.
+        """
+        key = os.path.abspath(path)
+        if key in self.readers:
+            return self.readers[key]
+        reader = self.reader(path, backend=self.backend, **self.reader_options)
+        try:
+            self.watcher.watch(key)
+        except TailReaderError as e:
+            if self.watcher.backend == 'inotify' and self.backend is None:
+                # Fall back to polling all files
+                logger.warning('Polling files for changes, error watching {}: {}'.format(key, e))
+                self.watcher.close()
+                self.watcher = PollWatcher()
+                for existing in self.readers:
+                    self.watcher.watch(existing)
+                self.watcher.watch(key)
+            else:
+                raise
+        reader.watcher = self.watcher
+        self.readers[key] = reader
+        self.__ready[key] = True
+        return reader
+
+    def remove(self, path):
+        """Remove file
+
+        Stop following path
+        """
+        key = os.path.abspath(path)
+        reader = self.readers.pop(key, None)
+        if reader is not None:
+            self.watcher.unwatch(key)
+            self.__ready.pop(key, None)
+            self.__queued.pop(key, None)
+            self.__positions.pop(key, None)
+            self.__pending = collections.deque(item for item in self.__pending if item[0] != reader.path)
+            reader.close()
+
+    def seek_to_end(self):
+        """Jump to end of files
+
+        Skip lines in files before tailing
+        """
+        self.__pending.clear()
+        self.__queued.clear()
+        self.__positions.clear()
+        for key, reader in self.readers.items():
+            reader.__seek_end__()
+            self.__ready.pop(key, None)
+            if reader.checkpoints is not None:
+                self.__queued[key] = 0
+                self.__positions[key] = collections.deque([(0, reader.__position__())])
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+        self.watcher.close()
+        self.readers.clear()
+        self.__pending.clear()
+        self.__queued.clear()
+        self.__positions.clear()
+        self.__ready.clear()
+
+    def __read_ready__(self):
+        """Read files with changes
+
+        Read lines from next file with changes to pending lines
+        """
+        key, check = self.__ready.popitem(last=False)
+        reader = self.readers.get(key)
+        if reader is None:
+            return
+        lines = reader.__read_lines__(self.max_lines, check=check)
+        if reader.__pending__():
+            # More lines are available, read again after other files
+            self.__ready[key] = False
+        self.__pending.extend((reader.path, line) for line in lines)
+        if reader.checkpoints is not None:
+            # Position after the batch can be committed when its lines are returned
+            queued = self.__queued.get(key, 0) + len(lines)
+            self.__queued[key] = queued
+            self.__positions.setdefault(key, collections.deque()).append((queued, reader.__position__()))
+
+    def __fill__(self, timeout=None):
+        """Fill pending lines
+
+        Read files with changes until lines are available, waiting up to
+        timeout seconds for changes, or forever if timeout is None
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        checked = False
+        while not self.__pending:
+            if self.__ready:
+                self.__read_ready__()
+                continue
+            if not self.readers:
+                raise TailReaderError('No files to follow')
+
+            if deadline is None:
+                changed = self.watcher.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    changed = self.watcher.wait(min(remaining, self.watcher.interval))
+                elif not checked:
+                    # Check for changes once without waiting
+                    changed = self.watcher.read()
+                    checked = True
+                else:
+                    return
+            for key in changed:
+                self.__ready[key] = True
+
+    def poll(self, timeout=0):
+        """Read lines
+
+        Wait up to timeout seconds for lines, or forever if timeout is None.
+        Returns list of (path, line) tuples available now, empty list on timeout.
+        """
+        self.__fill__(timeout)
+        lines = list(self.__pending)
+        self.__pending.clear()
+        return lines
+
+    def readline(self):
+        """Read line
+
+        Returns next tuple (path, line), waiting for data if necessary
+        """
+        self.__fill__()
+        return self.__pending.popleft()
+
+    def commit(self):
+        """Commit positions
+
+        Record positions of files to checkpoints. Lines read from a file but
+        not returned yet are not committed, so the position is recorded after
+        the last batch of lines returned completely.
+        """
+        remaining = collections.Counter(item[0] for item in self.__pending)
+        for key, positions in self.__positions.items():
+            reader = self.readers[key]
+            returned = self.__queued[key] - remaining[reader.path]
+            position = None
+            while positions and positions[0][0] <= returned:
+                position = positions.popleft()[1]
+            if position is not None:
+                reader.checkpoints.update(reader.path, *position)
+
+
+class AsyncTailReader(object):
+    """Asyncio file tail reader
+
+    Tail reader for asyncio: use 'async for line in reader' or await
+    readline() or read(). Waiting for new data does not block the event
+    loop: with inotify the watcher file descriptor is added to the loop,
+    otherwise the file is polled with asyncio.sleep. Rotation and truncation
+    are checked after each wait like in TailReader.
+
+    Lines are read and formatted with a reader object, by default TailReader
+    created with reader_options. Reading is driven by the consumer: the file is
+    only read when lines buffered from previous read are consumed, and at most
+    max_lines lines are buffered, so a slow consumer leaves unread data in
+    the file instead of in memory.
+    """
+    reader = TailReader
+
+    def __init__(self, path, backend=None, max_lines=DEFAULT_MAX_LINES, **reader_options):
+        self.path = path
+        self.max_lines = max_lines
+        self.tail = self.reader(path, backend=backend, **reader_options)
+        self.buffer = collections.deque()
+        self.__loop = None
+        self.__changed = None
+        self.__check = False
+        self.__position = None
+
+    def __repr__(self):
+        return 'async tail {}'.format(self.path)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.readline()
+
+    @property
+    def buffered(self):
+        """Number of lines read from file but not consumed
+
+        """
+        return len(self.buffer)
+
+    def __on_events__(self):
+        # Events must be read here, the descriptor stays readable until drained
+        if self.tail.watcher.read():
+            self.__changed.set()
+
+    def __watch__(self):
+        """Register watcher to event loop
+
+        Returns the watcher
+        """
+        watcher = self.tail.__get_watcher__()
+        if self.__loop is None:
+            self.__loop = asyncio.get_running_loop()
+            self.__changed = asyncio.Event()
+            if watcher.fileno() is not None:
+                watcher.add_reader(self.__loop, self.__on_events__)
+        return watcher
+
+    async def __wait__(self, timeout=None):
+        """Wait for file changes
+
+        Wait up to timeout seconds, or the watcher interval if shorter
+        """
+        watcher = self.__watch__()
+        interval = watcher.interval if timeout is None else min(timeout, watcher.interval)
+        if watcher.fileno() is None:
+            await asyncio.sleep(interval)
+        else:
+            try:
+                await asyncio.wait_for(self.__changed.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self.__changed.clear()
+            watcher.read()
+        self.__check = True
+
+    async def __fill__(self, timeout=None):
+        """Fill buffer
+
+        Read lines to the buffer, waiting up to timeout seconds for data, or
+        forever if timeout is None
+        """
+        self.__watch__()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        while not self.buffer:
+            # All lines read before have been returned
+            self.__position = self.tail.__position__()
+            self.buffer.extend(self.tail.__read_lines__(self.max_lines, check=self.__check))
+            self.__check = False
+            if self.buffer:
+                break
+            if self.tail.__pending__():
+                # Yield to other tasks while catching up
+                await asyncio.sleep(0)
+                continue
+            if deadline is None:
+                await self.__wait__()
+            else:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                await self.__wait__(remaining)
+
+    async def readline(self):
+        """Read line
+
+        Returns next formatted line, waiting for data without blocking the
+        event loop
+        """
+        await self.__fill__()
+        return self.buffer.popleft()
+
+    async def read(self, timeout=None):
+        """Read lines
+
+        Returns list of up to max_lines formatted lines, waiting up to timeout
+        seconds for data, or forever if timeout is None. Returns empty list
+        on timeout.
+        """
+        await self.__fill__(timeout)
+        lines = list(self.buffer)
+        self.buffer.clear()
+        return lines
+
+    def seek_to_end(self):
+        """Jump to end of file
+
+        Skip existing lines without waiting. If the file does not exist yet,
+        it is read from start when created.
+        """
+        self.buffer.clear()
+        self.tail.__seek_end__()
+
+    def commit(self):
+        """Commit position
+
+        Record position to checkpoints of the reader. Lines in the buffer are
+        not committed, so the position is recorded after the last batch of
+        lines returned completely.
+        """
+        if self.tail.checkpoints is None:
+            raise TailReaderError('No checkpoints for {}'.format(self.path))
+        position = self.tail.__position__() if not self.buffer else self.__position
+        if position is not None:
+            self.tail.checkpoints.update(self.tail.path, *position)
+
+    def close(self):
+        """Close reader
+
+        Remove the watcher from event loop and close the file
+        """
+        watcher = self.tail.watcher
+        if watcher is not None:
+            if self.__loop is not None and watcher.fileno() is not None:
+                watcher.remove_reader(self.__loop)
+            watcher.close()
+            self.tail.watcher = None
+        self.__loop = None
+        self.tail.close()
+        self.buffer.clear()
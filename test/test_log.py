@@ -0,0 +1,927 @@
+"""
+Unit tests for syslog file parsers
+"""
+
+import gzip
+import os
+import pytest
+
+TEST_LOG_LINES = (
+    'Oct 16 10:00:01 host1 sshd[123]: Accepted publickey for root from 10.0.0.1',
+    '    continuation of previous entry',
+    'Oct 16 10:00:02 host2 cron[5]: (root) CMD (run-parts /etc/cron.hourly)',
+    'Oct 16 10:00:03 host1 kernel: eth0: link up',
+    'Oct 16 10:00:04 host2 sshd[124]: Connection closed by 10.0.0.2',
+)
+
+
+def write_logfile(tmpdir, name='messages', lines=TEST_LOG_LINES, compress=False):
+    """Write test log file
+
+    Returns path to the written file
+    """
+    path = os.path.join('{}'.format(tmpdir), name)
+    data = '\n'.join(lines) + '\n'
+    if compress:
+        with gzip.open(path, 'wt') as fd:
+            fd.write(data)
+    else:
+        with open(path, 'w') as fd:
+            fd.write(data)
+    return path
+
+
+def test_logfile_cached(tmpdir):
+    """Iterate cached logfile
+
+    """
+    from systematic.log import LogFile
+
+    logfile = LogFile(write_logfile(tmpdir))
+    entries = [entry for entry in logfile]
+    assert len(entries) == 4
+    assert len(logfile) == 4
+    assert entries[0].message.endswith('continuation of previous entry')
+    assert [x.pid for x in logfile.filter_program('sshd')] == ['123', '124']
+    assert len(logfile.filter_host('host1')) == 2
+
+
+def test_logfile_streaming(tmpdir):
+    """Iterate logfile in streaming mode
+
+    """
+    from systematic.log import LogFile
+
+    logfile = LogFile(write_logfile(tmpdir), streaming=True)
+    entries = [entry for entry in logfile]
+    assert len(entries) == 4
+    assert len(logfile) == 0
+    message_lines = entries[0].message.split('\n')
+    assert message_lines[0] == 'Accepted publickey for root from 10.0.0.1'
+    assert message_lines[1].strip() == 'continuation of previous entry'
+
+    # Each pass reads the file again
+    assert len([entry for entry in logfile]) == 4
+    assert len(logfile.filter_host('host2')) == 2
+    assert len(logfile.match_message(r'^Connection closed by (?P<address>.*)$')) == 1
+    assert len(logfile) == 0
+
+
+def test_logfile_collection_streaming(tmpdir):
+    """Stream logfile collection
+
+    """
+    from systematic.log import LogFileCollection
+
+    paths = (
+        write_logfile(tmpdir, 'messages.1.gz', compress=True),
+        write_logfile(tmpdir, 'messages'),
+    )
+    collection = LogFileCollection(paths, streaming=True)
+    assert len([entry for entry in collection]) == 8
+    assert len(list(collection.stream())) == 8
+    assert len(collection.filter_program('sshd')) == 4
+    assert all(len(logfile) == 0 for logfile in collection.logfiles)
+
+
+def test_parse_syslog_timestamp():
+    """Parse syslog timestamps
+
+    """
+    from datetime import datetime
+    from systematic.log import parse_syslog_timestamp
+
+    for month, day, time in (('Oct', '16', '10:00:01'), ('Feb', '1', '00:00:00'), ('dec', '31', '23:59:59')):
+        expected = datetime.strptime('2020 {} {} {}'.format(month, day, time), '%Y %b %d %H:%M:%S')
+        assert parse_syslog_timestamp(2020, month, day, time) == expected
+
+    for month, day, time in (('Foo', '16', '10:00:01'), ('Feb', '30', '10:00:00'), ('Oct', '16', '24:00:00')):
+        with pytest.raises(ValueError):
+            parse_syslog_timestamp(2020, month, day, time)
+
+
+def test_source_matcher():
+    """Match source formats
+
+    Combined matcher must return same fields as matching formats in order
+    """
+    import re
+    from systematic.log import SourceMatcher, SOURCE_FORMATS
+
+    custom_formats = [
+        re.compile(r'^(?P<program>[a-z]+)\[(?P<pid>\d+)\]$'),
+        re.compile(r'^(?P<program>[a-z]+)$', re.IGNORECASE),
+    ]
+    sources = (
+        'host1 sshd[123]',
+        'host1 kernel',
+        '<13> host1 cron[5]',
+        '<3.4> host1 sudo',
+        '<3.4>x host1 sudo',
+        'host1 prog[abc]',
+        'sshd[1]',
+        'nomatch',
+    )
+    for source_formats in (SOURCE_FORMATS, custom_formats):
+        matcher = SourceMatcher.get(source_formats)
+        assert SourceMatcher.get(source_formats) is matcher
+        for source in sources:
+            expected = None
+            for fmt in source_formats:
+                m = fmt.match(source)
+                if m:
+                    expected = m.groupdict()
+                    break
+            assert matcher.match(source) == expected
+
+
+def test_logentry_lazy_decoding():
+    """Decode log entry fields on access
+
+    """
+    import re
+    from systematic.log import LogEntry, LogFileError, SOURCE_FORMATS
+
+    entry = LogEntry(None, TEST_LOG_LINES[0] + '\n', 2020, SOURCE_FORMATS)
+    assert not hasattr(entry, '__dict__')
+    assert entry._time is None and entry._fields is None
+
+    entry.append(TEST_LOG_LINES[1])
+    assert entry.program == 'sshd'
+    assert entry._time is None
+    assert entry.time.year == 2020
+    assert entry.pid == '123'
+    assert entry.host == 'host1'
+    assert entry.message.split('\n')[1].strip() == 'continuation of previous entry'
+    assert entry.message_fields == {}
+
+    entry = LogEntry(None, 'Oct 16 10:00:01 <1.2> host1 cron[1]: test', 2020, [
+        re.compile(r'^<(?P<facility>\d+)\.(?P<level>\d+)>\s+(?P<host>[^\s]+)\s+(?P<program>[^\[]+)\[(?P<pid>\d+)\]$'),
+    ])
+    assert entry.facility == '1'
+    assert entry.level == '2'
+    assert not hasattr(entry, 'category')
+
+    entry = LogEntry(None, 'Foo 16 10:00:01 host1 kernel: test', 2020, SOURCE_FORMATS)
+    assert entry.program == 'kernel'
+    with pytest.raises(LogFileError):
+        entry.time
+    with pytest.raises(LogFileError):
+        LogEntry(None, 'invalid line', 2020, SOURCE_FORMATS).decode()
+
+
+def test_logfile_collection_workers(tmpdir):
+    """Filter logfile collection with worker processes
+
+    """
+    from systematic.log import LogFileCollection
+
+    paths = [write_logfile(tmpdir, 'messages.{:d}'.format(index)) for index in range(4)]
+    serial = LogFileCollection(paths)
+    parallel = LogFileCollection(paths, workers=2)
+    assert parallel.parallel
+
+    for method, args in (
+            ('filter_host', ('host1', )),
+            ('filter_program', ('sshd', )),
+            ('filter_message', ('^Connection', ))):
+        expected = getattr(serial, method)(*args)
+        result = getattr(parallel, method)(*args)
+        assert [(x.logfile.path, x.line) for x in result] == [(x.logfile.path, x.line) for x in expected]
+        assert [x.message for x in result] == [x.message for x in expected]
+
+    assert parallel.match_message(r'^Connection closed by (?P<address>.*)$') == [{'address': '10.0.0.2'}] * 4
+    assert [x.line for x in parallel.stream()] == [x.line for x in serial.stream()]
+
+
+def test_logfile_index(tmpdir):
+    """Query indexed logfile
+
+    """
+    from datetime import datetime
+    from systematic.log import LogFile, LogFileCollection
+
+    path = write_logfile(tmpdir)
+    logfile = LogFile(path, index=True)
+    unindexed = LogFile(path)
+
+    assert [x.line for x in logfile.filter_host('host2')] == [x.line for x in unindexed.filter_host('host2')]
+    assert [x.line for x in logfile.filter_program('sshd')] == [x.line for x in unindexed.filter_program('sshd')]
+    assert logfile.filter_host('unknown') == []
+    assert len(logfile.index.times) == 4
+
+    year = logfile[0].time.year
+    start = datetime(year, 10, 16, 10, 0, 2)
+    end = datetime(year, 10, 16, 10, 0, 4)
+    assert [x.program for x in logfile.between(start, end)] == ['cron', 'kernel']
+    assert [x.program for x in unindexed.between(start, end)] == ['cron', 'kernel']
+    assert len(logfile.between(start)) == 3
+    assert len(logfile.between(end=start)) == 1
+
+    collection = LogFileCollection([path], index=True)
+    assert len(collection.between(start, end)) == 2
+
+
+def test_logfile_sidecar_index(tmpdir, monkeypatch):
+    """Query logfile with sidecar index
+
+    """
+    from datetime import datetime
+    from systematic.log import LogFile, LogFileCollection
+    from systematic.logindex import LogFileSidecarIndex
+    from systematic.logreader import PipelinedReader
+
+    lines = ['Oct 16 10:{:02d}:00 host{:d} prog{:d}[1]: message {:d}'.format(i, i // 5, i % 3, i) for i in range(20)]
+    path = write_logfile(tmpdir, 'messages.1.gz', lines=lines, compress=True)
+    index_directory = os.path.join('{}'.format(tmpdir), 'index')
+
+    index = LogFileSidecarIndex(LogFile(path), index_directory, block_entries=5)
+    assert len(index.blocks) == 4
+    assert os.path.isfile(index.index_path)
+    assert len(index.match(host='host2')) == 1
+    assert index.match(host='host9') == []
+    year = index.first_time.year
+    assert len(index.match(start=datetime(year, 10, 16, 10, 12), end=datetime(year, 10, 16, 10, 14))) == 1
+
+    logfile = LogFile(path, streaming=True, sidecar_index=True, index_directory=index_directory)
+    assert [x.line for x in logfile.filter_host('host3')] == lines[15:]
+    assert [x.line for x in logfile.filter_program('prog1')] == lines[1::3]
+    assert logfile.filter_host('host9') == []
+    assert len(logfile.between(datetime(year, 10, 16, 10, 12), datetime(year, 10, 16, 10, 14))) == 2
+
+    # Compressed blocks are read forward, decompressing the file once
+    many = ['Oct 16 10:{:02d}:00 host1 prog{:d}[1]: message {:d}'.format(i % 60, i % 3, i) for i in range(10000)]
+    many_logfile = LogFile(
+        write_logfile(tmpdir, 'many.1.gz', lines=many, compress=True),
+        streaming=True, sidecar_index=True, index_directory=index_directory
+    )
+    assert len(many_logfile.filter_host('host1', limit=1)) == 1
+    starts = []
+    start = PipelinedReader.__start__
+    monkeypatch.setattr(PipelinedReader, '__start__', lambda reader: starts.append(True) or start(reader))
+    assert [x.line for x in many_logfile.filter_program('prog1', limit=3000, from_end=True)] == many[1::3][-3000:]
+    assert len(starts) == 1
+    monkeypatch.undo()
+
+    # Changed file invalidates the index
+    path = write_logfile(tmpdir, 'messages.1.gz', lines=lines[:10], compress=True)
+    os.utime(path, (0, 0))
+    assert logfile.filter_host('host3') == []
+    assert len(logfile.filter_host('host1')) == 5
+
+    collection = LogFileCollection([path], sidecar_index=True)
+    assert len(collection.filter_host('host0')) == 5
+    assert os.path.isfile(os.path.join('{}'.format(tmpdir), '.messages.1.gz.idx'))
+
+
+def test_logfile_incremental_reload(tmpdir):
+    """Reload appended logfile incrementally
+
+    """
+    from systematic.log import LogFile
+
+    path = write_logfile(tmpdir)
+    logfile = LogFile(path, index=True)
+    logfile.reload(incremental=True)
+    assert len(logfile) == 4
+    first = logfile[0]
+
+    with open(path, 'a') as fd:
+        fd.write('    appended continuation\n')
+        fd.write('Oct 16 10:00:05 host3 cron[6]: appended')
+    logfile.reload(incremental=True)
+    assert len(logfile) == 5
+    assert logfile[0] is first
+    assert logfile[3].message.split('\n')[-1].strip() == 'appended continuation'
+    assert [x.message for x in logfile.filter_host('host3')] == ['appended']
+
+    # Incomplete last line is parsed again when completed
+    with open(path, 'a') as fd:
+        fd.write(' line\n')
+    logfile.reload(incremental=True)
+    assert len(logfile) == 5
+    assert [x.message for x in logfile.filter_host('host3')] == ['appended line']
+    assert len(logfile.filter_program('cron')) == 2
+
+    # Truncated file is loaded again
+    write_logfile(tmpdir, lines=TEST_LOG_LINES[:1])
+    logfile.reload(incremental=True)
+    assert len(logfile) == 1
+    assert logfile[0] is not first
+
+    # File truncated and written again past the loaded size is loaded again
+    write_logfile(tmpdir)
+    logfile.reload(incremental=True)
+    assert len(logfile) == 4
+    lines = ['Oct 16 11:00:{:02d} host4 cron[7]: written after truncate'.format(i) for i in range(10)]
+    with open(path, 'w') as fd:
+        fd.write('\n'.join(lines) + '\n')
+    logfile.reload(incremental=True)
+    assert len(logfile) == 10
+    assert [x.host for x in logfile] == ['host4'] * 10
+
+
+def test_logfile_iterators(tmpdir):
+    """Iterate logfile with named iterators
+
+    """
+    import sys
+    from systematic.log import LogFile, LogFileCursor, LogFileError
+
+    logfile = LogFile(write_logfile(tmpdir))
+    cursor = logfile.register_iterator('first')
+    assert isinstance(cursor, LogFileCursor)
+    logfile.register_iterator('second', callback=lambda entry: entry.host == 'host2')
+    with pytest.raises(LogFileError):
+        logfile.register_iterator('first')
+
+    assert logfile.next_iterator_match('first').program == 'sshd'
+    assert logfile.next_iterator_match('second').program == 'cron'
+    assert logfile.next_iterator_match('first').program == 'cron'
+    assert logfile.get_iterator('first') == 2
+    assert [x.program for x in logfile.next_n('first', 5)] == ['kernel', 'sshd']
+    assert logfile.next_n('first', 5) == []
+    assert [x.program for x in logfile.next_n('first', 3)] == ['sshd', 'cron', 'kernel']
+    assert [x.pid for x in logfile.next_n('second', 5)] == ['124']
+    with pytest.raises(StopIteration):
+        logfile.next_iterator_match('second')
+    assert [x.host for x in cursor] == ['host2']
+
+    # Continuation lines are not read recursively
+    lines = [TEST_LOG_LINES[0]] + ['    line {:d}'.format(i) for i in range(sys.getrecursionlimit() * 2)]
+    logfile = LogFile(write_logfile(tmpdir, 'multiline', lines=lines))
+    assert len(logfile.next_n('default', 10)) == 1
+
+
+def test_message_matcher(tmpdir):
+    """Match messages with multiple rules
+
+    """
+    import re
+    from systematic.log import LogFile, LogFileCollection, MessageMatcher, regexp_literals
+
+    assert regexp_literals(r'^Accepted (?P<method>\w+) for') == ('Accepted ', 'Accepted ')
+    assert regexp_literals(r'.*Failed (password|key)') == ('', 'Failed ')
+    assert regexp_literals(r'(?i)accepted') == ('', '')
+    assert regexp_literals(r'a|b') == ('', '')
+
+    rules = {
+        'accepted': r'^Accepted (?P<method>\w+) for (?P<user>\w+)',
+        'closed': re.compile(r'Connection closed by (?P<address>[\d.]+)'),
+        'link': r'.*link (?P<state>up|down)',
+        'anything': r'.*',
+        'ignorecase': re.compile(r'CONNECTION', re.IGNORECASE),
+        'never': r'^never matches',
+    }
+    matcher = MessageMatcher(rules)
+    logfile = LogFile(write_logfile(tmpdir))
+    for entry in logfile:
+        expected = {}
+        for name, regexp in rules.items():
+            m = re.match(regexp, entry.message)
+            if m:
+                expected[name] = m.groupdict()
+        assert matcher.match(entry.message) == expected
+
+    results = logfile.match_rules(rules)
+    assert len(results) == 4
+    assert results[0][1]['accepted'] == {'method': 'publickey', 'user': 'root'}
+    assert sorted(results[3][1].keys()) == ['anything', 'closed', 'ignorecase']
+
+    paths = [write_logfile(tmpdir, 'messages.{:d}'.format(index)) for index in range(2)]
+    results = LogFileCollection(paths, workers=2).match_rules({'link': rules['link']})
+    assert [(entry.logfile.path, matches) for entry, matches in results] == [
+        (path, {'link': {'state': 'up'}}) for path in paths
+    ]
+
+
+def test_logfile_seek_time(tmpdir):
+    """Seek logfile to time
+
+    """
+    import time
+    from datetime import datetime
+    from systematic.log import LogFile
+
+    lines = []
+    for index in range(5000):
+        lines.append('Oct 16 {:02d}:{:02d}:{:02d} host1 prog[1]: message {:d}'.format(
+            index // 3600, index // 60 % 60, index % 60, index
+        ))
+        if index % 7 == 0:
+            lines.append('    continuation {:d}'.format(index))
+    path = write_logfile(tmpdir, lines=lines)
+    year = datetime.fromtimestamp(os.stat(path).st_mtime).year
+
+    for streaming in (False, True):
+        logfile = LogFile(path, streaming=streaming)
+        offset = logfile.seek_time(datetime(year, 10, 16, 1, 0, 5))
+        assert offset > 0
+        entries = [entry for entry in logfile]
+        assert len(entries) == 5000 - 3605
+        assert entries[0].message == 'message 3605\n    continuation 3605'
+
+    logfile = LogFile(path)
+    logfile.seek_time(datetime(year, 10, 17))
+    assert [entry for entry in logfile] == []
+    logfile.seek_time(datetime(year, 1, 1))
+    assert len([entry for entry in logfile]) == 5000
+
+    path = write_logfile(tmpdir, 'messages.1.gz', lines=lines, compress=True)
+    logfile = LogFile(path)
+    logfile.seek_time(datetime(year, 10, 16, 1, 6, 40))
+    assert logfile.next().message == 'message 4000'
+
+    # Entries after file mtime are from previous year
+    lines = ['Dec 31 23:59:{:02d} host1 prog: old {:d}'.format(i, i) for i in range(50)]
+    lines += ['Jan  1 00:00:{:02d} host1 prog: new {:d}'.format(i, i) for i in range(50)]
+    path = write_logfile(tmpdir, 'rollover', lines=lines)
+    mtime = time.mktime((2021, 1, 2, 0, 0, 0, 0, 0, -1))
+    os.utime(path, (mtime, mtime))
+    logfile = LogFile(path)
+    logfile.seek_time(datetime(2021, 1, 1))
+    assert logfile.next().message == 'new 0'
+    logfile.seek_time(datetime(2020, 12, 31, 23, 59, 30))
+    assert logfile.next().message == 'old 30'
+
+
+def test_logentry_lazy_decode(tmpdir):
+    """Decode entry lines on first access
+
+    """
+    from systematic.log import LogFile
+
+    path = write_logfile(tmpdir)
+    for streaming in (False, True):
+        entries = [entry for entry in LogFile(path, streaming=streaming)]
+        assert isinstance(entries[1]._line, bytes)
+        assert entries[1].program == 'cron'
+        assert entries[1].line == TEST_LOG_LINES[2]
+        assert isinstance(entries[1]._line, str)
+
+
+def test_logfile_compression_codecs(tmpdir):
+    """Read compressed logfiles with pipelined reader
+
+    """
+    import bz2
+    import lzma
+    from systematic.log import LogFile, LogFileError
+    from systematic.logreader import PipelinedReader, has_zstd, zstd
+
+    data = ('\n'.join(TEST_LOG_LINES) + '\n').encode('utf-8')
+    expected = [(x.line, x.message) for x in LogFile(write_logfile(tmpdir))]
+    compressed = {
+        'gzip': gzip.compress(data[:100]) + gzip.compress(data[100:]),
+        'bz2': bz2.compress(data),
+        'xz': lzma.compress(data),
+    }
+    if has_zstd:
+        compressed['zstd'] = zstd.compress(data) if hasattr(zstd, 'compress') else zstd.ZstdCompressor().compress(data)
+
+    for codec, value in compressed.items():
+        path = os.path.join('{}'.format(tmpdir), 'messages.{}'.format(codec))
+        with open(path, 'wb') as fd:
+            fd.write(value)
+
+        logfile = LogFile(path, streaming=True)
+        assert [(x.line, x.message) for x in logfile] == expected
+
+        reader = PipelinedReader(path, codec, chunk_size=7, queue_size=1)
+        assert reader.read() == data
+        assert reader.seek(10) == 10
+        assert reader.readline() == data[10:data.index(b'\n') + 1]
+        assert reader.seek(0, os.SEEK_CUR) == data.index(b'\n') + 1
+        reader.close()
+
+    if not has_zstd:
+        path = os.path.join('{}'.format(tmpdir), 'messages.zst')
+        with open(path, 'wb') as fd:
+            fd.write(b'\x28\xb5\x2f\xfd' + data)
+        with pytest.raises(LogFileError):
+            LogFile(path).reload()
+
+
+def test_logfile_format_detection(tmpdir):
+    """Detect logfile compression from magic bytes
+
+    """
+    import bz2
+    from systematic.log import LogFile, LogFileError
+    from systematic.logreader import PipelinedReader, detect_compression, _FORMAT_CACHE
+
+    plain = write_logfile(tmpdir)
+    compressed = write_logfile(tmpdir, 'messages.1.gz', compress=True)
+    with open(plain, 'rb') as fd:
+        assert detect_compression(fd) is None
+        assert fd.tell() == 0
+    with open(compressed, 'rb') as fd:
+        assert detect_compression(fd, compressed) == 'gzip'
+    with open(compressed, 'rb') as fd:
+        st = os.fstat(fd.fileno())
+        assert _FORMAT_CACHE[(compressed, st.st_ino, st.st_dev, st.st_mtime_ns)] == 'gzip'
+
+    # Cached format is not used after the file is modified
+    with open(compressed, 'wb') as fd:
+        fd.write(bz2.compress(('\n'.join(TEST_LOG_LINES) + '\n').encode('utf-8')))
+    os.utime(compressed, ns=(0, 0))
+    logfile = LogFile(compressed)
+    fd = logfile.__open_logfile__(compressed)
+    assert isinstance(fd, PipelinedReader) and fd.codec == 'bz2'
+    fd.close()
+    assert len(logfile.filter_program('sshd')) == 2
+
+    # Corrupted compressed data
+    with open(compressed, 'wb') as fd:
+        fd.write(b'\x1f\x8b' + b'x' * 100)
+    with pytest.raises(LogFileError):
+        LogFile(compressed).reload()
+
+
+def test_logfile_collection_merged(tmpdir):
+    """Merge collection entries by time
+
+    """
+    from systematic.log import LogFileCollection
+
+    paths = []
+    for host in range(3):
+        lines = [
+            'Oct 16 10:{:02d}:{:02d} host{:d} prog[1]: message {:d}'.format(index, host, host, index)
+            for index in range(host, 30, 2)
+        ]
+        if host == 1:
+            lines.insert(3, 'Foo 16 10:00:00 host1 prog[1]: invalid time')
+        paths.append(write_logfile(tmpdir, 'host{:d}.log.gz'.format(host), lines=lines, compress=host == 2))
+
+    collection = LogFileCollection(paths)
+    entries = list(collection.merged())
+    assert len(entries) == len(list(collection.stream()))
+    assert [x.line for x in entries if x.message == 'invalid time'] == [
+        'Foo 16 10:00:00 host1 prog[1]: invalid time'
+    ]
+    times = [x.time for x in entries if x.message != 'invalid time']
+    assert times == sorted(times)
+    assert [x.host for x in entries[:4]] == ['host0', 'host1', 'host0', 'host2']
+    assert entries[7].message == 'message 5' and entries[8].message == 'invalid time'
+    assert all(len(logfile) == 0 for logfile in collection.logfiles)
+
+
+def test_logfile_aggregate(tmpdir):
+    """Aggregate logfile entries
+
+    """
+    import json
+    from systematic.log import LogFile, LogFileCollection, LogFileError
+    from systematic.logaggregate import SpaceSavingCounter
+
+    lines = [
+        'Oct 16 10:{:02d}:{:02d} host{:d} prog{:d}[1]: message {:d}'.format(
+            index // 60, index % 60, index % 2, index % 3, index
+        )
+        for index in range(0, 180, 5)
+    ]
+    lines.append('Foo 16 10:00:00 host1 prog0[1]: invalid time')
+    path = write_logfile(tmpdir, lines=lines)
+
+    logfile = LogFile(path, streaming=True)
+    stats = logfile.aggregate(interval=60, group_by=('host', 'program'), top=2)
+    assert stats.entries == 36 and stats.skipped == 1
+    assert len(stats.buckets) == 3
+    assert all(counter.total == 12 for counter in stats.buckets.values())
+    assert stats.keys.count(('host0', 'prog0')) == 6
+    assert stats.estimate(host='host0', program='prog0') >= 6
+
+    data = json.loads(stats.to_json())
+    assert data['group_by'] == ['host', 'program']
+    assert len(data['top']) == 2 and data['top'][0]['count'] == 6
+    assert data['buckets'][0]['rate'] == 0.2
+    assert len(data['buckets'][0]['keys']) == 2
+    assert len(json.loads(stats.to_json(verbose=True))['buckets'][0]['keys']) == 6
+
+    stats = logfile.aggregate(group_by='program', callback=lambda entry: entry.host == 'host1')
+    assert stats.entries == 18
+    assert sum(counter.total for counter in stats.buckets.values()) == 18
+
+    # Callback errors skip the entry, callback is called for decoded entries
+    def callback(entry):
+        if entry.message == 'message 5':
+            raise LogFileError('invalid entry')
+        return entry.program is not None
+    stats = logfile.aggregate(callback=callback)
+    assert stats.entries == 35 and stats.skipped == 2
+
+    # Only latest buckets are kept with max_buckets
+    stats = logfile.aggregate(interval=60, max_buckets=2)
+    assert stats.entries == 36 and stats.dropped == 12
+    assert len(stats.buckets) == 2 and min(stats.buckets).minute == 1
+    assert stats.keys.count(('prog0', )) == 12
+
+    paths = [path, write_logfile(tmpdir, 'messages.1', lines=lines)]
+    serial = LogFileCollection(paths).aggregate(group_by='host')
+    parallel = LogFileCollection(paths, workers=2).aggregate(group_by='host')
+    assert serial.as_dict() == parallel.as_dict()
+    assert serial.keys.top() == [(('host0', ), 36, 0), (('host1', ), 36, 0)]
+
+    # Space-saving keeps heavy hitters with bounded memory
+    counter = SpaceSavingCounter(capacity=10)
+    for index in range(10000):
+        counter.add('heavy' if index % 3 == 0 else 'key{:d}'.format(index))
+    assert len(counter) == 10
+    key, count, error = counter.top(1)[0]
+    assert key == 'heavy' and count - error <= 3334 <= count
+
+
+def test_message_field_extractors(tmpdir):
+    """Extract message fields
+
+    """
+    import json
+    from systematic.log import LogFile, LogFileCollection
+    from systematic.logformats.extractors import default_extractors, MessageFieldExtractors
+
+    lines = TEST_LOG_LINES + (
+        'Oct 16 10:00:05 host1 sshd[125]: Failed password for invalid user admin from 10.0.0.3 port 2222 ssh2',
+        'Oct 16 10:00:06 host1 sudo:     root : TTY=pts/0 ; PWD=/root ; USER=nobody ; COMMAND=/bin/ls -l',
+        'Oct 16 10:00:07 host1 postfix/smtp[7]: 4BC1E2A0F1: to=<user@example.com>, '
+        'relay=mx.example.com[10.0.0.5]:25, delay=0.5, status=sent (250 OK)',
+        'Oct 16 10:00:08 host1 kernel: [ 12.345678] Out of memory: Killed process 1234 (java)',
+    )
+    extractors = default_extractors()
+    logfile = LogFile(write_logfile(tmpdir, lines=lines), extractors=extractors)
+    entries = list(logfile)
+    assert entries[0]._message_fields is None
+    assert entries[0].message_fields == {
+        'event': 'accepted', 'method': 'publickey', 'user': 'root', 'address': '10.0.0.1',
+    }
+    assert entries[1].message_fields == {}
+    assert entries[2].message_fields == {'event': 'link', 'interface': 'eth0', 'state': 'up'}
+    assert entries[3].message_fields == {'event': 'closed', 'address': '10.0.0.2'}
+    assert entries[4].message_fields['user'] == 'admin'
+    assert entries[5].message_fields['target_user'] == 'nobody'
+    assert entries[5].message_fields['command'] == '/bin/ls -l'
+    assert entries[6].message_fields['status'] == 'sent'
+    assert entries[7].message_fields == {'event': 'oom', 'pid': '1234', 'process': 'java'}
+
+    # Fields are memoised
+    assert entries[0].message_fields is entries[0].message_fields
+    entries[0].update_message_fields({'extra': 1})
+    assert entries[0].message_fields['extra'] == 1
+
+    assert [x.pid for x in logfile.filter_fields(event='failed')] == ['125']
+    assert [x.pid for x in logfile.filter_fields({'event': 'closed', 'address': '10.0.0.2'})] == ['124']
+
+    stats = dict((x['name'], x) for x in json.loads(extractors.to_json())['extractors'])
+    assert stats['sshd']['calls'] == 3 and stats['sshd']['matches'] == 3
+    assert stats['kernel']['match_rate'] == 1.0
+    assert stats['postfix']['calls'] == 1
+
+    assert LogFile(logfile.path, extractors=MessageFieldExtractors()).next().message_fields == {}
+    collection = LogFileCollection([logfile.path], workers=2)
+    assert len(collection.filter_fields(event='failed', user='admin')) == 1
+
+
+def test_icinga_log(tmpdir):
+    """Parse icinga logs
+
+    """
+    from datetime import datetime
+    from systematic.log import LogFileError
+    from systematic.logformats.nagios import IcingaLog, IcingaLogEntry, RE_ICINGA_LOG
+
+    lines = []
+    for index in range(3000):
+        epoch = 1600000000 + index * 10
+        if index % 3 == 0:
+            lines.append('[{:d}] SERVICE ALERT: host{:d};ping;OK;HARD;1;PING OK'.format(epoch, index % 4))
+        elif index % 3 == 1:
+            lines.append('[{:d}] HOST NOTIFICATION: admin;host{:d};DOWN;notify'.format(epoch, index % 4))
+        else:
+            lines.append('[{:d}] Auto-save of retention data completed successfully.'.format(epoch))
+    lines.append('[1600030000] message: with: colons')
+    lines.append('[1600030000] no category:colon')
+    path = write_logfile(tmpdir, 'icinga.log', lines=lines)
+
+    for line in lines[:3] + lines[-2:]:
+        entry = IcingaLogEntry(None, line + '\n')
+        for parser in RE_ICINGA_LOG:
+            m = parser.match(line)
+            if m:
+                break
+        fields = m.groupdict()
+        assert entry.epoch == int(fields['epoch'])
+        assert entry.category == fields.get('category', '')
+        assert entry.message == fields['message']
+        assert entry.time == datetime.fromtimestamp(int(fields['epoch']))
+    with pytest.raises(LogFileError):
+        IcingaLogEntry(None, '[123x] invalid').decode()
+
+    for index in (False, True):
+        logfile = IcingaLog(path, index=index)
+        assert len(logfile.filter_category('SERVICE ALERT')) == 1000
+        assert len(logfile.filter_category('')) == 1001
+        assert [x.message for x in logfile.filter_category('message')] == ['with: colons']
+        assert logfile.filter_category('UNKNOWN') == []
+        entries = logfile.between_epochs(1600000000 + 100, 1600000000 + 200)
+        assert [x.epoch for x in entries] == list(range(1600000100, 1600000200, 10))
+        assert len(logfile.between_epochs(1600029990)) == 3
+
+    logfile = IcingaLog(path, streaming=True)
+    assert len(logfile.filter_category('HOST NOTIFICATION')) == 1000
+    offset = logfile.seek_epoch(1600000000 + 15005)
+    assert offset > 0
+    assert logfile.next().epoch == 1600000000 + 15010
+
+
+def test_log_store(tmpdir):
+    """Export entries to sqlite store
+
+    """
+    from datetime import datetime
+    from systematic.log import LogFileCollection
+    from systematic.logstore import LogStore, LogStoreError
+
+    path = write_logfile(tmpdir)
+    store = LogStore(os.path.join('{}'.format(tmpdir), 'logs.sqlite'), batch_size=2)
+    assert store.append(path) == 4
+    assert store.append(path) == 0
+    assert store.count() == 4
+
+    entries = list(store.query(host='host1'))
+    assert [x['program'] for x in entries] == ['sshd', 'kernel']
+    assert entries[0]['message'].split('\n')[-1].strip() == 'continuation of previous entry'
+    assert entries[0]['message_fields']['event'] == 'accepted'
+    assert entries[0]['path'] == path
+    assert store.count(program='sshd', fields={'event': 'closed'}) == 1
+    assert store.count(start=datetime(1900, 10, 16, 10, 0, 2), end=datetime(1900, 10, 16, 10, 0, 4)) == 0
+    year = entries[0]['time'].year
+    assert store.count(start=datetime(year, 10, 16, 10, 0, 2), end=datetime(year, 10, 16, 10, 0, 4)) == 2
+    assert len(list(store.query(limit=3))) == 3
+    with pytest.raises(LogStoreError):
+        store.count(fields={'event\'': 'closed'})
+
+    # Appended lines and entries
+    with open(path, 'a') as fd:
+        fd.write('    appended continuation\n')
+        fd.write('Oct 16 10:00:05 host3 cron[6]: appended\n')
+    assert store.append(path) == 1
+    assert store.count() == 5
+    assert list(store.query(program='sshd'))[-1]['message'].endswith('appended continuation')
+
+    # Rotated and compressed file is recognized, new file is added
+    rotated = write_logfile(tmpdir, 'messages.1.gz', lines=TEST_LOG_LINES + (
+        '    appended continuation',
+        'Oct 16 10:00:05 host3 cron[6]: appended',
+        'Oct 16 10:00:06 host3 cron[6]: after rotation',
+    ), compress=True)
+    os.unlink(path)
+    write_logfile(tmpdir, lines=('Oct 16 10:01:00 host4 cron[7]: new file', ))
+    assert store.append(LogFileCollection([rotated, path], streaming=True)) == 2
+    assert store.count() == 7
+    assert sorted(x['path'] for x in store.files()) == [path, rotated]
+    assert store.append(LogFileCollection([rotated, path], streaming=True)) == 0
+
+    # Files with same first line are different files
+    first = write_logfile(tmpdir, 'first.log', lines=(
+        'Oct 16 10:02:00 host5 cron[8]: same first line',
+        'Oct 16 10:02:01 host5 cron[8]: first file',
+    ))
+    second = write_logfile(tmpdir, 'second.log', lines=(
+        'Oct 16 10:02:00 host5 cron[8]: same first line',
+        'Oct 16 10:02:01 host5 cron[8]: second file',
+        'Oct 16 10:02:02 host5 cron[8]: second file',
+    ))
+    assert store.append(first) == 2
+    assert store.append(second) == 3
+    assert store.count(host='host5') == 5
+    assert sorted(x['path'] for x in store.files()) == sorted([path, rotated, first, second])
+
+
+def test_logfile_json_lines(tmpdir):
+    """Write entries as JSON lines
+
+    """
+    import io
+    import json
+    from systematic.log import LogEntry, LogFile, LogFileCollection, LogFileError, write_json_lines
+
+    path = write_logfile(tmpdir)
+    logfile = LogFile(path)
+    entry = logfile.next()
+    data = json.loads(entry.to_json())
+    assert '\n' not in entry.to_json()
+    assert data['host'] == 'host1' and data['program'] == 'sshd' and data['pid'] == '123'
+    assert data['time'] == entry.time.strftime('%Y-%m-%d %H:%M:%S')
+    assert 'message_fields' not in data
+    assert entry.as_dict(verbose=True)['message_fields']['event'] == 'accepted'
+    with pytest.raises(LogFileError):
+        LogEntry(None, 'invalid', 2020, None).to_json()
+
+    fd = io.StringIO()
+    assert LogFile(path, streaming=True).write_json(fd) == 4
+    lines = fd.getvalue().splitlines()
+    assert [json.loads(x)['program'] for x in lines] == ['sshd', 'cron', 'kernel', 'sshd']
+
+    fd = io.BytesIO()
+    entries = [LogEntry(None, 'invalid', 2020, None)] + list(LogFile(path))
+    assert write_json_lines(entries, fd, verbose=True, buffer_size=100) == 5
+    lines = fd.getvalue().decode('utf-8').splitlines()
+    assert json.loads(lines[0]) == {'line': 'invalid'}
+    assert json.loads(lines[1])['message_fields']['user'] == 'root'
+
+    other = write_logfile(tmpdir, 'messages.1', lines=('Oct 16 10:00:02 host3 cron[9]: other', ))
+    collection = LogFileCollection([path, other], streaming=True)
+    for merged in (False, True):
+        fd = io.StringIO()
+        assert collection.write_json(fd, merged=merged) == 5
+        hosts = [json.loads(x)['host'] for x in fd.getvalue().splitlines()]
+        assert sorted(hosts) == ['host1', 'host1', 'host2', 'host2', 'host3']
+        assert (hosts[2] == 'host3') == merged
+
+
+def test_logfile_limited_queries(tmpdir):
+    """Limit, sample and read filter results from end
+
+    """
+    import random
+    from systematic.log import LogFile, LogFileError
+
+    lines = []
+    for index in range(1000):
+        lines.append('Oct 16 10:{:02d}:{:02d} host{:d} prog{:d}[{:d}]: message {:d}'.format(
+            index // 60 % 60, index % 60, index % 2, index % 3, index, index
+        ))
+        if index % 10 == 0:
+            lines.append('    continuation {:d}'.format(index))
+            lines.append('')
+    path = write_logfile(tmpdir, lines=lines)
+    compressed = write_logfile(tmpdir, 'messages.1.gz', lines=lines, compress=True)
+
+    for kwargs in ({}, {'index': True}, {'streaming': True}, {'sidecar_index': True}):
+        for filename in (path, compressed):
+            logfile = LogFile(filename, **kwargs)
+            entries = logfile.filter_host('host1', limit=3)
+            assert [x.pid for x in entries] == ['1', '3', '5']
+            if not kwargs:
+                # Limited query does not load the file
+                assert len(logfile) == 0
+
+            entries = logfile.filter_program('prog0', limit=3, from_end=True)
+            assert [x.pid for x in entries] == ['993', '996', '999']
+            entries = logfile.filter_host('host0', limit=2, from_end=True)
+            assert [x.message for x in entries] == ['message 996', 'message 998']
+            entries = logfile.filter_message(r'^message \d+0\b', limit=2, from_end=True)
+            assert entries[-1].message == 'message 990\n    continuation 990'
+            assert entries[0].message == 'message 980\n    continuation 980'
+
+            assert len(logfile.filter_host('host1')) == 500
+            assert len(logfile.filter_host('host1', from_end=True)) == 500
+            assert logfile.filter_host('host1', limit=0) == []
+            assert len(logfile.filter_host('host1', sample=1.0)) == 500
+            with pytest.raises(LogFileError):
+                logfile.filter_host('host1', sample=0)
+
+    logfile = LogFile(path)
+    random.seed(1)
+    assert 150 < len(logfile.filter_host('host1', sample=0.5)) < 350
+    assert len(logfile.filter_host('host1', sample=0.5, limit=10)) == 10
+    assert logfile.match_message(r'^message (?P<id>\d+)', limit=2, from_end=True) == [{'id': '998'}, {'id': '999'}]
+    assert [x.pid for x, m in logfile.match_rules({'a': r'^message 99'}, limit=2)] == ['99', '990']
+    logfile = LogFile(path)
+    assert len(logfile.between(limit=5, from_end=True)) == 5
+    assert len(logfile) == 0
+    logfile.reload()
+    assert [x.pid for x in logfile.between(limit=2, from_end=True)] == ['998', '999']
+
+
+def test_logfile_multi_tail_reader(tmpdir):
+    """Tail multiple logfiles
+
+    """
+    from systematic.log import LogfileMultiTailReader
+
+    first = write_logfile(tmpdir, 'first.log', lines=TEST_LOG_LINES[:1])
+    second = write_logfile(tmpdir, 'second.log', lines=TEST_LOG_LINES[2:3])
+    reader = LogfileMultiTailReader([first, second])
+    entries = [reader.readline(), reader.readline()]
+    assert [(path, entry.program) for path, entry in entries] == [(first, 'sshd'), (second, 'cron')]
+    reader.close()
+
+
+def test_async_logfile_tail_reader(tmpdir):
+    """Tail logfile with asyncio
+
+    """
+    import asyncio
+    from systematic.log import AsyncLogfileTailReader
+
+    path = write_logfile(tmpdir)
+
+    async def follow():
+        reader = AsyncLogfileTailReader(path)
+        entries = await reader.read()
+        reader.close()
+        return entries
+
+    entries = asyncio.run(follow())
+    assert [x.program for x in entries] == ['sshd', 'cron', 'kernel', 'sshd']
@@ -0,0 +1,460 @@
+"""
+Unit tests for tail reader
+"""
+
+import os
+import pytest
+import threading
+import time
+
+from systematic.inotify import has_inotify
+
+TAIL_BACKENDS = ['poll'] + (['inotify'] if has_inotify else [])
+
+
+def append_lines(path, lines):
+    with open(path, 'a') as fd:
+        for line in lines:
+            fd.write('{}\n'.format(line))
+
+
+@pytest.mark.parametrize('backend', TAIL_BACKENDS)
+def test_tail_reader(tmpdir, backend):
+    """Tail file with rotation and truncation
+
+    """
+    from systematic.tail import TailReader
+
+    path = os.path.join('{}'.format(tmpdir), 'messages')
+    append_lines(path, ('first', 'second'))
+    reader = TailReader(path, backend=backend)
+    assert reader.readline() == 'first'
+    assert reader.readline() == 'second'
+    assert reader.watcher.backend == backend
+
+    # Lines written while waiting
+    timer = threading.Timer(0.05, append_lines, (path, ('third', )))
+    timer.start()
+    assert reader.readline() == 'third'
+    timer.join()
+
+    # Rotated file
+    os.rename(path, '{}.1'.format(path))
+    append_lines(path, ('rotated', ))
+    assert reader.readline() == 'rotated'
+
+    # Truncated file
+    with open(path, 'w') as fd:
+        fd.write('x\n')
+    assert reader.readline() == 'x'
+
+
+@pytest.mark.skipif(not has_inotify, reason='inotify is not available')
+def test_inotify_watcher(tmpdir):
+    """Watch files with inotify
+
+    """
+    from systematic.tail import InotifyWatcher, INOTIFY_INTERVAL
+
+    path = os.path.join('{}'.format(tmpdir), 'messages')
+    other = os.path.join('{}'.format(tmpdir), 'other')
+    watcher = InotifyWatcher()
+    watcher.watch(path)
+    assert watcher.read() == []
+
+    append_lines(other, ('other', ))
+    assert watcher.read() == []
+    append_lines(path, ('created', ))
+    start = time.time()
+    assert watcher.wait(5) == [path]
+    assert time.time() - start < 1
+    assert watcher.wait(0.01) == []
+
+    # All paths are returned periodically without events
+    watcher.checked -= INOTIFY_INTERVAL
+    assert watcher.wait(0.01) == [path]
+
+    watcher.unwatch(path)
+    assert watcher.directories == {}
+    watcher.close()
+
+
+@pytest.mark.parametrize('backend', TAIL_BACKENDS)
+def test_multi_tail_reader(tmpdir, backend):
+    """Tail multiple files
+
+    """
+    from systematic.tail import MultiTailReader, TailReaderError
+
+    paths = [os.path.join('{}'.format(tmpdir), 'file{:d}.log'.format(index)) for index in range(5)]
+    append_lines(paths[0], ('old', ))
+    reader = MultiTailReader(paths, backend=backend, max_lines=2)
+    assert reader.readline() == (paths[0], 'old')
+    assert reader.poll() == []
+
+    append_lines(paths[3], ('a', ))
+    append_lines(paths[1], ('b', ))
+    lines = [reader.readline(), reader.readline()]
+    if backend == 'poll':
+        # Polling can't detect order of changes in different files
+        lines.sort(reverse=True)
+    assert lines == [(paths[3], 'a'), (paths[1], 'b')]
+
+    # Files with many lines are read in turns
+    append_lines(paths[2], ('c1', 'c2', 'c3'))
+    append_lines(paths[4], ('d1', ))
+    lines = reader.poll(1)
+    while len(lines) < 4:
+        lines.extend(reader.poll(1))
+    if backend == 'poll':
+        assert [x[1] for x in lines if x[0] == paths[2]] == ['c1', 'c2', 'c3']
+        assert sorted(x[1] for x in lines) == ['c1', 'c2', 'c3', 'd1']
+    else:
+        assert [x[1] for x in lines] == ['c1', 'c2', 'd1', 'c3']
+
+    # Rotation, and files created after start
+    os.rename(paths[0], '{}.1'.format(paths[0]))
+    append_lines(paths[0], ('rotated', ))
+    assert reader.readline() == (paths[0], 'rotated')
+
+    reader.seek_to_end()
+    append_lines(paths[1], ('new', ))
+    assert next(reader) == (paths[1], 'new')
+
+    for path in paths:
+        reader.remove(path)
+    with pytest.raises(TailReaderError):
+        reader.readline()
+    reader.close()
+
+
+@pytest.mark.parametrize('backend', TAIL_BACKENDS)
+def test_async_tail_reader(tmpdir, backend):
+    """Tail file with asyncio
+
+    """
+    import asyncio
+    from systematic.tail import AsyncTailReader
+
+    path = os.path.join('{}'.format(tmpdir), 'messages')
+
+    async def follow():
+        reader = AsyncTailReader(path, backend=backend, max_lines=2)
+        loop = asyncio.get_running_loop()
+
+        # File created after start
+        loop.call_later(0.05, append_lines, path, ('first', 'second', 'third'))
+        ticks = 0
+        task = asyncio.ensure_future(reader.readline())
+        while not task.done():
+            await asyncio.sleep(0.001)
+            ticks += 1
+        assert task.result() == 'first'
+        assert ticks > 10
+        assert reader.buffered == 1
+        assert await reader.read() == ['second']
+        assert await reader.read() == ['third']
+        assert await reader.read(timeout=0.05) == []
+
+        os.rename(path, '{}.1'.format(path))
+        loop.call_later(0.05, append_lines, path, ('rotated', 'more'))
+        lines = []
+        async for line in reader:
+            lines.append(line)
+            if len(lines) == 2:
+                break
+        assert lines == ['rotated', 'more']
+
+        reader.seek_to_end()
+        append_lines(path, ('new', ))
+        assert await reader.readline() == 'new'
+        reader.close()
+
+    asyncio.run(asyncio.wait_for(follow(), 10))
+
+
+@pytest.mark.skipif(not has_inotify, reason='inotify is not available')
+def test_async_tail_reader_events(tmpdir):
+    """Inotify events are read when the watcher becomes readable
+
+    """
+    import asyncio
+    from systematic.tail import AsyncTailReader
+
+    path = os.path.join('{}'.format(tmpdir), 'messages')
+    other = os.path.join('{}'.format(tmpdir), 'other')
+    append_lines(path, ('first', ))
+
+    async def follow():
+        reader = AsyncTailReader(path, backend='inotify')
+        callbacks = []
+        on_events = reader.__on_events__
+
+        def count_events():
+            callbacks.append(True)
+            on_events()
+        reader.__on_events__ = count_events
+
+        assert await reader.readline() == 'first'
+        append_lines(path, ('second', ))
+        append_lines(other, ('other', ))
+        await asyncio.sleep(0.2)
+        assert 0 < len(callbacks) < 10
+        assert await reader.read(timeout=1) == ['second']
+        reader.close()
+
+    asyncio.run(asyncio.wait_for(follow(), 10))
+
+
+@pytest.mark.parametrize('backend', TAIL_BACKENDS)
+def test_tail_reader_read_batch(tmpdir, backend):
+    """Read lines in batches
+
+    """
+    from systematic.tail import TailReader
+
+    path = os.path.join('{}'.format(tmpdir), 'messages')
+    append_lines(path, ('line {:d}'.format(index) for index in range(25)))
+    reader = TailReader(path, backend=backend)
+    assert reader.read_batch(max_bytes=21) == ['line 0', 'line 1', 'line 2']
+    assert reader.read_batch(max_lines=10) == ['line {:d}'.format(index) for index in range(3, 13)]
+    assert reader.read_batch() == ['line {:d}'.format(index) for index in range(13, 25)]
+    assert reader.read_batch(timeout=0.05) == []
+
+    # Incomplete lines are returned when completed
+    with open(path, 'a') as fd:
+        fd.write('partial')
+    assert reader.read_batch(timeout=0.05) == []
+    timer = threading.Timer(0.05, append_lines, (path, (' line', 'next')))
+    timer.start()
+    assert reader.read_batch(timeout=5) == ['partial line', 'next']
+    timer.join()
+
+    # Incomplete last line of rotated file is not lost
+    with open(path, 'a') as fd:
+        fd.write('last')
+    assert reader.read_batch(timeout=0.05) == []
+    os.rename(path, '{}.1'.format(path))
+    append_lines(path, ('rotated', ))
+    assert reader.read_batch(timeout=5) == ['last']
+    assert reader.read_batch(timeout=5) == ['rotated']
+
+    # Truncated file
+    with open(path, 'w') as fd:
+        fd.write('x\n')
+    assert reader.read_batch(timeout=5) == ['x']
+
+    append_lines(path, ('skipped', ))
+    reader.seek_to_end()
+    append_lines(path, ('new', ))
+    assert reader.readline() == 'new'
+    reader.close()
+
+
+@pytest.mark.parametrize('backend', TAIL_BACKENDS)
+def test_tail_reader_checkpoints(tmpdir, backend):
+    """Resume tail reader from checkpoints
+
+    """
+    from systematic.tail import TailCheckpoints, TailReader
+
+    path = os.path.join('{}'.format(tmpdir), 'messages')
+    checkpoints_path = os.path.join('{}'.format(tmpdir), 'checkpoints.json')
+    with open(path, 'w') as fd:
+        fd.write('first\r\nsecond \u00e4\nthird\n')
+
+    checkpoints = TailCheckpoints(checkpoints_path, sync_interval=60)
+    reader = TailReader(path, backend=backend, checkpoints=checkpoints)
+    assert reader.readline() == 'first'
+    assert reader.read_batch(max_lines=1) == ['second \u00e4']
+    reader.commit()
+    assert reader.offset == len('first\r\nsecond \u00e4\n'.encode('utf-8'))
+    reader.close()
+
+    # Committed positions are synced by interval or on close
+    assert not os.path.isfile(checkpoints_path)
+    checkpoints.close()
+
+    # Resume after restart, seek_to_end keeps checkpoint position
+    checkpoints = TailCheckpoints(checkpoints_path)
+    reader = TailReader(path, backend=backend, checkpoints=checkpoints)
+    reader.seek_to_end()
+    append_lines(path, ('fourth', ))
+    assert reader.read_batch(timeout=5) == ['third', 'fourth']
+    reader.commit()
+    reader.close()
+
+    # File was rotated while stopped
+    append_lines(path, ('fifth', ))
+    os.rename(path, '{}.1'.format(path))
+    append_lines(path, ('rotated', ))
+    checkpoints.sync()
+    reader = TailReader(path, backend=backend, checkpoints=TailCheckpoints(checkpoints_path))
+    assert reader.read_batch(timeout=5) == ['fifth']
+    assert reader.read_batch(timeout=5) == ['rotated']
+    reader.commit()
+    reader.checkpoints.close()
+    reader.close()
+
+    # New file without checkpoint is skipped with seek_to_end
+    other = os.path.join('{}'.format(tmpdir), 'other')
+    append_lines(other, ('old', ))
+    checkpoints = TailCheckpoints(checkpoints_path)
+    assert sorted(checkpoints.files) == [path]
+    reader = TailReader(other, backend=backend, checkpoints=checkpoints)
+    reader.seek_to_end()
+    append_lines(other, ('new', ))
+    assert reader.readline() == 'new'
+    reader.close()
+
+
+@pytest.mark.parametrize('backend', TAIL_BACKENDS)
+def test_multi_tail_reader_checkpoints(tmpdir, backend):
+    """Commit positions of multiple files
+
+    """
+    from systematic.tail import MultiTailReader, TailCheckpoints
+
+    paths = [os.path.join('{}'.format(tmpdir), 'file{:d}.log'.format(index)) for index in range(2)]
+    checkpoints_path = os.path.join('{}'.format(tmpdir), 'checkpoints.json')
+    append_lines(paths[0], ('a1', 'a2', 'a3'))
+    append_lines(paths[1], ('b1', ))
+
+    checkpoints = TailCheckpoints(checkpoints_path)
+    reader = MultiTailReader(paths, backend=backend, max_lines=2, checkpoints=checkpoints)
+    assert reader.readline() == (paths[0], 'a1')
+    reader.commit()
+    assert checkpoints.files == {}
+
+    # Only batches returned completely are committed
+    assert reader.readline() == (paths[0], 'a2')
+    assert reader.readline() == (paths[1], 'b1')
+    assert reader.readline() == (paths[0], 'a3')
+    reader.commit()
+    assert checkpoints.get(paths[0])['offset'] == 9
+    assert checkpoints.get(paths[1])['offset'] == 3
+    reader.close()
+    checkpoints.close()
+
+    append_lines(paths[1], ('b2', ))
+    reader = MultiTailReader(paths, backend=backend, checkpoints=TailCheckpoints(checkpoints_path))
+    reader.seek_to_end()
+    assert reader.poll(5) == [(paths[1], 'b2')]
+    reader.close()
+
+
+def rotate_file(path, lines, new_lines):
+    append_lines(path, lines)
+    os.rename(path, '{}.1'.format(path))
+    append_lines(path, new_lines)
+
+
+@pytest.mark.parametrize('backend', TAIL_BACKENDS)
+def test_tail_reader_rotation_while_waiting(tmpdir, backend):
+    """Lines written to a file before rotation are not lost
+
+    """
+    from systematic.tail import TailReader
+
+    path = os.path.join('{}'.format(tmpdir), 'messages')
+    append_lines(path, ('first', ))
+    reader = TailReader(path, backend=backend)
+    assert reader.read_batch() == ['first']
+    for index in range(5):
+        timer = threading.Timer(0.05, rotate_file, (path, ('last {:d}'.format(index), ), ('new {:d}'.format(index), )))
+        timer.start()
+        lines = reader.read_batch(timeout=5)
+        lines.extend(reader.read_batch(timeout=5))
+        timer.join()
+        assert lines == ['last {:d}'.format(index), 'new {:d}'.format(index)]
+
+    timer = threading.Timer(0.05, rotate_file, (path, ('last', ), ('new', )))
+    timer.start()
+    assert reader.readline() == 'last'
+    assert reader.readline() == 'new'
+    timer.join()
+    reader.close()
+
+
+@pytest.mark.skipif(not has_inotify, reason='inotify is not available')
+def test_shared_inotify_watcher(tmpdir):
+    """Tail readers share one inotify instance
+
+    """
+    from systematic import tail
+
+    paths = [os.path.join('{}'.format(tmpdir), 'file{:d}.log'.format(index)) for index in range(200)]
+    for path in paths:
+        append_lines(path, ('first', ))
+    readers = [tail.TailReader(path) for path in paths]
+    for reader in readers:
+        assert reader.readline() == 'first'
+    assert set(reader.watcher.backend for reader in readers) == set(['inotify'])
+    assert len(set(reader.watcher.fileno() for reader in readers)) == 1
+
+    # Events read by one thread are delivered to readers in other threads
+    results = {}
+
+    def follow(reader):
+        results[reader.path] = reader.read_batch(timeout=5)
+    threads = [threading.Thread(target=follow, args=(reader, )) for reader in readers[:10]]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    start = time.time()
+    for path in paths[:10]:
+        append_lines(path, ('second', ))
+    for thread in threads:
+        thread.join()
+    assert time.time() - start < 0.5
+    assert results == dict((path, ['second']) for path in paths[:10])
+
+    for reader in readers:
+        reader.watcher.close()
+        reader.close()
+    assert tail._shared_inotify is None
+
+
+def test_tail_watcher_fallback(tmpdir, monkeypatch, caplog):
+    """Falling back to polling is logged
+
+    """
+    from systematic import tail
+
+    def no_inotify():
+        raise tail.TailReaderError('Too many open files')
+    monkeypatch.setattr(tail, 'SharedInotifyWatcher', no_inotify)
+    monkeypatch.setattr(tail, 'has_inotify', True)
+
+    path = os.path.join('{}'.format(tmpdir), 'messages')
+    append_lines(path, ('first', ))
+    reader = tail.TailReader(path)
+    assert reader.readline() == 'first'
+    assert reader.watcher.backend == 'poll'
+    assert 'Too many open files' in caplog.text
+    reader.close()
+
+
+@pytest.mark.parametrize('backend', TAIL_BACKENDS)
+def test_tail_reader_unreadable_rotated_file(tmpdir, monkeypatch, backend):
+    """Rotated file which can't be opened does not keep the reader busy
+
+    """
+    from systematic import tail
+
+    path = os.path.join('{}'.format(tmpdir), 'messages')
+    append_lines(path, ('first', ))
+    reader = tail.TailReader(path, backend=backend)
+    assert reader.read_batch() == ['first']
+
+    access = os.access
+    monkeypatch.setattr(tail.os, 'access', lambda x, mode: x != path and access(x, mode))
+    rotate_file(path, ('last', ), ('new', ))
+    assert reader.read_batch(timeout=1) == ['last']
+    start = time.time()
+    assert reader.read_batch(timeout=0.1) == []
+    assert time.time() - start < 0.5
+
+    monkeypatch.undo()
+    assert reader.read_batch(timeout=5) == ['new']
+    reader.close()